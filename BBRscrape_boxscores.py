@@ -2,19 +2,65 @@ import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 import numpy as np
+import os
+import pickle
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import BBRscrape_players
+from BBRscrape_players import get_page, get_session, RateLimiter
+import pipeline_profile
 
 
-def scrape_boxscore(game_url):
+logger = pipeline_profile.get_logger(__name__)
+
+# raw html ({game_id}.html) and parsed minutes tables ({game_id}.pkl) of every boxscore fetched so far
+boxscore_dir = 'Boxscores'
+
+
+def get_game_id(game_url):
     if '.' in game_url:
         game_url = game_url.split('.')[0]
     if '/' in game_url:
         game_url = game_url.split('/')[-1]
-    URL = f'https://www.basketball-reference.com/boxscores/{game_url}.html'
-    page = requests.get(URL)  # requests gets the html page
-    page_sans_comments = str(page.content, encoding='utf-8').replace('-->',' ').replace('<!--',' ')
+    return game_url
+
+
+def write_file(path, content):
+    # write then rename, so threads/processes never read a half-written cache file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def scrape_boxscore(game_url, session=None, limiter=None, cache=True):
+    game_url = get_game_id(game_url)
+    html_path = os.path.join(boxscore_dir, f'{game_url}.html')
+    parsed_path = os.path.join(boxscore_dir, f'{game_url}.pkl')
+
+    if cache and os.path.isfile(parsed_path):
+        with open(parsed_path, 'rb') as f:
+            return pickle.load(f)
+
+    if cache and os.path.isfile(html_path):
+        with open(html_path, 'rb') as f:
+            page_content = f.read()
+    else:
+        URL = f'{BBRscrape_players.BBR_URL}/boxscores/{game_url}.html'
+        page_content = get_page(URL, session=session, limiter=limiter).content  # requests gets the html page
+        if cache:
+            write_file(html_path, page_content)
+
+    dict_df_boxscores = parse_boxscore_page(page_content, game_url)
+    if cache:
+        write_file(parsed_path, pickle.dumps(dict_df_boxscores, protocol=pickle.HIGHEST_PROTOCOL))
+    return dict_df_boxscores
+
+
+def parse_boxscore_page(page_content, game_url):
+    page_sans_comments = str(page_content, encoding='utf-8').replace('-->',' ').replace('<!--',' ')
     soup = BeautifulSoup(page_sans_comments, 'lxml')
-    
+
     dict_df_boxscores = {'URL': game_url}
     for t in soup.find_all('table'):
         if t.get('id'):
@@ -37,5 +83,38 @@ def scrape_boxscore(game_url):
                 df_temp = df_temp.rename(columns={'Starters':'Players'})
                 df_temp['Players'] = df_temp['Players'].apply(lambda x: dict_player_name_id[x])
                 dict_df_boxscores[title] = df_temp
-    
-    return dict_df_boxscores
\ No newline at end of file
+
+    return dict_df_boxscores
+
+
+def scrape_boxscores(game_urls, n_workers=4, requests_per_second=None):
+    '''
+    Batched prefetch: fetches every boxscore not cached yet in one rate-limited thread pool job,
+    afterwards scrape_boxscore() on any of game_urls is served from boxscore_dir
+    requests_per_second: a budget of its own for this batch, by default it draws from BBRscrape_players.rate_limiter,
+    which the workers of run_stage_parallel share across processes
+    '''
+    game_ids = list(dict.fromkeys(get_game_id(game_url) for game_url in game_urls))
+    missing_ids = [game_id for game_id in game_ids
+                   if not os.path.isfile(os.path.join(boxscore_dir, f'{game_id}.pkl'))]
+    if len(missing_ids) == 0:
+        return []
+    logger.info(f"Prefetching {len(missing_ids)} boxscores")
+    pipeline_profile.record_event('prefetch_boxscores', games=len(missing_ids))
+
+    if requests_per_second is None:
+        limiter = BBRscrape_players.rate_limiter
+    else:
+        limiter = RateLimiter(requests_per_second=requests_per_second)
+    session = get_session(n_workers)
+    failed_ids = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(scrape_boxscore, game_id, session, limiter):game_id for game_id in missing_ids}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (requests.RequestException, KeyError, IndexError, ValueError) as e:
+                logger.warning(f"{futures[future]} failed: {e}")
+                failed_ids.append(futures[future])
+    session.close()
+    return failed_ids
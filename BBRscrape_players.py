@@ -1,25 +1,129 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import pandas as pd
 import numpy as np
+import lxml.html
+import re
+import threading
+import multiprocessing
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pandas.io.parsers import TextParser
+import pipeline_profile
 
 
-def scrape_player(bbr_id=None):
-    
-    URL = f'https://www.basketball-reference.com/players/{bbr_id[0]}/{bbr_id}.html'
-    page = requests.get(URL)  # requests gets the html page
-    #page_sans_comments = re.sub(r'<!.*?->','', str(page.content))
-    page_sans_comments = str(page.content, encoding='utf-8').replace('-->',' ').replace('<!--',' ')
-    #print(page.content)
-    #soup = BeautifulSoup(page.content, "html.parser")
-    #re.sub(r'<!.*?->','', soup)
-    soup = BeautifulSoup(page_sans_comments, 'lxml')
-    
+logger = pipeline_profile.get_logger(__name__)
+
+# point at a local server (e.g. python -m http.server over saved pages) to scrape fixtures, see tests/conftest.py
+BBR_URL = 'https://www.basketball-reference.com'
+# whitespace runs pd.read_html collapses inside table cells
+re_whitespace = re.compile(r'[\r\n]+|\s{2,}')
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every thread that hits BBR
+    BBR jails clients that go over ~20 requests a minute, hence the default of one request every pi seconds
+    '''
+    def __init__(self, requests_per_second=1/np.pi, burst=1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.clock = time.monotonic
+        # [tokens, time of the last refill]
+        self.state = [burst, self.clock()]
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                tokens = min(self.burst, self.state[0] + (now - self.state[1]) * self.requests_per_second)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.requests_per_second
+            time.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    '''
+    RateLimiter whose bucket is in shared memory, one request budget for a whole process pool
+    hand it to the workers with ProcessPoolExecutor(initializer=set_rate_limiter, initargs=(limiter,))
+    '''
+    def __init__(self, requests_per_second=1/np.pi, burst=1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        # the wall clock, time.monotonic is not comparable between processes on every platform
+        self.clock = time.time
+        self.state = multiprocessing.Array('d', [burst, self.clock()])
+        self.lock = self.state.get_lock()
+
+
+# every get_page/scrape_boxscores call without a limiter of its own draws from this one
+rate_limiter = RateLimiter()
+
+
+def set_rate_limiter(limiter):
+    # e.g. the initializer of a process pool, so its workers share the parent's SharedRateLimiter
+    global rate_limiter
+    rate_limiter = limiter
+
+
+def get_session(n_workers=1):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(n_workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_page(url, session=None, limiter=None, max_retries=5, backoff=2.0, timeout=30):
+    '''
+    GET through the rate limiter, retrying connection errors, 429 and 5xx with exponential backoff
+    (or the server's Retry-After)
+    '''
+    if session is None:
+        session = requests
+    if limiter is None:
+        limiter = rate_limiter
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            page = session.get(url, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff ** attempt)
+            continue
+        if (page.status_code == 429) or (page.status_code >= 500):
+            if attempt == max_retries:
+                page.raise_for_status()
+            retry_after = page.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit() else backoff ** attempt)
+            continue
+        page.raise_for_status()
+        return page
+
+
+def scrape_player(bbr_id=None, session=None, limiter=None, table_ids=None, fast=True):
+    '''
+    table_ids: only parse these tables (all of them if None)
+    fast: parse with parse_player_page_fast, else the original BeautifulSoup + pd.read_html parser
+    '''
+    URL = f'{BBR_URL}/players/{bbr_id[0]}/{bbr_id}.html'
+    page = get_page(URL, session=session, limiter=limiter)  # requests gets the html page
+    if fast:
+        return parse_player_page_fast(page.content, bbr_id, table_ids=table_ids)
+    return parse_player_page(page.content, bbr_id, table_ids=table_ids)
+
+
+def parse_player_info(soup, bbr_id):
     info = soup.find('div', attrs={'id':'meta'}).find_all('p')
     #for n, i in enumerate(info):
     #    print(n, i, '\n')
-    player_dict = {}
     info_dict = {'BBR_id':bbr_id}
     if 'Pronunciation' in info[0].text:
         info_dict['Pronunciation'] = info[0].text.split(':')[-1].strip()
@@ -34,7 +138,7 @@ def scrape_player(bbr_id=None):
         elif len(item) == 2:
             info_dict[item[0].strip()] = item[1].strip()
         else:
-            print("ERROR ERROR ",item)
+            logger.error(f"ERROR ERROR {item}")
     
     if 'Position' in info[2].text:
         info.insert(2,'')
@@ -143,43 +247,220 @@ def scrape_player(bbr_id=None):
             transactions.append(transaction_detail.strip())
 
         info_dict['Transactions'] = transactions
-        
+
+    return info_dict
+
+
+def parse_player_page(page_content, bbr_id, table_ids=None):
+    '''
+    BeautifulSoup parser, every table is handed to pd.read_html
+    table_ids: only keep these tables (all of them if None), 'info' is always parsed
+    '''
+    #page_sans_comments = re.sub(r'<!.*?->','', str(page.content))
+    page_sans_comments = str(page_content, encoding='utf-8').replace('-->',' ').replace('<!--',' ')
+    #print(page.content)
+    #soup = BeautifulSoup(page.content, "html.parser")
+    #re.sub(r'<!.*?->','', soup)
+    soup = BeautifulSoup(page_sans_comments, 'lxml')
+
+    player_dict = {}
+    info_dict = parse_player_info(soup, bbr_id)
     player_dict['info'] = pd.DataFrame({k:[info_dict[k]] for k, v in info_dict.items()})
     
     for t in soup.find_all('table'):
-        if t.get('id') not in [None,'stathead_insights']:
+        if (t.get('id') not in [None,'stathead_insights']) and ((table_ids is None) or (t.get('id') in table_ids)):
 
             pd_df = pd.read_html(str(t))[0]
+            player_dict[f"{t.get('id')}"] = clean_player_table(pd_df)
     
-            if isinstance(pd_df.columns, pd.MultiIndex):
-                unnamed_cols = [(idx1, idx2) for idx1, idx2 in pd_df.columns if ('Unnamed:' in idx1) and ('Unnamed:' in idx2)]
-            else:
-                unnamed_cols = [col for col in pd_df.columns if 'Unnamed:' in col]
-
-            for unnamed_col in unnamed_cols:
-                if pd_df.loc[:,unnamed_col].isnull().sum() == pd_df.shape[0]:
-                    pd_df = pd_df.drop(unnamed_col, axis=1)
-            
-            player_dict[f"{t.get('id')}"] = pd_df[pd_df.shape[1] != pd_df.isnull().sum(axis=1)]
-    
     return player_dict
 
-def scrape_players(list_of_bbr_ids, sleep_timer=np.pi):
+
+def clean_player_table(pd_df):
+    # drop the empty spacer columns and all-NaN rows BBR puts in its tables
+    if isinstance(pd_df.columns, pd.MultiIndex):
+        unnamed_cols = [(idx1, idx2) for idx1, idx2 in pd_df.columns if ('Unnamed:' in idx1) and ('Unnamed:' in idx2)]
+    else:
+        unnamed_cols = [col for col in pd_df.columns if 'Unnamed:' in col]
+
+    for unnamed_col in unnamed_cols:
+        if pd_df.loc[:,unnamed_col].isnull().sum() == pd_df.shape[0]:
+            pd_df = pd_df.drop(unnamed_col, axis=1)
+
+    return pd_df[pd_df.shape[1] != pd_df.isnull().sum(axis=1)]
+
+
+def table_text_rows(rows):
+    '''
+    <tr> elements -> lists of cell texts, colspan/rowspan cells repeated the way pd.read_html does
+    '''
+    text_rows = []
+    remainder = []  # (index, text, rows left) of cells spanning down from previous rows
+    for tr in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for td in tr.xpath('./td|./th'):
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+                index += 1
+            text = re_whitespace.sub(' ', td.text_content().strip())
+            rowspan = int(td.get('rowspan') or 1)
+            colspan = int(td.get('colspan') or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        text_rows.append(texts)
+        remainder = next_remainder
+    while remainder:
+        text_rows.append([prev_text for prev_index, prev_text, prev_rowspan in remainder])
+        remainder = [(prev_index, prev_text, prev_rowspan - 1) for prev_index, prev_text, prev_rowspan in remainder
+                     if prev_rowspan > 1]
+    return text_rows
+
+
+def read_lxml_table(t):
+    '''
+    Same DataFrame pd.read_html(str(t))[0] gives, read straight off the parsed lxml <table>
+    instead of serializing it and parsing it a second time
+    '''
+    # removed with their tail text, as pd.read_html does
+    for hidden in t.xpath('.//*[contains(translate(@style, " ", ""), "display:none")]'):
+        hidden.getparent().remove(hidden)
+    head_rows = t.xpath('.//thead/tr')
+    body_rows = t.xpath('.//tbody//tr') + t.xpath('./tr')
+    foot_rows = t.xpath('.//tfoot//tr')
+    if not head_rows:
+        # no <thead>, the top all-<th> rows are the header
+        while body_rows and all(td.tag == 'th' for td in body_rows[0].xpath('./td|./th')):
+            head_rows.append(body_rows.pop(0))
+    head, body, foot = table_text_rows(head_rows), table_text_rows(body_rows), table_text_rows(foot_rows)
+    if not (head or body):
+        raise ValueError(f"table {t.get('id')} has no rows")
+
+    header = None
+    if head:
+        if len(head) == 1:
+            header = 0
+        else:
+            header = [n for n, row in enumerate(head) if any(text for text in row)]
+    rows = head + body + foot
+    n_cols = max(len(row) for row in rows)
+    rows = [row + [''] * (n_cols - len(row)) for row in rows]
+    with TextParser(rows, header=header, thousands=',') as parser:
+        return parser.read()
+
+
+def parse_player_page_fast(page_content, bbr_id, table_ids=None):
+    '''
+    lxml parser: one parse of the page, XPath straight to the wanted tables, cells read off the tree
+    Returns the same player_dict as parse_player_page
+    '''
+    # BBR ships most tables inside html comments
+    page_sans_comments = page_content.replace(b'<!--', b' ').replace(b'-->', b' ')
+    tree = lxml.html.fromstring(page_sans_comments, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    # the info section is small, keep its parsing in one place by running parse_player_info on just those divs
+    info_divs = tree.xpath("//div[@id='meta' or @id='div_contract' or @id='all_transactions']")
+    info_soup = BeautifulSoup(''.join(lxml.html.tostring(div, encoding='unicode') for div in info_divs), 'lxml')
+    player_dict = {}
+    info_dict = parse_player_info(info_soup, bbr_id)
+    player_dict['info'] = pd.DataFrame({k:[info_dict[k]] for k, v in info_dict.items()})
+
+    for t in tree.xpath('//table[@id]'):
+        if (t.get('id') != 'stathead_insights') and ((table_ids is None) or (t.get('id') in table_ids)):
+            player_dict[t.get('id')] = clean_player_table(read_lxml_table(t))
+
+    return player_dict
+
+
+def scrape_players(list_of_bbr_ids, sleep_timer=np.pi, n_workers=1, requests_per_second=None, on_scraped=None,
+                   table_ids=None, fast=True):
+    '''
+    requests_per_second: request budget shared by all n_workers threads, defaults to one request every sleep_timer seconds
+    on_scraped: called as on_scraped(bbr_id, player_dict) as each player finishes, e.g. to save it right away so an
+                interrupted run can be resumed with only the remaining ids
+    table_ids, fast: passed on to scrape_player
+    players that fail to scrape are reported and left out of the returned dict
+    '''
     dict_of_player_dicts = {}
     if isinstance(list_of_bbr_ids, str):
         list_of_bbr_ids = [list_of_bbr_ids]
     else:
-        list_of_bbr_ids = list(set(list_of_bbr_ids))
-    print(f"Scraping BBR for: {list_of_bbr_ids}")
-    for n, bbr_id in enumerate(list_of_bbr_ids):
-        dict_of_player_dicts[bbr_id] = scrape_player(bbr_id)
-        print(f"{dict_of_player_dicts[bbr_id]['info']['Name'][0]:>40} is Sleeping...", end='')
-        if n < len(list_of_bbr_ids) - 1:
-            time.sleep(sleep_timer)
-        print(" and now is Awake")
-        
+        list_of_bbr_ids = list(dict.fromkeys(list_of_bbr_ids))
+    logger.info(f"Scraping BBR for: {list_of_bbr_ids}")
+
+    if requests_per_second is None:
+        requests_per_second = 1 / sleep_timer
+    limiter = RateLimiter(requests_per_second=requests_per_second)
+    session = get_session(n_workers)
+    failed_bbr_ids = []
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(scrape_player, bbr_id, session, limiter, table_ids, fast):bbr_id for bbr_id in list_of_bbr_ids}
+        for future in as_completed(futures):
+            bbr_id = futures[future]
+            try:
+                dict_of_player_dicts[bbr_id] = future.result()
+            except (requests.RequestException, AttributeError, IndexError, ValueError) as e:
+                logger.warning(f"{bbr_id:>40} failed: {e}")
+                failed_bbr_ids.append(bbr_id)
+                continue
+            if on_scraped is not None:
+                on_scraped(bbr_id, dict_of_player_dicts[bbr_id])
+            logger.info(f"{dict_of_player_dicts[bbr_id]['info']['Name'][0]:>40} scraped")
+    session.close()
+
+    if len(failed_bbr_ids) > 0:
+        logger.warning(f"Failed to scrape: {failed_bbr_ids}")
+    return {bbr_id:dict_of_player_dicts[bbr_id] for bbr_id in list_of_bbr_ids if bbr_id in dict_of_player_dicts}
+
+def benchmark_parsers(page_paths, table_ids=None, n_repeats=3):
+    '''
+    Per-page parse time of parse_player_page vs parse_player_page_fast on saved player pages
+    (e.g. Players/pages/*.html), also checks both parsers return the same tables
+    returns the times and the mismatches, (bbr_id, table_name) of every table the parsers disagree on or only one returned
+    '''
+    times = {'soup':[], 'fast':[]}
+    mismatches = []
+    for page_path in page_paths:
+        with open(page_path, 'rb') as f:
+            page_content = f.read()
+        bbr_id = page_path.split('/')[-1].split('.')[0]
+        for name, parser in [('soup', parse_player_page), ('fast', parse_player_page_fast)]:
+            best = np.inf
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                player_dict = parser(page_content, bbr_id, table_ids=table_ids)
+                best = min(best, time.perf_counter() - start)
+            times[name].append(best)
+            if name == 'soup':
+                soup_dict = player_dict
+        if soup_dict.keys() != player_dict.keys():
+            logger.warning(f"{bbr_id}: parsers returned different tables {sorted(soup_dict.keys() ^ player_dict.keys())}")
+            mismatches += [(bbr_id, table_name) for table_name in sorted(soup_dict.keys() ^ player_dict.keys())]
+        for table_name in sorted(soup_dict.keys() & player_dict.keys()):
+            if not soup_dict[table_name].equals(player_dict[table_name]):
+                logger.warning(f"{bbr_id}: parsers disagree on {table_name}")
+                mismatches.append((bbr_id, table_name))
 
-    return dict_of_player_dicts
+    soup_ms, fast_ms = 1000 * np.mean(times['soup']), 1000 * np.mean(times['fast'])
+    print(f"{len(page_paths)} pages, tables: {'all' if table_ids is None else table_ids}")
+    print(f"parse_player_page:      {soup_ms:8.1f} ms/page")
+    print(f"parse_player_page_fast: {fast_ms:8.1f} ms/page ({soup_ms / fast_ms:.1f}x)")
+    return times, mismatches
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    import sys
+    # python BBRscrape_players.py saved_page1.html saved_page2.html ...
+    if len(sys.argv) > 1:
+        benchmark_parsers(sys.argv[1:])
\ No newline at end of file
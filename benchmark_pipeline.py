@@ -0,0 +1,328 @@
+import pandas as pd
+import numpy as np
+import os
+import io
+import contextlib
+import pickle
+import tempfile
+import time
+import tracemalloc
+import play_by_play
+import player_store
+import BBRscrape_boxscores
+
+
+# columns of the Kaggle PBP_data/NBA_PBP_{season}.csv files, in file order
+pbp_csv_cols = ['URL','GameType','Location','Date','Time','WinningTeam','Quarter','SecLeft','AwayTeam','AwayPlay',
+                'AwayScore','HomeTeam','HomePlay','HomeScore','Shooter','ShotType','ShotOutcome','ShotDist','Assister',
+                'Blocker','FoulType','Fouler','Fouled','Rebounder','ReboundType','ViolationPlayer','ViolationType',
+                'TimeoutTeam','FreeThrowShooter','FreeThrowOutcome','FreeThrowNum','EnterGame','LeaveGame',
+                'TurnoverPlayer','TurnoverType','TurnoverCause','TurnoverCauser','JumpballAwayPlayer',
+                'JumpballHomePlayer','JumpballPoss']
+teams = ['ATL','BOS','BRK','CHI','CHO','CLE','DAL','DEN','DET','GSW','HOU','IND','LAC','LAL','MEM',
+         'MIA','MIL','MIN','NOP','NYK','OKC','ORL','PHI','PHO','POR','SAC','SAS','TOR','UTA','WAS']
+roster_size = 13
+
+
+def make_players(rng, season, n_teams=len(teams)):
+    '''
+    Fake player tables for every roster spot, enough of them for the lineup, possession and feature stages
+    returns (rosters: team -> [bbr_id], players: bbr_id -> {table_name: pd.DataFrame})
+    '''
+    previous_season = play_by_play.get_previous_season(season, 1)
+    rosters, players = {}, {}
+    for team in teams[:n_teams]:
+        rosters[team] = [f"{team.lower()}pl{n:02d}" for n in range(roster_size)]
+        for bbr_id in rosters[team]:
+            season_rows = {'Season': [previous_season, season], 'Tm': [team, team]}
+            players[bbr_id] = {
+                'info': pd.DataFrame({'BBR_id': [bbr_id], 'Name': [f"P. {bbr_id}"],
+                                      'Height_cm': [int(rng.integers(180, 225))], 'Mass_kg': [int(rng.integers(80, 130))],
+                                      'Birthdate': [f"{int(rng.integers(1980, 2000))}-{int(rng.integers(1, 13)):02d}-15"],
+                                      'Transactions': [[]]}),
+                'per_poss': pd.DataFrame(dict(season_rows, PTS=rng.normal(20, 5, 2), ORtg=rng.normal(110, 5, 2))),
+                'advanced': pd.DataFrame(dict(season_rows, BPM=rng.normal(0, 2, 2), VORP=rng.normal(1, 1, 2))),
+                'all_salaries': pd.DataFrame({'Season': [previous_season, season], 'Team': [team, team], 'Lg': ['NBA', 'NBA'],
+                                              'Salary': [f"${int(salary):,}" for salary in rng.integers(1e6, 3e7, 2)]}),
+            }
+    return rosters, players
+
+
+def make_game(rng, game_url, game_date, away, home, rosters, sub_rate=0.08, n_ot=0, miss_rate=0.0, drop_sub_rate=0.0):
+    '''
+    Plays of one fake game in the Kaggle schema, and the seconds each player was on the court
+
+    sub_rate: chance of a substitution per team after each play
+    miss_rate: chance per team and quarter (after the 1st) that one player on court the whole quarter is never named in it,
+               an undercount the lineup stage repairs from the boxscore (unless it hits the same team twice in a game)
+    drop_sub_rate: chance a substitution row is left out of the file, a miscount that persists
+    '''
+    rows = []
+    score = {'a': 0, 'h': 0}
+    team = {'a': away, 'h': home}
+    lineups = {side: list(rng.choice(rosters[team[side]], 5, replace=False)) for side in 'ah'}
+    seconds_played = {}
+    clock = {'sec': 720}
+    silent = {'a': None, 'h': None}
+
+    def advance_clock(sec):
+        # time since the last play goes to the players on court before this play's substitution
+        for side in 'ah':
+            for p in lineups[side]:
+                seconds_played[p] = seconds_played.get(p, 0) + clock['sec'] - sec
+        clock['sec'] = sec
+
+    def add_row(qtr, sec, side, play, **players_and_details):
+        advance_clock(sec)
+        row = dict(URL=game_url, GameType='regular', Location='Arena', Date=f"{game_date:%B} {game_date.day} {game_date.year}",
+                   Time='7:30 PM', Quarter=qtr, SecLeft=sec, AwayTeam=away, HomeTeam=home,
+                   AwayPlay=play if side == 'a' else np.nan, HomePlay=play if side == 'h' else np.nan,
+                   AwayScore=score['a'], HomeScore=score['h'])
+        for col, value in players_and_details.items():
+            # player columns hold 'F. Last - bbr_id' like the Kaggle files
+            row[col] = f"{value[0].upper()}. {value} - {value}" if col in play_by_play.player_cols else value
+        rows.append(row)
+
+    def named_player(side, exclude=None):
+        candidates = [p for p in lineups[side] if (p != silent[side]) and (p != exclude)]
+        return candidates[rng.integers(len(candidates))]
+
+    for qtr in range(1, 5 + n_ot):
+        qtr_seconds = 720 if qtr <= 4 else 300
+        clock['sec'] = qtr_seconds
+        previous_silent = dict(silent)
+        silent = {'a': None, 'h': None}
+        previous_lineups = {side: list(lineups[side]) for side in 'ah'}
+        if qtr > 1:
+            # substitutions between quarters are not in the play-by-play
+            for side in 'ah':
+                if rng.random() < 0.5:
+                    bench = [p for p in rosters[team[side]] if p not in lineups[side]]
+                    lineups[side][rng.integers(5)] = bench[rng.integers(len(bench))]
+                # a player named in the last quarter who stays on court and is never named in this one
+                candidates = [p for p in lineups[side] if (p in previous_lineups[side]) and (p != previous_silent[side])]
+                if (rng.random() < miss_rate) and (len(candidates) > 0):
+                    silent[side] = candidates[rng.integers(len(candidates))]
+
+        sec = qtr_seconds
+        if (qtr == 1) or (qtr > 4):
+            possession = 'a' if rng.random() < 0.5 else 'h'
+            add_row(qtr, sec, 'a', 'Jump ball', JumpballAwayPlayer=named_player('a'), JumpballHomePlayer=named_player('h'),
+                    JumpballPoss=named_player(possession))
+        else:
+            possession = 'a' if qtr % 2 == 0 else 'h'
+
+        while sec > 14:
+            sec = max(sec - int(rng.integers(4, 24)), 1)
+            offense, defense = possession, ('h' if possession == 'a' else 'a')
+            shooter = named_player(offense)
+            play = rng.random()
+            if play < 0.45:
+                points = 3 if rng.random() < 0.3 else 2
+                score[offense] += points
+                add_row(qtr, sec, offense, f"{shooter} makes {points}-pt jump shot", Shooter=shooter,
+                        ShotType=f"{points}-pt jump shot", ShotOutcome='make', ShotDist=int(rng.integers(1, 28)),
+                        Assister=named_player(offense, exclude=shooter))
+                if rng.random() < 0.05:
+                    add_row(qtr, sec, defense, 'Shooting foul', FoulType='shooting', Fouler=named_player(defense), Fouled=shooter)
+                    score[offense] += 1
+                    add_row(qtr, sec, offense, 'free throw 1 of 1', FreeThrowShooter=shooter, FreeThrowOutcome='make',
+                            FreeThrowNum='1 of 1')
+                possession = defense
+            elif play < 0.85:
+                blocked = {'Blocker': named_player(defense)} if rng.random() < 0.1 else {}
+                add_row(qtr, sec, offense, f"{shooter} misses 2-pt layup", Shooter=shooter, ShotType='2-pt layup',
+                        ShotOutcome='miss', ShotDist=int(rng.integers(0, 4)), **blocked)
+                rebound_side = defense if rng.random() < 0.75 else offense
+                sec = max(sec - 1, 1)
+                add_row(qtr, sec, rebound_side, 'Rebound', Rebounder=named_player(rebound_side),
+                        ReboundType='defensive' if rebound_side == defense else 'offensive')
+                possession = rebound_side
+            elif play < 0.92:
+                add_row(qtr, sec, offense, 'Turnover', TurnoverPlayer=shooter, TurnoverType='bad pass',
+                        TurnoverCauser=named_player(defense))
+                possession = defense
+            elif play < 0.96:
+                add_row(qtr, sec, defense, 'Shooting foul', FoulType='shooting', Fouler=named_player(defense), Fouled=shooter)
+                for n in (1, 2):
+                    made = rng.random() < 0.75
+                    score[offense] += int(made)
+                    add_row(qtr, sec, offense, f"free throw {n} of 2", FreeThrowShooter=shooter,
+                            FreeThrowOutcome='make' if made else 'miss', FreeThrowNum=f"{n} of 2")
+                if not made:
+                    sec = max(sec - 1, 1)
+                    add_row(qtr, sec, defense, 'Rebound', Rebounder=named_player(defense), ReboundType='defensive')
+                possession = defense
+            elif play < 0.98:
+                add_row(qtr, sec, offense, f"{team[offense]} full timeout", TimeoutTeam=team[offense])
+            else:
+                winner = 'a' if rng.random() < 0.5 else 'h'
+                add_row(qtr, sec, 'a', 'Jump ball', JumpballAwayPlayer=named_player('a'), JumpballHomePlayer=named_player('h'),
+                        JumpballPoss=named_player(winner))
+                possession = winner
+
+            for side in 'ah':
+                if rng.random() < sub_rate:
+                    bench = [p for p in rosters[team[side]] if p not in lineups[side]]
+                    leaving = named_player(side)
+                    entering = bench[rng.integers(len(bench))]
+                    if rng.random() >= drop_sub_rate:
+                        add_row(qtr, sec, side, f"{entering} enters the game for {leaving}", EnterGame=entering, LeaveGame=leaving)
+                    lineups[side][lineups[side].index(leaving)] = entering
+
+        # everyone on court gets named at least once a quarter, except the silent players
+        for side in 'ah':
+            for p in lineups[side]:
+                if p != silent[side]:
+                    add_row(qtr, 1, side, 'Rebound', Rebounder=p, ReboundType='offensive')
+        add_row(qtr, 1, 'h', 'Violation', ViolationPlayer=named_player('h'), ViolationType='kicked ball')
+        add_row(qtr, 0, 'a', f"End of {qtr} quarter")
+
+    if score['a'] == score['h']:
+        score['h'] += 1
+    rows[-1]['AwayPlay'] = 'End of Game'
+    for row in rows:
+        row['WinningTeam'] = home if score['h'] > score['a'] else away
+    return rows, seconds_played
+
+
+def make_boxscore(game_url, away, home, seconds_played, rosters):
+    # the dict scrape_boxscore caches, minutes of every player who got on the court
+    dict_df_boxscores = {'URL': BBRscrape_boxscores.get_game_id(game_url)}
+    for team in (away, home):
+        team_players = [p for p in rosters[team] if seconds_played.get(p, 0) > 0]
+        minutes = [seconds_played[p] / 60 for p in team_players]
+        dict_df_boxscores[team] = pd.DataFrame({'Players': team_players + [team], 'MP': minutes + [sum(minutes)]})
+    return dict_df_boxscores
+
+
+def make_season(n_games=200, season='2018-19', sub_rate=0.08, ot_rate=0.06, miss_rate=0.0, drop_sub_rate=0.0,
+                n_teams=len(teams), seed=0):
+    '''
+    Writes a fake season in the current directory: PBP_data/NBA_PBP_{season}.csv, the player tables in the
+    player_store and every game's boxscore in the BBRscrape_boxscores cache, so the pipeline runs without the network
+    returns the number of play-by-play rows
+    '''
+    rng = np.random.default_rng(seed)
+    rosters, players = make_players(rng, season, n_teams)
+    season_start = pd.Timestamp(f"{season[:4]}-10-16")
+
+    rows = []
+    for n in range(n_games):
+        away, home = rng.choice(list(rosters.keys()), 2, replace=False)
+        game_date = season_start + pd.Timedelta(days=int(n * 170 / max(n_games, 1)))
+        game_url = f"/boxscores/{game_date:%Y%m%d}{n:04d}{home}.html"
+        game_rows, seconds_played = make_game(rng, game_url, game_date, away, home, rosters, sub_rate=sub_rate,
+                                              n_ot=int(rng.random() < ot_rate), miss_rate=miss_rate, drop_sub_rate=drop_sub_rate)
+        rows += game_rows
+        BBRscrape_boxscores.write_file(os.path.join(BBRscrape_boxscores.boxscore_dir,
+                                                    f"{BBRscrape_boxscores.get_game_id(game_url)}.pkl"),
+                                       pickle.dumps(make_boxscore(game_url, away, home, seconds_played, rosters)))
+
+    os.makedirs('PBP_data', exist_ok=True)
+    pd.DataFrame(rows).reindex(columns=pbp_csv_cols).to_csv(f'PBP_data/NBA_PBP_{season}.csv', index=False)
+    for bbr_id, player_tables in players.items():
+        player_store.save_player(bbr_id, player_tables)
+    return len(rows)
+
+
+def reset_pipeline_state():
+    # a stage run should not find players, codes or attribute tables a previous run left behind
+    play_by_play.players_dict.clear()
+    play_by_play.lineup_miscounts.clear()
+    play_by_play.player_attr_tables.clear()
+    play_by_play.roster_index = (set(), None)
+
+
+def measure_stage(stage, fn, n_rows, track_memory=True):
+    '''
+    Runs fn twice, once timed and once under tracemalloc (tracing slows it down) for its peak memory,
+    what the pipeline prints along the way is swallowed
+    returns (fn's result, dict of the stage's wall time, rows/sec and peak MiB)
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn()
+        seconds = time.perf_counter() - start
+
+        peak_mib = np.nan
+        if track_memory:
+            tracemalloc.start()
+            fn()
+            peak_mib = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return result, {'stage': stage, 'seconds': seconds, 'rows': n_rows,
+                    'rows_per_sec': n_rows / seconds if seconds > 0 else np.nan, 'peak_MiB': peak_mib}
+
+
+def run_benchmark(n_games=200, season='2018-19', sub_rate=0.08, ot_rate=0.06, miss_rate=0.0, drop_sub_rate=0.0,
+                  lineup_engine='vectorized', track_memory=True, seed=0, work_dir=None):
+    '''
+    Times each pipeline stage on a fake season (see make_season) built in work_dir (a new temporary directory if None):
+    read_season, add_lineups, add_possessions, drop_bad_games, get_lineup_results, get_stints, get_possessions,
+    get_lineup_results on the stints, get_lineup_features and load_season end to end
+    returns a DataFrame with one row per stage: seconds, rows, rows_per_sec, peak_MiB
+    '''
+    work_dir = tempfile.mkdtemp(prefix='pbp_benchmark_') if work_dir is None else work_dir
+    os.makedirs(work_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        n_rows = make_season(n_games, season=season, sub_rate=sub_rate, ot_rate=ot_rate, miss_rate=miss_rate,
+                             drop_sub_rate=drop_sub_rate, seed=seed)
+        print(f"{n_games} games, {n_rows} rows generated in {work_dir} ({time.perf_counter() - start:.1f}s)")
+        reset_pipeline_state()
+
+        stages = []
+        df_, stage = measure_stage('read_season', lambda: play_by_play.read_season(season), n_rows, track_memory)
+        stages.append(stage)
+        df_, stage = measure_stage('add_lineups', lambda: play_by_play.add_lineups(df_, lineup_engine=lineup_engine),
+                                   n_rows, track_memory)
+        stages.append(stage)
+        df_, stage = measure_stage('add_possessions',
+                                   lambda: df_.groupby('URL', group_keys=False).apply(play_by_play.add_possessions),
+                                   n_rows, track_memory)
+        stages.append(stage)
+        df_, stage = measure_stage('drop_bad_games',
+                                   lambda: play_by_play.drop_bad_games(df_, miscounts=play_by_play.lineup_miscounts),
+                                   n_rows, track_memory)
+        stages.append(stage)
+        df_results, stage = measure_stage('get_lineup_results', lambda: play_by_play.get_lineup_results(df_),
+                                          n_rows, track_memory)
+        stages.append(stage)
+        df_stints, stage = measure_stage('get_stints', lambda: play_by_play.get_stints(df_), n_rows, track_memory)
+        stages.append(stage)
+        _, stage = measure_stage('get_possessions', lambda: play_by_play.get_possessions(df_), n_rows, track_memory)
+        stages.append(stage)
+        _, stage = measure_stage('get_lineup_results_stints', lambda: play_by_play.get_lineup_results(df_stints),
+                                 len(df_stints), track_memory)
+        stages.append(stage)
+        _, stage = measure_stage('get_lineup_features',
+                                 lambda: play_by_play.get_lineup_features(df_results,
+                                                                          features=[('info','age'), ('per_poss','PTS'),
+                                                                                    ('advanced','BPM')],
+                                                                          aggs=['mean', 'max', 'std']),
+                                 len(df_results), track_memory)
+        stages.append(stage)
+
+        reset_pipeline_state()
+        _, stage = measure_stage('load_season',
+                                 lambda: play_by_play.load_season(season, lineups=True, possessions=True,
+                                                                  lineup_engine=lineup_engine, cache=False),
+                                 n_rows, track_memory)
+        stages.append(stage)
+        print(f"lineup miscount games: {len(play_by_play.lineup_miscounts)}")
+    finally:
+        os.chdir(cwd)
+
+    df_stages = pd.DataFrame(stages).set_index('stage')
+    print(df_stages.round(2).to_string())
+    return df_stages
+
+
+if __name__ == '__main__':
+    import sys
+    # python benchmark_pipeline.py [n_games] [lineup_engine]
+    run_benchmark(n_games=int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                  lineup_engine=sys.argv[2] if len(sys.argv) > 2 else 'vectorized')
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+
+# event type of a play, stored as its int8 code in the Event column (see play_by_play.clean_season)
+# a Kaggle play-by-play row records one event, earlier types win if a row ever fills several
+event_types = ['Other',
+               'Make2', 'Make3', 'Miss2', 'Miss3',
+               'FreeThrowMake', 'FreeThrowMiss',            # not the last of the trip (k of n, k < n) or technical
+               'FinalFreeThrowMake', 'FinalFreeThrowMiss',  # n of n, n > 1
+               'AndOneMake', 'AndOneMiss',                  # 1 of 1
+               'OffRebound', 'DefRebound',
+               'Turnover',
+               'TechnicalFoul', 'Foul',
+               'Violation', 'Timeout', 'JumpBall', 'Substitution',
+               'PeriodStart', 'PeriodEnd', 'GameEnd']
+event_codes = {event:np.int8(code) for code, event in enumerate(event_types)}
+
+MADE_SHOTS = [event_codes[event] for event in ['Make2', 'Make3']]
+MADE_FINAL_FREE_THROWS = [event_codes[event] for event in ['FinalFreeThrowMake', 'AndOneMake']]
+AND_ONES = [event_codes[event] for event in ['AndOneMake', 'AndOneMiss']]
+
+
+def str_contains(values, substring):
+    # substring test run once per distinct value instead of once per row
+    inverse, uniques = pd.factorize(pd.Series(values))
+    unique_contains = np.r_[[substring in str(value) for value in uniques], False]
+    return unique_contains[inverse]
+
+
+def classify_events(df_pbp):
+    '''
+    One pass over the event columns of a play-by-play frame
+    returns an int8 array with the event_codes of every row
+    '''
+    notnull = lambda col: df_pbp[col].notnull().values
+    equals = lambda col, value: (df_pbp[col] == value).values
+
+    # same tests add_possessions used to run on the strings: a '3' in ShotType is a three, else a '2' is a two
+    threes = str_contains(df_pbp['ShotType'].values, '3')
+    twos = str_contains(df_pbp['ShotType'].values, '2') & ~threes
+    shot_makes = equals('ShotOutcome', 'make')
+
+    free_throws = notnull('FreeThrowNum')
+    free_throw_makes = equals('FreeThrowOutcome', 'make')
+    and_ones = equals('FreeThrowNum', '1 of 1')
+    final_free_throws = df_pbp['FreeThrowNum'].isin([f"{n} of {n}" for n in range(2, 4)]).values
+
+    conditions = [(threes & shot_makes, 'Make3'), (twos & shot_makes, 'Make2'),
+                  (threes, 'Miss3'), (twos, 'Miss2'),
+                  (and_ones & free_throw_makes, 'AndOneMake'), (and_ones, 'AndOneMiss'),
+                  (final_free_throws & free_throw_makes, 'FinalFreeThrowMake'), (final_free_throws, 'FinalFreeThrowMiss'),
+                  (free_throws & free_throw_makes, 'FreeThrowMake'), (free_throws, 'FreeThrowMiss'),
+                  (equals('ReboundType', 'defensive'), 'DefRebound'), (notnull('ReboundType'), 'OffRebound'),
+                  (notnull('TurnoverType'), 'Turnover'),
+                  (equals('FoulType', 'technical'), 'TechnicalFoul'), (notnull('FoulType'), 'Foul'),
+                  (notnull('ViolationType'), 'Violation'),
+                  (notnull('TimeoutTeam'), 'Timeout'),
+                  (notnull('JumpballAwayPlayer'), 'JumpBall'),
+                  (notnull('EnterGame'), 'Substitution')]
+    events = np.select([condition for condition, event in conditions],
+                       [event_codes[event] for condition, event in conditions],
+                       default=event_codes['Other']).astype(np.int8)
+
+    # period markers only carry text, scan it on the rows nothing else claimed
+    unclaimed = np.flatnonzero(events == event_codes['Other'])
+    if 'AwayPlay' in df_pbp.columns and len(unclaimed) > 0:
+        plays = df_pbp['AwayPlay'].values[unclaimed]
+        period_ends = str_contains(plays, 'End of')
+        game_ends = period_ends & str_contains(plays, 'Game')
+        events[unclaimed[period_ends & ~game_ends]] = event_codes['PeriodEnd']
+        events[unclaimed[game_ends]] = event_codes['GameEnd']
+        events[unclaimed[str_contains(plays, 'Start of')]] = event_codes['PeriodStart']
+    return events
+
+
+def cotemporal(timestamps, condition):
+    '''
+    True for every play sharing a Timestamp with a play where condition holds
+    timestamps: one game's Timestamp values (small positive ints, see play_by_play.add_timestamps)
+    '''
+    timestamps = np.asarray(timestamps)
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=bool)
+    flagged = np.zeros(timestamps.max() + 1, dtype=bool)
+    flagged[timestamps[condition]] = True
+    return flagged[timestamps]
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+# (Season, LineupKey, Home) identifies a lineup, like the rows of get_lineup_results(..., return_lineup_matchups=False)
+lineup_id_cols = ['Season', 'LineupKey', 'Home']
+
+
+def get_possession_units(df_pbp):
+    '''
+    Splits every lineup's totals into possessions, the units the bootstrap resamples:
+    one row per (lineup, possession it was on the floor for), Off for its own possessions and not Off for the opponent's
+    Pts: points scored (Off) or allowed, Poss: 1 if the possession ended with this lineup on the floor
+    summing the units of a lineup gives back its get_lineup_results totals, units with no points and no end are dropped
+    (so are lineups with nothing but such units)
+    df_pbp: load_season(..., lineups=True, possessions=True) output (plays, not stints)
+    '''
+    if 'AwayPossEnd' not in df_pbp.columns:
+        raise ValueError("df_pbp has no possessions, load it with load_season(..., lineups=True, possessions=True)")
+    df_units = []
+    for side, other in [('Away', 'Home'), ('Home', 'Away')]:
+        for off, team in [(True, side), (False, other)]:
+            # possessions ended before this play in this game = number of the possession the play belongs to
+            df_side = pd.DataFrame({'Season': df_pbp['Season'].astype(str).values,
+                                    'URL': df_pbp['URL'].astype(str).values,
+                                    'PossNum': df_pbp[f'{team}Poss'].values - df_pbp[f'{team}PossEnd'].values,
+                                    'LineupKey': df_pbp[f'{side}LineupKey'].values,
+                                    'Lineup': df_pbp[f'{side}Lineup'].astype(str).values,
+                                    'Pts': df_pbp[f'{team}Pts'].values.astype(np.int64),
+                                    'Poss': df_pbp[f'{team}PossEnd'].values.astype(np.int64)})
+            df_side = df_side.groupby(['Season', 'URL', 'PossNum', 'LineupKey'], as_index=False, sort=False
+                                     ).agg(Lineup=('Lineup', 'first'), Pts=('Pts', 'sum'), Poss=('Poss', 'sum'))
+            df_side['Home'] = side == 'Home'
+            df_side['Off'] = off
+            df_units.append(df_side[(df_side['Pts'] != 0) | (df_side['Poss'] != 0)])
+    df_units = pd.concat(df_units, axis=0, ignore_index=True)
+    return df_units.sort_values(lineup_id_cols + ['Off'], kind='stable').reset_index(drop=True)
+
+
+def bootstrap_chunks(net_pts, poss, stratum_starts, stratum_sizes, lineup_starts, n_boot, seed, max_draws=2*10**7):
+    '''
+    n_boot bootstrap replicates of every lineup's PtsDiff_perPos at once: each unit is replaced by a random unit of
+    its stratum (the lineup's own possessions or its opponents'), then units are summed per lineup
+    replicates are drawn max_draws random indices at a time, returns (n_boot x n_lineups) float32
+    '''
+    rng = np.random.default_rng(seed)
+    n_units = len(net_pts)
+    chunk_size = max(1, int(max_draws // max(n_units, 1)))
+    replicates = np.empty((n_boot, len(lineup_starts)), dtype=np.float32)
+    for chunk_start in range(0, n_boot, chunk_size):
+        n_chunk = min(chunk_size, n_boot - chunk_start)
+        draws = stratum_starts + rng.integers(0, stratum_sizes, size=(n_chunk, n_units))
+        boot_pts = np.add.reduceat(net_pts[draws], lineup_starts, axis=1)
+        boot_poss = np.add.reduceat(poss[draws], lineup_starts, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            replicates[chunk_start:chunk_start + n_chunk] = boot_pts / boot_poss
+    return replicates
+
+
+def bootstrap_lineups(df_pbp, n_boot=1000, ci=0.95, seed=0, n_jobs=1, max_draws=2*10**7, df_units=None):
+    '''
+    Bootstrap confidence intervals and empirical Bayes shrunk ratings of every lineup's
+    PtsDiff_perPos = (PtsScored - PtsAllowed) / TotalPossessions, the rating the notebook ranks lineups by
+
+    possessions are resampled within each lineup (its own and its opponents' separately), all lineups in one
+    vectorized draw per chunk of replicates, see bootstrap_chunks
+    n_jobs: split the replicates over that many worker processes, each with its own random stream
+    df_units: get_possession_units(df_pbp) if it was already built
+
+    returns one row per (Season, LineupKey, Home): Lineup, TotalPossessions, PtsDiff_perPos, BootSE, CILow, CIHigh,
+    ShrunkPtsDiff_perPos, ShrinkWeight (see shrink_ratings), sorted by TotalPossessions
+    '''
+    if df_units is None:
+        df_units = get_possession_units(df_pbp)
+    lineup_starts = np.flatnonzero(~df_units.duplicated(lineup_id_cols).values)
+    df_lineups = df_units.iloc[lineup_starts][lineup_id_cols + ['Lineup']].reset_index(drop=True)
+
+    net_pts = np.where(df_units['Off'].values, 1, -1) * df_units['Pts'].values
+    poss = df_units['Poss'].values
+    df_lineups['PtsDiff'] = np.add.reduceat(net_pts, lineup_starts) if len(lineup_starts) > 0 else 0
+    df_lineups['TotalPossessions'] = np.add.reduceat(poss, lineup_starts) if len(lineup_starts) > 0 else 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_lineups['PtsDiff_perPos'] = df_lineups['PtsDiff'] / df_lineups['TotalPossessions']
+
+    # strata: a lineup's possessions on offense, and on defense
+    stratum_ids = df_units.groupby(lineup_id_cols + ['Off'], sort=False).ngroup().values
+    stratum_first = np.flatnonzero(np.r_[True, stratum_ids[1:] != stratum_ids[:-1]])
+    stratum_sizes = np.diff(np.r_[stratum_first, len(stratum_ids)])
+    unit_stratum_starts, unit_stratum_sizes = stratum_first[stratum_ids], stratum_sizes[stratum_ids]
+
+    seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+    boot_parts = [n_boot // n_jobs + (n < n_boot % n_jobs) for n in range(n_jobs)]
+    chunk_args = (net_pts, poss, unit_stratum_starts, unit_stratum_sizes, lineup_starts)
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            replicates = np.concatenate(list(executor.map(bootstrap_chunks, *[[arg]*n_jobs for arg in chunk_args],
+                                                          boot_parts, seeds, [max_draws]*n_jobs)), axis=0)
+    else:
+        replicates = bootstrap_chunks(*chunk_args, n_boot, seeds[0], max_draws=max_draws)
+
+    df_lineups['BootSE'] = np.nanstd(replicates, axis=0) if n_boot > 1 else np.nan
+    alpha = (1 - ci) / 2
+    df_lineups['CILow'], df_lineups['CIHigh'] = np.nanquantile(replicates, [alpha, 1 - alpha], axis=0) \
+                                                 if n_boot > 0 else (np.nan, np.nan)
+
+    df_lineups = shrink_ratings(df_lineups, df_units)
+    df_lineups = df_lineups.drop(columns='PtsDiff')
+    return df_lineups.sort_values(['TotalPossessions'], ascending=False, kind='stable').reset_index(drop=True)
+
+
+def shrink_ratings(df_lineups, df_units):
+    '''
+    Empirical Bayes (normal-normal) shrinkage of PtsDiff_perPos toward the possession weighted mean of all lineups:
+    sampling variance of a lineup = pooled per possession variance of points / TotalPossessions,
+    the spread of true ratings is what the observed spread has beyond that,
+    ShrinkWeight = prior variance / (prior variance + sampling variance)
+    adds ShrunkPtsDiff_perPos and ShrinkWeight, lineups with no possessions get the mean
+    '''
+    n_poss = df_lineups['TotalPossessions'].values.astype(float)
+    ratings = df_lineups['PtsDiff_perPos'].values.astype(float)
+    played = n_poss > 0
+    prior_mean = np.sum(ratings[played] * n_poss[played]) / n_poss[played].sum() if played.any() else np.nan
+
+    # per possession variance of points around the lineup's points per possession, on offense and on defense
+    df_strata = df_units.groupby(lineup_id_cols + ['Off'], sort=False)[['Pts', 'Poss']].transform('sum')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stratum_ppp = np.nan_to_num(df_strata['Pts'].values / df_strata['Poss'].values)
+    residuals = df_units['Pts'].values - stratum_ppp * df_units['Poss'].values
+    possession_var = np.sum(residuals**2) / max(n_poss.sum(), 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sampling_var = possession_var / n_poss
+        prior_var = max(np.sum(n_poss[played] * ((ratings[played] - prior_mean)**2 - sampling_var[played]))
+                        / n_poss[played].sum(), 0) if played.any() else 0
+        shrink_weight = np.where(played, prior_var / (prior_var + sampling_var), 0)
+    shrink_weight = np.nan_to_num(shrink_weight)
+    df_lineups['ShrunkPtsDiff_perPos'] = prior_mean + shrink_weight * (np.nan_to_num(ratings, nan=prior_mean) - prior_mean)
+    df_lineups['ShrinkWeight'] = shrink_weight
+    return df_lineups
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+# bbr_id <-> integer code, code 0 is an empty lineup slot
+player_codes = {}
+code_players = ['']
+
+LINEUP_SIZE = 5
+CODE_BITS = 12
+MAX_CODE = 2**CODE_BITS - 1
+
+
+def get_player_codes(bbr_ids):
+    codes = []
+    for bbr_id in bbr_ids:
+        if bbr_id not in player_codes:
+            if len(code_players) > MAX_CODE:
+                raise ValueError(f"more than {MAX_CODE} players, lineup keys can no longer be packed")
+            player_codes[bbr_id] = len(code_players)
+            code_players.append(bbr_id)
+        codes.append(player_codes[bbr_id])
+    return np.array(codes, dtype=np.int16)
+
+
+def encode_lineups(lineups, width=LINEUP_SIZE):
+    '''
+    Comma-joined lineup strings -> (n_rows x width) int16 array of player codes
+    Players keep their order from the string, missing slots are 0
+    '''
+    inverse, uniques = pd.factorize(pd.Series(lineups), sort=False)
+    unique_codes = np.zeros((len(uniques) + 1, width), dtype=np.int16)
+    for n, lineup in enumerate(uniques):
+        players = [p for p in lineup.split(',') if p != '']
+        if len(players) > width:
+            raise ValueError(f"lineup has {len(players)} players, more than width={width}: {lineup}")
+        unique_codes[n, :len(players)] = get_player_codes(players)
+    # factorize marks missing lineups with -1, which picks the empty last row
+    return unique_codes[inverse]
+
+
+def decode_lineups(codes):
+    '''
+    (n_rows x width) array of player codes -> array of comma-joined lineup strings
+    '''
+    players = np.array(code_players, dtype=object)
+    uniques, inverse = np.unique(codes, axis=0, return_inverse=True)
+    unique_lineups = np.array([','.join(players[row[row > 0]]) for row in uniques], dtype=object)
+    return unique_lineups[inverse.ravel()]
+
+
+def pack_lineups(codes):
+    '''
+    (n_rows x 5) array of player codes -> int64 lineup keys
+    Codes are sorted before packing, so the key does not depend on player order
+    '''
+    if codes.shape[1] > LINEUP_SIZE:
+        raise ValueError(f"can only pack lineups of up to {LINEUP_SIZE} players")
+    sorted_codes = np.sort(codes, axis=1)[:, ::-1].astype(np.int64)
+    keys = np.zeros(codes.shape[0], dtype=np.int64)
+    for slot in range(sorted_codes.shape[1]):
+        keys |= sorted_codes[:, slot] << (CODE_BITS * slot)
+    return keys
+
+
+def unpack_lineups(keys):
+    '''
+    int64 lineup keys -> (n_rows x 5) int16 array of player codes, sorted by code
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+    codes = np.zeros((keys.shape[0], LINEUP_SIZE), dtype=np.int16)
+    for slot in range(LINEUP_SIZE):
+        codes[:, LINEUP_SIZE - 1 - slot] = (keys >> (CODE_BITS * slot)) & MAX_CODE
+    return codes
+
+
+def lineup_keys(lineups):
+    '''
+    Comma-joined lineup strings -> int64 lineup keys
+    Lineups with more than 5 players (unrepaired overcounts) get a negative key hashed from their players,
+    the same in every call, so sums of separate calls can be combined
+    '''
+    lineups = pd.Series(lineups)
+    n_players = lineups.str.count(',') + 1
+    overcounts = (n_players > LINEUP_SIZE).values
+    keys = np.zeros(lineups.shape[0], dtype=np.int64)
+    keys[~overcounts] = pack_lineups(encode_lineups(lineups[~overcounts]))
+    if overcounts.any():
+        keys[overcounts] = overcount_keys(lineups[overcounts].values)
+    return keys
+
+
+def overcount_keys(lineups):
+    # players sorted like pack_lineups, the 64-bit hash folded to 63 bits below zero
+    inverse, uniques = pd.factorize(lineups)
+    sorted_lineups = np.array([','.join(sorted(lineup.split(','))) for lineup in uniques], dtype=object)
+    hashes = pd.util.hash_array(sorted_lineups) >> np.uint64(1)
+    return (-1 - hashes.astype(np.int64))[inverse]
+
+
+def lineup_players(codes):
+    '''
+    Unique bbr_ids appearing in an array of player codes
+    '''
+    return [code_players[code] for code in np.unique(codes) if code > 0]
+
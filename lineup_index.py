@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from itertools import combinations
+from lineup_codes import LINEUP_SIZE, pack_lineups, unpack_lineups, decode_lineups, player_codes
+
+
+# stats of one team's side of a lineup matchup, from that team's point of view
+index_stat_cols = ['SecElapsed', 'OffPoss', 'DefPoss', 'PtsScored', 'PtsAllowed']
+# play_by_play.lineup_stat_cols -> index_stat_cols, for the away and the home side of a matchup
+side_stat_cols = {'Away': {'SecElapsed':'SecElapsed', 'AwayPossEnd':'OffPoss', 'HomePossEnd':'DefPoss',
+                           'AwayPts':'PtsScored', 'HomePts':'PtsAllowed'},
+                  'Home': {'SecElapsed':'SecElapsed', 'HomePossEnd':'OffPoss', 'AwayPossEnd':'DefPoss',
+                           'HomePts':'PtsScored', 'AwayPts':'PtsAllowed'}}
+
+
+def build_lineup_index(df_pbp):
+    '''
+    Prebuilt index of every lineup that took the floor, for player subset queries without rescanning the season
+    df_pbp: load_season(..., lineups=True, possessions=True) output of one or several seasons, or its stint table
+
+    returns dict:
+        'matchups': one row per (Season, Team, lineup, opposing lineup) with index_stat_cols summed over its plays
+        'codes': (n_matchups x 5) int16 player codes of each matchup's lineup (lineup_codes, only valid in this process)
+        'player_rows': inverted index, player code -> sorted positions of the matchups the player was on court for
+    lineups with more than 5 players (unrepaired overcounts) are left out
+    '''
+    if 'AwayLineupKey' not in df_pbp.columns:
+        raise ValueError("df_pbp has no lineup keys, load it with load_season(..., lineups=True)")
+    stat_cols = list(side_stat_cols['Away'].keys())
+    df_matchups = df_pbp.groupby(['Season', 'AwayTeam', 'HomeTeam', 'AwayLineupKey', 'HomeLineupKey'],
+                                 as_index=False, observed=True, sort=False)[stat_cols].sum()
+
+    df_sides = []
+    for side, opponent in [('Away', 'Home'), ('Home', 'Away')]:
+        df_side = pd.DataFrame({'Season': df_matchups['Season'].astype(str).values,
+                                'Team': df_matchups[f'{side}Team'].astype(str).values,
+                                'Home': side == 'Home',
+                                'LineupKey': df_matchups[f'{side}LineupKey'].values,
+                                'OpponentKey': df_matchups[f'{opponent}LineupKey'].values})
+        for col, index_col in side_stat_cols[side].items():
+            df_side[index_col] = df_matchups[col].values.astype(np.int64)
+        df_sides.append(df_side)
+    df_matchup_sides = pd.concat(df_sides, axis=0, ignore_index=True)
+    df_matchup_sides = df_matchup_sides[df_matchup_sides['LineupKey'] >= 0].reset_index(drop=True)
+
+    codes = unpack_lineups(df_matchup_sides['LineupKey'].values)
+    # inverted index: sort every filled slot by player code, each player's matchups are one contiguous run
+    slot_rows = np.repeat(np.arange(codes.shape[0]), LINEUP_SIZE)
+    slot_codes = codes.ravel()
+    filled = slot_codes > 0
+    order = np.argsort(slot_codes[filled], kind='stable')
+    sorted_codes, sorted_rows = slot_codes[filled][order], slot_rows[filled][order]
+    run_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    player_rows = {code:rows for code, rows in zip(sorted_codes[run_starts], np.split(sorted_rows, run_starts[1:]))}
+
+    return {'matchups': df_matchup_sides, 'codes': codes, 'player_rows': player_rows}
+
+
+def get_matchup_rows(lineup_index, bbr_ids, season=None, team=None):
+    '''
+    Positions in lineup_index['matchups'] of every matchup with all of bbr_ids on court
+    season/team: only matchups of that season ('2015-16') / team ('GSW')
+    '''
+    if isinstance(bbr_ids, str):
+        bbr_ids = [bbr_ids]
+    player_lists = [lineup_index['player_rows'].get(player_codes.get(bbr_id, -1), np.zeros(0, dtype=np.int64))
+                    for bbr_id in bbr_ids]
+    # intersect starting from the player with the fewest matchups
+    player_lists = sorted(player_lists, key=len)
+    rows = player_lists[0]
+    for other_rows in player_lists[1:]:
+        rows = np.intersect1d(rows, other_rows, assume_unique=True)
+    return filter_matchup_rows(lineup_index, rows, season=season, team=team)
+
+
+def filter_matchup_rows(lineup_index, rows, season=None, team=None):
+    df_matchup_sides = lineup_index['matchups']
+    if season is not None:
+        rows = rows[df_matchup_sides['Season'].values[rows] == season]
+    if team is not None:
+        rows = rows[df_matchup_sides['Team'].values[rows] == team]
+    return rows
+
+
+def add_ppp_cols(df_results, prefix=''):
+    # per possession columns of summed index_stat_cols, same names as summarize_lineup_results
+    # prefix: of the sums and the added columns, e.g. 'Cum' and 'Roll' in lineup_trends
+    df_results[f'{prefix}OffPPP'] = df_results[f'{prefix}PtsScored'] / df_results[f'{prefix}OffPoss']
+    df_results[f'{prefix}DefPPP'] = df_results[f'{prefix}PtsAllowed'] / df_results[f'{prefix}DefPoss']
+    df_results[f'{prefix}NetPPP'] = df_results[f'{prefix}OffPPP'] - df_results[f'{prefix}DefPPP']
+    df_results[f'{prefix}TotalPossessions'] = df_results[f'{prefix}OffPoss'] + df_results[f'{prefix}DefPoss']
+    return df_results
+
+
+def query_lineups(lineup_index, bbr_ids, season=None, team=None):
+    '''
+    Seconds, possessions and points of every lineup that had all of bbr_ids (any 1 to 5 players) on court
+    e.g. query_lineups(lineup_index, ['curryst01', 'greendr01'], season='2015-16')
+    returns a Series of index_stat_cols + OffPPP, DefPPP, NetPPP, TotalPossessions
+    '''
+    rows = get_matchup_rows(lineup_index, bbr_ids, season=season, team=team)
+    totals = lineup_index['matchups'][index_stat_cols].values[rows].sum(axis=0)
+    df_totals = add_ppp_cols(pd.DataFrame([totals], columns=index_stat_cols).astype(float))
+    df_totals['Matchups'] = len(rows)
+    return df_totals.iloc[0]
+
+
+def get_on_off(lineup_index, bbr_ids, season=None, team=None):
+    '''
+    On/off split of bbr_ids for every team they shared the floor for (or just team):
+    On sums the matchups with all of bbr_ids on court, Off the rest of that team's matchups
+    returns one row per Season, Team and On
+    '''
+    df_matchup_sides = lineup_index['matchups']
+    on_rows = get_matchup_rows(lineup_index, bbr_ids, season=season, team=team)
+    on = np.zeros(df_matchup_sides.shape[0], dtype=bool)
+    on[on_rows] = True
+
+    team_seasons = df_matchup_sides.iloc[on_rows][['Season', 'Team']].drop_duplicates()
+    in_teams = pd.MultiIndex.from_frame(df_matchup_sides[['Season', 'Team']]).isin(pd.MultiIndex.from_frame(team_seasons))
+    df_split = df_matchup_sides.loc[in_teams, ['Season', 'Team'] + index_stat_cols].copy()
+    df_split['On'] = on[in_teams]
+    df_on_off = df_split.groupby(['Season', 'Team', 'On'], as_index=False)[index_stat_cols].sum()
+    df_on_off = df_on_off.sort_values(['Season', 'Team', 'On'], ascending=[True, True, False]).reset_index(drop=True)
+    return add_ppp_cols(df_on_off)
+
+
+def get_combo_results(lineup_index, size=2, season=None, team=None, min_possessions=0):
+    '''
+    Batch query: every size (2, 3 or 4) player combination that shared the floor, in one pass over the matchups
+    each 5-man lineup adds its stats to all of its 10 pairs / 10 trios / 5 quartets
+    e.g. get_combo_results(lineup_index, size=3, season='2015-16', team='GSW')
+    returns one row per Season, Team and combination (Lineup string, LineupKey), sorted by TotalPossessions
+    '''
+    if not 1 <= size < LINEUP_SIZE:
+        raise ValueError(f"size must be between 1 and {LINEUP_SIZE - 1}, use get_lineup_results for 5-man lineups")
+    df_matchup_sides = lineup_index['matchups']
+    rows = filter_matchup_rows(lineup_index, np.arange(df_matchup_sides.shape[0]), season=season, team=team)
+    codes = lineup_index['codes'][rows]
+    stats = df_matchup_sides[index_stat_cols].values[rows]
+
+    combo_cols = np.array(list(combinations(range(LINEUP_SIZE), size)))
+    # (n_matchups * n_combos x size) player codes, combos touching an empty slot are dropped
+    combo_codes = codes[:, combo_cols].reshape(-1, size)
+    combo_rows = np.repeat(np.arange(len(rows)), len(combo_cols))
+    filled = (combo_codes > 0).all(axis=1)
+    combo_codes, combo_rows = combo_codes[filled], combo_rows[filled]
+
+    df_combos = pd.DataFrame(stats[combo_rows], columns=index_stat_cols)
+    df_combos.insert(0, 'Season', df_matchup_sides['Season'].values[rows][combo_rows])
+    df_combos.insert(1, 'Team', df_matchup_sides['Team'].values[rows][combo_rows])
+    df_combos.insert(2, 'LineupKey', pack_lineups(combo_codes))
+    df_combo_results = df_combos.groupby(['Season', 'Team', 'LineupKey'], as_index=False, sort=False)[index_stat_cols].sum()
+    df_combo_results.insert(2, 'Lineup', decode_lineups(unpack_lineups(df_combo_results['LineupKey'].values)))
+
+    df_combo_results = add_ppp_cols(df_combo_results)
+    df_combo_results = df_combo_results[df_combo_results['TotalPossessions'] >= min_possessions]
+    return df_combo_results.sort_values(['TotalPossessions', 'SecElapsed'], ascending=False).reset_index(drop=True)
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import play_by_play
+from lineup_index import index_stat_cols, side_stat_cols, add_ppp_cols
+
+
+def new_lineup_trends(window=10):
+    '''
+    Running state of update_lineup_trends, fed one season's (or any chronological batch's) stint table at a time
+    window: an int for the last window games of the lineup's team, or a pd.Timedelta / '30D' string for a date window
+
+    'totals': cumulative index_stat_cols per (Team, LineupKey) over every batch so far
+    'team_games': number of games seen per team
+    'recent': lineup-game rows still inside their team's window, the only rows carried into the next batch
+    '''
+    if not isinstance(window, (int, np.integer)):
+        window = pd.Timedelta(window)
+    return {'window': window, 'totals': None, 'team_games': pd.Series(dtype=np.int64), 'recent': None}
+
+
+def get_lineup_games(df_stints):
+    '''
+    Stint table -> one row per (game, team, lineup) with index_stat_cols from that team's point of view
+    lineups with more than 5 players (unrepaired overcounts) are left out
+    '''
+    df_sides = []
+    for side in ['Away', 'Home']:
+        df_side = pd.DataFrame({'Season': df_stints['Season'].astype(str).values,
+                                'Date': pd.to_datetime(df_stints['Date'].values),
+                                'URL': df_stints['URL'].astype(str).values,
+                                'Team': df_stints[f'{side}Team'].astype(str).values,
+                                'Lineup': df_stints[f'{side}Lineup'].astype(str).values,
+                                'LineupKey': df_stints[f'{side}LineupKey'].values})
+        for col, index_col in side_stat_cols[side].items():
+            df_side[index_col] = df_stints[col].values.astype(np.int64)
+        df_sides.append(df_side[df_side['LineupKey'] >= 0])
+    return pd.concat(df_sides, axis=0, ignore_index=True
+                    ).groupby(['Season', 'Date', 'URL', 'Team', 'LineupKey'], as_index=False, sort=False
+                    ).agg(Lineup=('Lineup', 'first'), **{col:(col, 'sum') for col in index_stat_cols})
+
+
+def update_lineup_trends(trends, df_stints):
+    '''
+    Folds the next batch of stints (get_stints / load_season(..., stints=True), later games than every earlier batch)
+    into trends, returns the batch's lineup-game rows with
+        TeamGame: the team's game number over all batches so far
+        Cum{stat}: the lineup's totals over all batches up to and including this game
+        Roll{stat}: the lineup's totals over the window ending at this game
+    plus OffPPP/DefPPP/NetPPP/TotalPossessions of both (add_ppp_cols), only the rows inside the window carry over to the next batch
+    '''
+    cum_cols = [f'Cum{col}' for col in index_stat_cols]
+    roll_cols = [f'Roll{col}' for col in index_stat_cols]
+    group_keys = ['Team', 'LineupKey']
+    df_games = get_lineup_games(df_stints)
+
+    # number each team's games in date order, continuing from the previous batch
+    df_team_games = df_games[['Team', 'Date', 'URL']].drop_duplicates().sort_values(['Date', 'URL'])
+    df_team_games['TeamGame'] = df_team_games.groupby('Team').cumcount().values + 1 \
+                                + trends['team_games'].reindex(df_team_games['Team'].values).fillna(0).values.astype(np.int64)
+    df_games = df_games.merge(df_team_games, on=['Team', 'Date', 'URL'], how='left')
+    if isinstance(trends['window'], pd.Timedelta):
+        df_games['Clock'] = df_games['Date'].values.astype('datetime64[D]').astype(np.int64)
+        window = trends['window'].days
+    else:
+        df_games['Clock'] = df_games['TeamGame'].values
+        window = trends['window']
+    df_games = df_games.sort_values(group_keys + ['Clock'], kind='stable').reset_index(drop=True)
+
+    # cumulative sums, on top of each lineup's totals from the earlier batches
+    df_cum = df_games.groupby(group_keys, sort=False)[index_stat_cols].cumsum()
+    if trends['totals'] is not None:
+        df_cum = df_cum + trends['totals'].reindex(pd.MultiIndex.from_frame(df_games[group_keys])).fillna(0).values
+    df_games[cum_cols] = df_cum.values.astype(np.int64)
+    df_games['New'] = True
+
+    # window sums: cumulative at this game minus cumulative at the lineup's last game at or before clock - window
+    df_all = df_games if trends['recent'] is None else pd.concat([trends['recent'], df_games], axis=0, ignore_index=True)
+    df_all = df_all.sort_values(group_keys + ['Clock'], kind='stable').reset_index(drop=True)
+    group_ids = df_all.groupby(group_keys, sort=False).ngroup().values.astype(np.int64)
+    clock = df_all['Clock'].values.astype(np.int64)
+    clock = clock - (clock.min() if len(clock) > 0 else 0) + window
+    # (group, clock) packed into one sorted int64, so one searchsorted finds every row's window start
+    composite = group_ids * (clock.max(initial=0) + 1) + clock
+    group_starts = np.searchsorted(group_ids, group_ids, side='left')
+    before_window = np.searchsorted(composite, composite - window, side='right') - 1
+    cum = df_all[cum_cols].values
+    # no game of the lineup at or before clock - window in view: everything before its first game in view is outside
+    base = np.where((before_window >= group_starts)[:, None],
+                    cum[np.maximum(before_window, 0)],
+                    cum[group_starts] - df_all[index_stat_cols].values[group_starts])
+    df_all[roll_cols] = cum - base
+
+    # carry the totals, team clocks and the rows still inside a window into the next batch
+    df_totals = df_games.groupby(group_keys, sort=False).tail(1).set_index(group_keys)[cum_cols].set_axis(index_stat_cols, axis=1)
+    trends['totals'] = df_totals if trends['totals'] is None else df_totals.combine_first(trends['totals'])
+    trends['team_games'] = df_games.groupby('Team')['TeamGame'].max().combine_first(trends['team_games']).astype(np.int64)
+    team_clock = df_all.groupby('Team')['Clock'].transform('max').values
+    trends['recent'] = df_all.loc[df_all['Clock'].values > team_clock - window].assign(New=False)
+
+    df_new = df_all[df_all['New'].values].drop(columns=['Clock', 'New'])
+    df_new = df_new.sort_values(['Date', 'URL', 'Team'], kind='stable').reset_index(drop=True)
+    return add_ppp_cols(add_ppp_cols(df_new, 'Cum'), 'Roll')
+
+
+def stream_lineup_trends(seasons, window=10, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', cache=True, n_jobs=1):
+    '''
+    update_lineup_trends over seasons in order, each season loaded straight to its stint table
+    (load_season(..., stints=True)) so no two seasons of plays are ever held at once
+    returns every season's lineup-game rows, see update_lineup_trends
+    '''
+    trends = new_lineup_trends(window=window)
+    df_trends_list = []
+    for season in seasons:
+        df_stints = play_by_play.load_season(season, lineups=True, possessions=True,
+                                             drop_lineup_miscount_games=drop_lineup_miscount_games,
+                                             drop_neg_scoring_error_games=drop_neg_scoring_error_games,
+                                             lineup_engine=lineup_engine, cache=cache, n_jobs=n_jobs, stints=True)
+        df_trends_list.append(update_lineup_trends(trends, df_stints))
+    return pd.concat(df_trends_list, axis=0, ignore_index=True)
+
+
+def get_lineup_range_results(df_trends, start=None, end=None):
+    '''
+    Lineup totals between two dates (inclusive, None for open) from the lineup-game rows of stream_lineup_trends
+    returns one row per Team and lineup with index_stat_cols, OffPPP, DefPPP, NetPPP, TotalPossessions, sorted by TotalPossessions
+    '''
+    in_range = np.ones(len(df_trends), dtype=bool)
+    if start is not None:
+        in_range &= (df_trends['Date'] >= pd.Timestamp(start)).values
+    if end is not None:
+        in_range &= (df_trends['Date'] <= pd.Timestamp(end)).values
+    df_range = df_trends[in_range].groupby(['Team', 'LineupKey'], as_index=False, sort=False
+                                          ).agg(Lineup=('Lineup', 'first'), Games=('URL', 'nunique'),
+                                                **{col:(col, 'sum') for col in index_stat_cols})
+    df_range = add_ppp_cols(df_range)
+    return df_range.sort_values(['TotalPossessions', 'SecElapsed'], ascending=False).reset_index(drop=True)
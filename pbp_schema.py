@@ -0,0 +1,67 @@
+import pandas as pd
+import numpy as np
+
+
+# declared dtypes of the processed play-by-play frame (load_season output), see compact_pbp
+# player id columns share one categorical, so a bbr_id is stored once whichever column it shows up in
+player_id_cols = ['Shooter', 'Assister', 'Blocker', 'Fouler', 'Fouled', 'Rebounder', 'ViolationPlayer',
+                  'FreeThrowShooter', 'EnterGame','LeaveGame','TurnoverPlayer','TurnoverCauser',
+                  'JumpballAwayPlayer','JumpballHomePlayer','JumpballPoss']
+# one category per distinct value
+category_cols = ['URL', 'GameType', 'Location', 'Season', 'WinningTeam', 'AwayTeam', 'HomeTeam',
+                 'ShotType', 'ShotOutcome', 'FoulType', 'ReboundType', 'ViolationType', 'TimeoutTeam',
+                 'FreeThrowOutcome', 'FreeThrowNum', 'TurnoverType', 'TurnoverCause',
+                 'AwayLineup', 'HomeLineup']
+# free text, every flag add_possessions needs has been derived from it by the time a season is compacted
+play_text_cols = ['AwayPlay', 'HomePlay']
+# lineup keys stay int64, see lineup_codes.pack_lineups
+int64_cols = ['AwayLineupKey', 'HomeLineupKey']
+
+
+def compact_pbp(df_pbp, drop_play_text=False):
+    '''
+    Copy of a processed play-by-play frame with the declared dtypes:
+    player ids -> one shared categorical, enumerations/lineups -> categoricals,
+    integers -> the narrowest int that holds them, floats -> float32
+    drop_play_text: also drop AwayPlay/HomePlay
+    '''
+    df_ = df_pbp.copy()
+    present_cols = lambda cols: [col for col in cols if col in df_.columns]
+
+    player_ids = pd.unique(df_[present_cols(player_id_cols)].values.ravel())
+    player_dtype = pd.CategoricalDtype(sorted(p for p in player_ids if pd.notnull(p)))
+    for col in present_cols(player_id_cols):
+        df_[col] = df_[col].astype(player_dtype)
+
+    for col in present_cols(category_cols):
+        df_[col] = df_[col].astype('category')
+
+    for col in df_.columns:
+        if col in int64_cols:
+            continue
+        if pd.api.types.is_integer_dtype(df_[col].dtype):
+            df_[col] = pd.to_numeric(df_[col], downcast='integer')
+        elif pd.api.types.is_float_dtype(df_[col].dtype):
+            df_[col] = df_[col].astype(np.float32)
+
+    if drop_play_text:
+        df_ = df_.drop(columns=present_cols(play_text_cols))
+    return df_
+
+
+def memory_report(df_before, df_after, n_cols=10):
+    '''
+    Prints bytes per row of both frames and the n_cols columns that shrank the most
+    returns per column bytes of both as a DataFrame
+    '''
+    df_bytes = pd.DataFrame({'before': df_before.memory_usage(index=False, deep=True),
+                             'after': df_after.memory_usage(index=False, deep=True)})
+    df_bytes['saved'] = df_bytes['before'] - df_bytes['after'].fillna(0)
+    df_bytes = df_bytes.sort_values('saved', ascending=False)
+
+    before_per_row = df_bytes['before'].sum() / max(len(df_before), 1)
+    after_per_row = df_bytes['after'].sum() / max(len(df_after), 1)
+    print(f"{before_per_row:.0f} -> {after_per_row:.0f} bytes per row ({before_per_row / after_per_row:.1f}x smaller), "
+          f"{df_bytes['before'].sum() / 2**20:.1f} -> {df_bytes['after'].sum() / 2**20:.1f} MiB")
+    print(df_bytes.head(n_cols).to_string())
+    return df_bytes
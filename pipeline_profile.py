@@ -0,0 +1,166 @@
+import contextlib
+import json
+import logging
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # no resource module on Windows, stages then go without max_rss_MiB
+    resource = None
+
+
+# loggers of the pipeline modules, see get_logger/set_log_level
+pipeline_loggers = {}
+# level of every pipeline logger, including the ones of modules imported after set_log_level
+log_level = logging.INFO
+# the profile that stage()/record_game()/record_event() write to, None when nothing is being profiled
+active_profile = None
+
+
+class StdoutHandler(logging.StreamHandler):
+    # writes to whatever sys.stdout is when a message is logged, so contextlib.redirect_stdout catches it like a print
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, stream):
+        pass
+
+
+def get_logger(name):
+    '''
+    Logger of a pipeline module, printing its messages to stdout like the print calls it replaces
+    silence the pipeline with set_log_level(logging.WARNING), or get per game progress with set_log_level(logging.DEBUG)
+    '''
+    if name not in pipeline_loggers:
+        logger = logging.getLogger(name)
+        if not logger.handlers:
+            handler = StdoutHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.propagate = False
+        logger.setLevel(log_level)
+        pipeline_loggers[name] = logger
+    return pipeline_loggers[name]
+
+
+def set_log_level(level):
+    global log_level
+    log_level = level
+    for logger in pipeline_loggers.values():
+        logger.setLevel(level)
+
+
+def get_max_rss_mib():
+    if resource is None:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+@contextlib.contextmanager
+def profile(track_memory=False, on_stage=None):
+    '''
+    Records every pipeline stage run inside the with block:
+        with pipeline_profile.profile() as prof:
+            df = play_by_play.load_season(16, lineups=True, possessions=True)
+        pipeline_profile.save_profile(prof, 'profile_2015-16.json')
+
+    prof['stages']: one dict per stage (stage, depth, seconds, rows, max_rss_MiB, ...), nested stages follow their parent
+    prof['games']: per game seconds of the stages that run game by game, see slowest_games
+    prof['events']: games that needed a boxscore, cache hits, ...
+    track_memory: also trace python allocations (tracemalloc, slows the pipeline down) for each stage's
+                  memory_delta_MiB and peak_MiB
+    on_stage: called with each stage's record as soon as the stage ends
+    '''
+    global active_profile
+    prof = {'stages': [], 'games': [], 'events': [], 'track_memory': track_memory, 'on_stage': on_stage, 'depth': 0}
+    previous_profile, active_profile = active_profile, prof
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield prof
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        active_profile = previous_profile
+
+
+@contextlib.contextmanager
+def stage(name, **details):
+    '''
+    Times the with block as one stage of the active profile, the yielded record takes extra fields (e.g. rows)
+    does nothing but yield a throwaway dict when no profile is active
+    '''
+    prof = active_profile
+    record = dict(stage=name, **details)
+    if prof is None:
+        yield record
+        return
+
+    record['depth'] = prof['depth']
+    prof['stages'].append(record)
+    prof['depth'] += 1
+    tracing = prof['track_memory'] and tracemalloc.is_tracing()
+    if tracing:
+        memory_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        prof['depth'] -= 1
+        record['seconds'] = time.perf_counter() - start
+        record['max_rss_MiB'] = get_max_rss_mib()
+        if tracing:
+            memory_after, memory_peak = tracemalloc.get_traced_memory()
+            record['memory_delta_MiB'] = (memory_after - memory_before) / 2**20
+            record['peak_MiB'] = memory_peak / 2**20
+        if prof['on_stage'] is not None:
+            prof['on_stage'](record)
+
+
+def per_game(fn, stage_name):
+    '''
+    fn for df.groupby('URL').apply(...), wrapped to record each game's seconds when a profile is active
+    '''
+    def timed_fn(df_game, *args, **kwargs):
+        if active_profile is None:
+            return fn(df_game, *args, **kwargs)
+        start = time.perf_counter()
+        result = fn(df_game, *args, **kwargs)
+        record_game(df_game['URL'].values[0], stage_name, time.perf_counter() - start, rows=len(df_game))
+        return result
+    return timed_fn
+
+
+def record_game(url, stage_name, seconds, **details):
+    if active_profile is not None:
+        active_profile['games'].append(dict(URL=url, stage=stage_name, seconds=seconds, **details))
+
+
+def record_event(event, **details):
+    if active_profile is not None:
+        active_profile['events'].append(dict(event=event, **details))
+
+
+def slowest_games(prof, n=10, stage_name=None):
+    games = [game for game in prof['games'] if (stage_name is None) or (game['stage'] == stage_name)]
+    return sorted(games, key=lambda game: game['seconds'], reverse=True)[:n]
+
+
+def profile_summary(prof, n_games=10):
+    # what save_profile writes
+    return {'stages': prof['stages'],
+            'slowest_games': slowest_games(prof, n_games),
+            'boxscore_games': sorted({event['URL'] for event in prof['events'] if event['event'] == 'boxscore'}),
+            'events': prof['events']}
+
+
+def save_profile(prof, path, n_games=10):
+    with open(path, 'w') as f:
+        json.dump(profile_summary(prof, n_games), f, indent=1, default=str)
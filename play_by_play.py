@@ -2,89 +2,532 @@ import pandas as pd
 import numpy as np
 import os
 import time
-from BBRscrape_players import scrape_players
-from BBRscrape_boxscores import scrape_boxscore
+import warnings
+import hashlib
+import re
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import BBRscrape_players
+from BBRscrape_players import scrape_player, scrape_players
+from BBRscrape_boxscores import scrape_boxscore, scrape_boxscores
+from lineup_codes import encode_lineups, lineup_keys, lineup_players, player_codes, code_players
+from event_codes import classify_events, cotemporal, event_codes, event_types, MADE_SHOTS, MADE_FINAL_FREE_THROWS, AND_ONES
+import season_cache
+import player_store
+import pbp_schema
+import pipeline_profile
 
 
 
 player_cols = ['Shooter', 'Assister', 'Blocker', 'Fouler', 'Fouled', 'Rebounder', 'ViolationPlayer', 'FreeThrowShooter', 'EnterGame','LeaveGame','TurnoverPlayer','TurnoverCauser','JumpballAwayPlayer','JumpballHomePlayer','JumpballPoss']
+# dtypes for reading PBP_data files, see read_season_chunks
+pbp_csv_dtypes = {**{col:'category' for col in ['GameType','Location','WinningTeam','AwayTeam','HomeTeam']},
+                  **{col:object for col in ['URL','Date','Time','AwayPlay','HomePlay','ShotType','ShotOutcome',
+                                            'FoulType','ReboundType','ViolationType','TimeoutTeam',
+                                            'FreeThrowOutcome','FreeThrowNum','TurnoverType','TurnoverCause'] + player_cols},
+                  'Quarter':'int8', 'SecLeft':'int16', 'AwayScore':'int16', 'HomeScore':'int16', 'ShotDist':'float32'}
+# silence with pipeline_profile.set_log_level(logging.WARNING)
+logger = pipeline_profile.get_logger(__name__)
 players_dict={}
 lineup_miscounts = {}
-
-def load_seasons(seasons, lineups=False, possessions=False, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True):
+# season -> (games taken out, games put in) by the last load_season(incremental=True), see update_lineup_results
+season_updates = {}
+player_dfs_to_load = ['adj_shooting','advanced','all_salaries', 'info',\
+                      'pbp','per_minute','per_poss','shooting','totals']
+# (table_name, col_name) -> (bbr_ids included, attribute values), see get_player_attr_table
+player_attr_tables = {}
+# (bbr_ids included, rows of Player, Season, Team, From, To), see get_roster_index
+roster_index = (set(), None)
+# column dtypes of the possession table, see get_possessions
+possession_dtypes = {**{col:'category' for col in ['Season', 'URL', 'OffTeam', 'DefTeam', 'OffLineup', 'DefLineup']},
+                     'PossNum':'int16', 'Quarter':'int8', 'StartSec':'int16', 'EndSec':'int16', 'OffPts':'int8', 'DefPts':'int8',
+                     'EndEvent': pd.CategoricalDtype(event_types)}
+# play columns summed per lineup matchup by get_lineup_results
+lineup_stat_cols = ['SecElapsed','AwayPossEnd','HomePossEnd', 'AwayPts', 'HomePts']
+# get_lineup_features agg -> (column name, reduction over the 5 lineup slots)
+lineup_aggs = {'mean': ('Mean', np.nanmean),
+               'median': ('Med', np.nanmedian),
+               'min': ('Min', np.nanmin),
+               'max': ('Max', np.nanmax),
+               'range': ('Range', lambda values, axis: np.nanmax(values, axis=axis) - np.nanmin(values, axis=axis)),
+               'std': ('Std', np.nanstd)}
+
+def load_seasons(seasons, lineups=False, possessions=False, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', cache=True, n_jobs=1, incremental=False, compact=False, drop_play_text=False, stints=False):
     df_list = []
     for season in seasons:
-        df_list.append(load_season(season, lineups=lineups, possessions=possessions, drop_lineup_miscount_games=drop_lineup_miscount_games))
+        df_list.append(load_season(season, lineups=lineups, possessions=possessions, drop_lineup_miscount_games=drop_lineup_miscount_games, lineup_engine=lineup_engine, cache=cache, n_jobs=n_jobs, incremental=incremental, compact=compact, drop_play_text=drop_play_text, stints=stints))
     return pd.concat(df_list, axis=0), players_dict
 
 
-def load_season(season, lineups=False, possessions=False, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True):
-    #lineup_miscounts = {}
-    
+def get_season_name(season):
     if isinstance(season, int):
         season = str(season)
     if len(season) == 2:
         season = '20'+season
     if len(season) == 4:
         season = f"{season[:2]}{int(season[2:4])-1}-{season[2:4]}"
-        
-    df_ = pd.read_csv(f'PBP_data/NBA_PBP_{season}.csv')
-    
-    df_['Date'] = pd.to_datetime(df_['Date']+ ' '+ df_['Time'])
-    df_ = df_.rename(columns={'Time':'Season'})
-    df_['Season'] = season
-    
-    # keep only bbr_id in play-identification columns
-    df_.loc[:,player_cols] = df_[player_cols].apply(lambda x: x.str.split('-').str[-1].str.strip())
-    # Replace coach (id ends with 'c') technical fouls with Team
-    df_.loc[df_['Fouler'].str[-1] == 'c', 'Fouler'] = 'Team'
-    
-    df_.loc[df_['Fouled'] == 'NULL', 'Fouled'] = np.nan
+    return season
+
+
+def load_season(season, lineups=False, possessions=False, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', cache=True, n_jobs=1, incremental=False, compact=False, drop_play_text=False, stints=False):
+    '''
+    lineup_engine can be ('vectorized', 'legacy'), both give the same lineups and lineup_miscounts
+    'legacy' runs add_lineup_cols game by game, 'vectorized' runs add_lineup_cols_vectorized on the whole season
+
+    cache: reuse/save the output of each pipeline stage in season_cache.cache_dir (needs pyarrow)
+    entries are keyed by season, the stages run, the play-by-play file hash and the pipeline code version
+
+    n_jobs: number of worker processes for the lineups and possessions stages, games are sharded across them
+    players are loaded once up front and shipped to the workers with their shard
+
+    incremental: when the play-by-play file changed since the last cached run of these stages, only the games that are
+    new or changed (by per game content hash) are run through the pipeline and merged into the cached season
+    the games taken out and put in are kept in season_updates[season], see update_lineup_results
+
+    compact: hand back the season with the declared dtypes of pbp_schema (categoricals, narrow ints), see pbp_schema.compact_pbp
+    drop_play_text: with compact, also drop the AwayPlay/HomePlay text
+
+    stints: hand back the stint table of the season (get_stints, needs lineups and possessions) instead of its plays,
+    season_updates[season] then holds stints too
+
+    every stage is timed when run inside pipeline_profile.profile(), see pipeline_profile
+    '''
+    #lineup_miscounts = {}
     
-    # For consistency of Play team was fouled
-    df_.loc[df_['FoulType'].isin(['loose ball','offensive', 'technical'])
-            , ['AwayPlay', 'HomePlay']
-           ] = df_.loc[df_['FoulType'].isin(['loose ball','offensive', 'technical'])
-                       , ['HomePlay', 'AwayPlay']
-                      ].values  
+    season = get_season_name(season)
+    source_path = f'PBP_data/NBA_PBP_{season}.csv'
+    stages = ['timestamps'] + ['lineups']*lineups + ['possessions']*possessions
+    if stints and not (lineups and possessions):
+        raise ValueError("stints need lineups=True and possessions=True")
+
+    with pipeline_profile.stage('load_season', season=season, stages=stages) as record:
+        if incremental and cache:
+            df_, df_old_games, df_new_games, old_miscounts = update_season(season, source_path, stages, 
+                                                                           lineup_engine=lineup_engine, n_jobs=n_jobs)
+            season_updates[season] = (drop_bad_games(df_old_games, drop_lineup_miscount_games, drop_neg_scoring_error_games, old_miscounts),
+                                      drop_bad_games(df_new_games, drop_lineup_miscount_games, drop_neg_scoring_error_games, lineup_miscounts))
+        else:
+            df_ = process_season(season, source_path, stages, lineup_engine=lineup_engine, cache=cache, n_jobs=n_jobs)
+
+        df_ = drop_bad_games(df_, drop_lineup_miscount_games, drop_neg_scoring_error_games, lineup_miscounts)
+        logger.info(f"Neg Scoring Error Games: {list(df_.loc[(df_['HomePts'] < 0) | (df_['AwayPts'] < 0), 'URL'].value_counts().index)}")
+        logger.info(f"Lineup Miscount Games: {lineup_miscounts}")
+        if stints:
+            with pipeline_profile.stage('stints', plays=len(df_)) as stints_record:
+                df_ = get_stints(df_)
+                if incremental and cache:
+                    season_updates[season] = tuple(get_stints(df_games) for df_games in season_updates[season])
+                stints_record['rows'] = len(df_)
+        if compact:
+            with pipeline_profile.stage('compact') as compact_record:
+                df_ = pbp_schema.compact_pbp(df_, drop_play_text=drop_play_text)
+                compact_record['rows'] = len(df_)
+        record['rows'] = len(df_)
+    return df_
+
+
+def load_possessions(season, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', cache=True, n_jobs=1):
+    '''
+    Possession table of a season (get_possessions), built from load_season(..., lineups=True, possessions=True)
+    cache: the table itself is cached as one more stage after possessions, so a cache hit never touches the plays
+    '''
+    season = get_season_name(season)
+    source_path = f'PBP_data/NBA_PBP_{season}.csv'
+    stages = ['timestamps', 'lineups', 'possessions', 'possession_table']
+    options = {'drop_lineup_miscount_games': drop_lineup_miscount_games,
+               'drop_neg_scoring_error_games': drop_neg_scoring_error_games}
+
+    with pipeline_profile.stage('load_possessions', season=season) as record:
+        df_poss = None
+        if cache:
+            df_poss, meta = season_cache.load_stage(source_path, season, stages, options)
+            if df_poss is not None:
+                logger.info(f"Loaded {season} possession table from cache")
+                lineup_miscounts.update(meta.get('lineup_miscounts', {}))
+                for col in ['OffLineup', 'DefLineup']:
+                    df_poss[f'{col}Key'] = lineup_keys(df_poss[col])
+                df_poss = df_poss.astype(possession_dtypes)
+
+        if df_poss is None:
+            df_pbp = load_season(season, lineups=True, possessions=True,
+                                 drop_lineup_miscount_games=drop_lineup_miscount_games,
+                                 drop_neg_scoring_error_games=drop_neg_scoring_error_games,
+                                 lineup_engine=lineup_engine, cache=cache, n_jobs=n_jobs)
+            df_poss = get_possessions(df_pbp)
+            if cache:
+                season_games = set(df_poss['URL'])
+                meta = {'lineup_miscounts': {k:int(v) for k, v in lineup_miscounts.items() if k in season_games}}
+                with pipeline_profile.stage('save_cache', stages=stages, rows=len(df_poss)):
+                    season_cache.save_stage(df_poss.drop(columns=['OffLineupKey', 'DefLineupKey']),
+                                            source_path, season, stages, options=options, meta=meta)
+        record['rows'] = len(df_poss)
+    return df_poss
+
+
+def process_season(season, source_path, stages, lineup_engine='vectorized', cache=True, n_jobs=1):
+    # start from the deepest cached stage
+    df_, done, game_hashes = None, 0, None
+    if cache:
+        with pipeline_profile.stage('load_cache') as record:
+            for n_stages in range(len(stages), 0, -1):
+                df_, meta = season_cache.load_stage(source_path, season, stages[:n_stages])
+                if df_ is not None:
+                    lineup_miscounts.update(meta.get('lineup_miscounts', {}))
+                    game_hashes = meta.get('game_hashes')
+                    # player codes are local to this process, so lineup keys are rebuilt rather than cached
+                    if 'AwayLineup' in df_.columns:
+                        df_ = add_lineup_keys(df_)
+                    done = n_stages
+                    logger.info(f"Loaded {season} {'-'.join(stages[:n_stages])} from cache")
+                    record.update(stages=stages[:n_stages], rows=len(df_))
+                    break
+
+    for n_stages in range(done+1, len(stages)+1):
+        stage = stages[n_stages-1]
+        if stage == 'timestamps':
+            df_raw = read_season_csv(season)
+            game_hashes = get_game_hashes(df_raw)
+            df_ = clean_season(df_raw, season)
+        else:
+            df_ = run_stage(df_, stage, lineup_engine=lineup_engine, n_jobs=n_jobs)
+        if cache:
+            save_season_stage(df_, source_path, season, stages[:n_stages], game_hashes)
+    return df_
+
+
+def update_season(season, source_path, stages, lineup_engine='vectorized', n_jobs=1):
+    '''
+    Incremental process_season: diffs the per game hashes of the play-by-play file against the latest cached run
+    of these stages, and only runs the new or changed games through the pipeline
+
+    returns the merged season, the cached rows of the games replaced or removed, the newly processed games,
+    and the lineup_miscounts the cached run had
+    '''
+    df_raw = read_season_csv(season)
+    game_hashes = get_game_hashes(df_raw)
+
+    df_cached, meta = season_cache.load_latest_stage(season, stages)
+    if (df_cached is None) or ('game_hashes' not in meta):
+        logger.info(f"No cached {season} {'-'.join(stages)} to update, processing every game")
+        df_cached, cached_hashes, old_miscounts = None, {}, {}
+    else:
+        cached_hashes, old_miscounts = meta['game_hashes'], meta.get('lineup_miscounts', {})
+
+    changed_games = [url for url, game_hash in game_hashes.items() if cached_hashes.get(url) != game_hash]
+    stale_games = set(changed_games) | (set(cached_hashes.keys()) - set(game_hashes.keys()))
+    logger.info(f"{season}: {len(changed_games)} new or changed games, {len(stale_games) - len(changed_games)} removed, "
+                f"{len(game_hashes) - len(changed_games)} unchanged")
+    pipeline_profile.record_event('incremental_update', season=season, changed=len(changed_games), 
+                                  removed=len(stale_games) - len(changed_games))
+    lineup_miscounts.update({url:n for url, n in old_miscounts.items() if url not in stale_games})
+    for url in stale_games:
+        lineup_miscounts.pop(url, None)
+
+    df_new_games = None
+    if len(changed_games) > 0:
+        df_new_games = clean_season(df_raw[df_raw['URL'].isin(changed_games)], season)
+        for stage in stages[1:]:
+            df_new_games = run_stage(df_new_games, stage, lineup_engine=lineup_engine, n_jobs=n_jobs)
+
+    if df_cached is None:
+        df_, df_old_games = df_new_games, df_new_games.iloc[:0]
+    else:
+        if 'AwayLineup' in df_cached.columns:
+            df_cached = add_lineup_keys(df_cached)
+        stale_rows = df_cached['URL'].isin(stale_games)
+        df_old_games = df_cached[stale_rows]
+        if df_new_games is None:
+            df_new_games = df_cached.iloc[:0]
+        df_ = pd.concat([get_raw_row_numbers(df_cached[~stale_rows], df_raw), df_new_games], axis=0)
+        # games in sorted URL order, like the groupby('URL') applies of a full run
+        df_ = df_.iloc[np.argsort(df_['URL'].values, kind='stable')]
+
+    if len(stale_games) > 0:
+        save_season_stage(df_, source_path, season, stages, game_hashes)
+    return df_, df_old_games, df_new_games, old_miscounts
+
+
+def get_raw_row_numbers(df_games, df_raw):
+    '''
+    df_games (processed rows of games unchanged since they were cached) with the row numbers their raw rows have in
+    df_raw now: the k-th smallest cached row number of a game becomes the k-th row number of that game in df_raw
+    '''
+    cached_urls = df_games['URL'].values
+    cached_order = np.lexsort((df_games.index.values, cached_urls))
+    in_games = df_raw['URL'].isin(set(cached_urls)).values
+    raw_urls, raw_index = df_raw['URL'].values[in_games], df_raw.index.values[in_games]
+    raw_order = np.lexsort((raw_index, raw_urls))
+    if (len(raw_order) != len(cached_order)) or (raw_urls[raw_order] != cached_urls[cached_order]).any():
+        raise ValueError("cached games do not have the same number of rows as in the play-by-play file")
+    row_numbers = np.empty(len(cached_order), dtype=raw_index.dtype)
+    row_numbers[cached_order] = raw_index[raw_order]
+    return df_games.set_axis(row_numbers, axis=0)
+
+
+def run_stage(df_pbp, stage, lineup_engine='vectorized', n_jobs=1):
+    if stage not in ('lineups', 'possessions'):
+        raise ValueError(f"unknown stage {stage}")
+    with pipeline_profile.stage(stage, n_jobs=n_jobs) as record:
+        if n_jobs > 1:
+            df_ = run_stage_parallel(df_pbp, stage, n_jobs=n_jobs, lineup_engine=lineup_engine)
+        elif stage == 'lineups':
+            df_ = add_lineups(df_pbp, lineup_engine=lineup_engine)
+        else:
+            df_ = df_pbp.groupby('URL', group_keys=False).apply(pipeline_profile.per_game(add_possessions, 'possessions'))
+        record['rows'] = len(df_)
+    return df_
+
+
+def save_season_stage(df_pbp, source_path, season, stages, game_hashes=None):
+    season_games = set(df_pbp['URL'])
+    meta = {'lineup_miscounts': {k:int(v) for k, v in lineup_miscounts.items() if k in season_games}}
+    if game_hashes is not None:
+        meta['game_hashes'] = game_hashes
+    with pipeline_profile.stage('save_cache', stages=stages, rows=len(df_pbp)):
+        season_cache.save_stage(df_pbp.drop(columns=['AwayLineupKey','HomeLineupKey'], errors='ignore'), 
+                                source_path, season, stages, meta=meta)
+
+
+def drop_bad_games(df_pbp, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, miscounts=None):
+    if miscounts is None:
+        miscounts = {}
+    with pipeline_profile.stage('drop_bad_games') as record:
+        df_ = df_pbp
+        if drop_lineup_miscount_games:
+            df_ = df_[~ df_['URL'].isin(miscounts.keys())]
+        if drop_neg_scoring_error_games:
+            df_ = df_[~df_['URL'].isin(list(df_.loc[(df_['HomePts'] < 0) | (df_['AwayPts'] < 0), 'URL'].value_counts().index))].copy()
+        record.update(rows=len(df_), rows_dropped=len(df_pbp) - len(df_))
+    return df_
+
+
+def get_game_hashes(df_raw):
+    '''
+    URL -> sha1 of that game's raw play-by-play rows, in file order
+    file row numbers are left out, so rows added or removed in one game don't change the hashes of the games after it
+    '''
+    row_hashes = pd.util.hash_pandas_object(df_raw, index=False).values
+    game_order = np.argsort(df_raw['URL'].values, kind='stable')
+    game_urls, game_starts = np.unique(df_raw['URL'].values[game_order], return_index=True)
+    game_ends = np.r_[game_starts[1:], len(game_order)]
+    return {url: hashlib.sha1(row_hashes[game_order[start:end]].tobytes()).hexdigest()
+            for url, start, end in zip(game_urls, game_starts, game_ends)}
+
+
+def run_stage_parallel(df_pbp, stage, n_jobs, lineup_engine='vectorized', shards_per_job=4):
+    '''
+    Runs the 'lineups' or 'possessions' stage on shards of games in a process pool
+    Shards are contiguous runs of the sorted game URLs, so the merged frame and lineup_miscounts
+    come back in the same order as the single-process groupby
+    '''
+    load_season_players(df_pbp)
+
+    game_urls = np.sort(df_pbp['URL'].unique())
+    url_shards = [shard for shard in np.array_split(game_urls, n_jobs*shards_per_job) if len(shard) > 0]
+    df_shards = [df_pbp[df_pbp['URL'].isin(shard)] for shard in url_shards]
+    shard_players = [{p:players_dict[p] for p in get_season_participants(df_shard) if p in players_dict} 
+                     for df_shard in df_shards]
+
+    # players are preloaded above, boxscores are only known to be needed inside the workers:
+    # they all draw from one shared request budget instead of one each
+    limiter = BBRscrape_players.SharedRateLimiter(requests_per_second=BBRscrape_players.rate_limiter.requests_per_second)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=BBRscrape_players.set_rate_limiter, initargs=(limiter,)) as executor:
+        results = list(executor.map(process_games, 
+                                    df_shards, 
+                                    shard_players, 
+                                    [stage]*len(df_shards), 
+                                    [lineup_engine]*len(df_shards)))
+
+    for _, shard_miscounts, new_players in results:
+        lineup_miscounts.update(shard_miscounts)
+        players_dict.update(new_players)
+    df_ = pd.concat([df_shard for df_shard, _, _ in results], axis=0)
+    if stage == 'lineups':
+        df_ = add_lineup_keys(df_)
+    return df_
+
+
+def process_games(df_games, shard_players, stage, lineup_engine='vectorized'):
+    # worker side of run_stage_parallel, module globals here belong to the worker process
+    players_dict.update(shard_players)
+    known_players = set(players_dict.keys())
+    lineup_miscounts.clear()
+    if stage == 'lineups':
+        # lineup keys are added by the parent, player codes are local to each process
+        df_games = add_lineups(df_games, lineup_engine=lineup_engine, keys=False)
+    elif stage == 'possessions':
+        df_games = df_games.groupby('URL', group_keys=False).apply(add_possessions)
+    new_players = {p:v for p, v in players_dict.items() if p not in known_players}
+    return df_games, dict(lineup_miscounts), new_players
+
+
+def get_season_participants(df_pbp):
+    return list(get_participant_index(df_pbp)['Player'].unique())
+
+
+def load_season_players(df_pbp):
+    load_players(get_season_participants(df_pbp))
+
+
+def read_season(season):
+    return clean_season(read_season_csv(season), season)
+
+
+def read_season_csv(season):
+    with pipeline_profile.stage('read_csv', season=season) as record:
+        df_raw = pd.read_csv(f'PBP_data/NBA_PBP_{season}.csv')
+        record['rows'] = len(df_raw)
+    return df_raw
+
+
+def read_season_chunks(season, chunksize=50000, dtype=pbp_csv_dtypes):
+    '''
+    Yields a season's play-by-play file in chunks of about chunksize rows, rounded to whole games
+    (a game is never split across chunks), with compact dtypes
+    The rows of each game have to be contiguous in the file, as they are in the Kaggle files
+    '''
+    # categories are set per yielded chunk, so the held back rows of a game concat cleanly with the next read
+    category_cols = [col for col, col_dtype in dtype.items() if col_dtype == 'category']
+    read_dtype = {col:(object if col in category_cols else col_dtype) for col, col_dtype in dtype.items()}
+
+    df_held_back = None
+    seen_games = set()
+    for df_rows in pd.read_csv(f'PBP_data/NBA_PBP_{season}.csv', dtype=read_dtype, chunksize=chunksize):
+        if df_held_back is not None:
+            df_rows = pd.concat([df_held_back, df_rows], axis=0)
+        # the last game of the read may go on in the next one
+        last_game_rows = df_rows['URL'].values == df_rows['URL'].values[-1]
+        df_held_back = df_rows[last_game_rows]
+        df_games = df_rows[~last_game_rows]
+        if len(df_games) == 0:
+            continue
+
+        chunk_games = set(df_games['URL'].unique())
+        if (len(chunk_games & seen_games) > 0) or (df_held_back['URL'].values[0] in chunk_games):
+            raise ValueError(f"rows of a game are not contiguous in PBP_data/NBA_PBP_{season}.csv, read it with read_season")
+        seen_games.update(chunk_games)
+        yield df_games.astype({col:'category' for col in category_cols})
+
+    if (df_held_back is not None) and (len(df_held_back) > 0):
+        if df_held_back['URL'].values[0] in seen_games:
+            raise ValueError(f"rows of a game are not contiguous in PBP_data/NBA_PBP_{season}.csv, read it with read_season")
+        yield df_held_back.astype({col:'category' for col in category_cols})
+
+
+def iter_lineup_sums(seasons, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', n_jobs=1, chunksize=50000):
+    '''
+    Streams every season through the whole pipeline (timestamps, lineups, possessions) one read_season_chunks chunk
+    at a time, and yields the get_lineup_sums of each chunk
+    '''
+    for season in seasons:
+        season = get_season_name(season)
+        n_games = 0
+        for df_raw in read_season_chunks(season, chunksize=chunksize):
+            df_ = clean_season(df_raw, season)
+            for stage in ['lineups', 'possessions']:
+                df_ = run_stage(df_, stage, lineup_engine=lineup_engine, n_jobs=n_jobs)
+            n_games += df_['URL'].nunique()
+            df_ = drop_bad_games(df_, drop_lineup_miscount_games, drop_neg_scoring_error_games, lineup_miscounts)
+            logger.info(f"{season}: {n_games} games processed")
+            if len(df_) > 0:
+                yield get_lineup_sums(df_)
+
+
+def stream_lineup_results(seasons, return_lineup_matchups=True, drop_lineup_miscount_games=True, drop_neg_scoring_error_games=True, lineup_engine='vectorized', n_jobs=1, chunksize=50000):
+    '''
+    get_lineup_results(load_seasons(seasons, lineups=True, possessions=True)) without ever holding more than one chunk
+    of plays in memory, the lineup sums of each chunk are folded into the running totals as it is done
+    '''
+    df_lineup_sums = None
+    for df_chunk_sums in iter_lineup_sums(seasons, 
+                                          drop_lineup_miscount_games=drop_lineup_miscount_games, 
+                                          drop_neg_scoring_error_games=drop_neg_scoring_error_games, 
+                                          lineup_engine=lineup_engine, 
+                                          n_jobs=n_jobs, 
+                                          chunksize=chunksize):
+        df_lineup_sums = df_chunk_sums if df_lineup_sums is None else combine_lineup_sums([df_lineup_sums, df_chunk_sums])
+    return summarize_lineup_results(df_lineup_sums, return_lineup_matchups=return_lineup_matchups)
+
+
+def clean_season(df_raw, season):
+    with pipeline_profile.stage('clean_ids', rows=len(df_raw)):
+        df_ = df_raw.copy()
+        
+        df_['Date'] = pd.to_datetime(df_['Date']+ ' '+ df_['Time'])
+        df_ = df_.rename(columns={'Time':'Season'})
+        df_['Season'] = season
+        
+        # keep only bbr_id in play-identification columns
+        df_.loc[:,player_cols] = df_[player_cols].apply(lambda x: x.str.split('-').str[-1].str.strip())
+        # Replace coach (id ends with 'c') technical fouls with Team
+        df_.loc[df_['Fouler'].str[-1] == 'c', 'Fouler'] = 'Team'
         
-    df_ = df_.groupby('URL', group_keys=False).apply(add_timestamps)
+        df_.loc[df_['Fouled'] == 'NULL', 'Fouled'] = np.nan
+        
+        # For consistency of Play team was fouled
+        df_.loc[df_['FoulType'].isin(['loose ball','offensive', 'technical'])
+                , ['AwayPlay', 'HomePlay']
+               ] = df_.loc[df_['FoulType'].isin(['loose ball','offensive', 'technical'])
+                           , ['HomePlay', 'AwayPlay']
+                          ].values  
+        
+    with pipeline_profile.stage('add_timestamps', rows=len(df_)):
+        df_ = df_.groupby('URL', group_keys=False).apply(add_timestamps)
     
   
     #specific Corrections
-    if season == '2015-16':
+    if (season == '2015-16') and (53066 in df_.index):
         # Misrecorded substitution, manually cross-checked with ESPN.com play-by-play
         df_.loc[53066, ['AwayPlay', 'EnterGame','LeaveGame']] = ['L. Thomas enters the game for J. Caldern',
                                                                  'thomala01',
                                                                  'caldejo01']
-        
-    if lineups:
-        df_ = df_.groupby('URL', group_keys=False).apply(add_lineup_cols)
-    if possessions:
-        df_ = df_.groupby('URL', group_keys=False).apply(add_possessions)  
-    if drop_lineup_miscount_games:
-        df_ = df_[~ df_['URL'].isin(lineup_miscounts.keys())]
-    if drop_neg_scoring_error_games:
-        df_ = df_[~df_['URL'].isin(list(df_.loc[(df_['HomePts'] < 0) | (df_['AwayPts'] < 0), 'URL'].value_counts().index))].copy()
-    print("Neg Scoring Error Games: ", list(df_.loc[(df_['HomePts'] < 0) | (df_['AwayPts'] < 0), 'URL'].value_counts().index))
-    print("Lineup Miscount Games: ", lineup_miscounts)
+
+    # event type of every play, classified once here for add_possessions and the lineup stages
+    with pipeline_profile.stage('classify_events', rows=len(df_)):
+        df_['Event'] = classify_events(df_)
     return df_
 
 
-def load_specific_games(season, game_url_list=[], lineups=True, possessions=True):
-    df_season = load_season(season, lineups=False, possessions=False)
+def get_events(df_pbp):
+    # Event column of clean_season, frames built some other way are classified on the spot
+    if 'Event' in df_pbp.columns:
+        return df_pbp['Event'].values
+    return classify_events(df_pbp)
+
+
+def load_specific_games(season, game_url_list=[], lineups=True, possessions=True, lineup_engine='vectorized'):
+    df_season = read_season(get_season_name(season))
     if len(game_url_list) == 0:
         game_url_list = [df_season.at[0, 'URL']]
     df_ = df_season[df_season['URL'].isin(game_url_list)].copy()
     
     if lineups:
-        df_ = df_.groupby('URL', group_keys=False).apply(add_lineup_cols)
+        df_ = add_lineups(df_, lineup_engine=lineup_engine)
     if possessions:
         df_ = df_.groupby('URL', group_keys=False).apply(add_possessions)
         
     return df_
 
 
+def add_lineups(df_pbp, lineup_engine='vectorized', keys=True):
+    if lineup_engine == 'legacy':
+        df_ = df_pbp.groupby('URL', group_keys=False).apply(pipeline_profile.per_game(add_lineup_cols, 'lineups'))
+    elif lineup_engine == 'vectorized':
+        df_ = add_lineup_cols_vectorized(df_pbp)
+    else:
+        raise ValueError(f"lineup_engine must be 'vectorized' or 'legacy', not {lineup_engine}")
+    if keys:
+        df_ = add_lineup_keys(df_)
+    return df_
+
+
+def add_lineup_keys(df_pbp):
+    # integer keys (see lineup_codes.py) so lineup groupbys hash int64 instead of strings
+    df_pbp['AwayLineupKey'] = lineup_keys(df_pbp['AwayLineup'])
+    df_pbp['HomeLineupKey'] = lineup_keys(df_pbp['HomeLineup'])
+    return df_pbp
+
+
 def add_timestamps(df_):
     df_ = df_.iloc[:,:].sort_values(['Quarter', 'SecLeft'], ascending=[True, False])
     df_.insert(8, 'Timestamp', (~df_.duplicated(subset=['Quarter', 'SecLeft'])).cumsum())
@@ -99,125 +542,237 @@ def add_timestamps(df_):
     return df_
 
 
-def participants_by_qtr(df_pbp):
-    player_cols = ['Shooter','Assister','Blocker','Fouler','Fouled','Rebounder', 
-                    'TurnoverPlayer', 'TurnoverCauser', 'ViolationPlayer','FreeThrowShooter',
-                    'EnterGame', 'LeaveGame','JumpballAwayPlayer','JumpballHomePlayer','JumpballPoss']
-    participants_by_qtr = {}
-    for qtr in range(1,df_pbp['Quarter'].max()+1):
-        qtr_plays = df_pbp['Quarter'] == qtr
-        not_technical_fouls = df_pbp['FoulType'] != 'technical'
-        stat_qtr_players = set()
-
-        for col in player_cols:
-            stat_qtr_players.update(list(df_pbp.loc[qtr_plays & not_technical_fouls
-                                                    ,col
-                                                   ].value_counts().index
-                                        )
-                                   )
-        stat_qtr_players.discard('Team')
-        #print(qtr, stat_qtr_players)
-        participants_by_qtr[qtr] = stat_qtr_players
-        
+def get_participant_index(df_pbp):
+    '''
+    (URL, Quarter, Player) of every player named in a play other than a technical foul, once each,
+    in order of first appearance. One pass over the player columns of the whole frame,
+    participants_by_qtr/get_game_participants/get_home_players_and_load_players take a game's slice of it
+    '''
+    stat_rows = np.flatnonzero(get_events(df_pbp) != event_codes['TechnicalFoul'])
+    stat_players = df_pbp[player_cols].values[stat_rows].ravel()
+    stat_rows = np.repeat(stat_rows, len(player_cols))
+    named = pd.notnull(stat_players) & (stat_players != 'Team')
+    return pd.DataFrame({'URL': df_pbp['URL'].values[stat_rows[named]],
+                         'Quarter': df_pbp['Quarter'].values[stat_rows[named]],
+                         'Player': stat_players[named]}).drop_duplicates(ignore_index=True)
+
+
+def participants_by_qtr(df_pbp, df_participants=None):
+    # df_participants: the game's rows of get_participant_index, built here when not given
+    if df_participants is None:
+        df_participants = get_participant_index(df_pbp)
+    participants_by_qtr = {qtr:set() for qtr in range(1,df_pbp['Quarter'].max()+1)}
+    for qtr, player in zip(df_participants['Quarter'].values, df_participants['Player'].values):
+        participants_by_qtr[qtr].add(player)
     return participants_by_qtr
 
 
-def get_game_participants(df_pbp):
-    players_by_qtr = participants_by_qtr(df_pbp)
-    game_players = set([player for quarter_participants in players_by_qtr.values() 
-                                for player in quarter_participants
-                                    if player != 'Team'])
-    return list(game_players)
+def get_game_participants(df_pbp, df_participants=None):
+    if df_participants is None:
+        df_participants = get_participant_index(df_pbp)
+    return list(df_participants['Player'].unique())
 
 
 def load_player(bbr_id):
     
-    print('Loading',bbr_id, end='... ')
+    logger.debug(f'Loading {bbr_id}')
     players_dict[bbr_id] = {}
-    player_dfs_to_load = ['adj_shooting','advanced','all_salaries', 'info',\
-                          'pbp','per_minute','per_poss','shooting','totals']
-    if (not os.path.isdir(f'Players/{bbr_id}')) or (len(os.listdir(f'Players/{bbr_id}')) == 0):
-
-        os.makedirs(f'Players/{bbr_id}')
-        scraped_player = scrape_players(bbr_id)
-        time.sleep(np.pi)
-        #print(type(scraped_player), scraped_player.keys())
-
-        for table_name, df in scraped_player[bbr_id].items():
-            #print(table_name, end=', ')
-            df.to_csv(f'Players/{bbr_id}/{table_name}.csv')
-            if table_name in player_dfs_to_load:
-                players_dict[bbr_id][table_name] = df
+    stored_player = player_store.load_players([bbr_id], table_names=player_dfs_to_load).get(bbr_id)
+    if stored_player is not None:
+        players_dict[bbr_id] = stored_player
 
-    else:
-        #print(' already exists locally')
+    elif os.path.isdir(f'Players/{bbr_id}') and (len(os.listdir(f'Players/{bbr_id}')) > 0):
+        # scraped before player_store existed, move it into the store
+        player_tables = player_store.read_player_dir(f'Players/{bbr_id}')
+        player_store.save_player(bbr_id, player_tables)
+        players_dict[bbr_id] = {table_name:df for table_name, df in player_tables.items() 
+                                if table_name in player_dfs_to_load}
 
+    else:
+        # pacing between requests is left to the BBRscrape_players rate limiter
+        scraped_player = scrape_player(bbr_id, table_ids=player_dfs_to_load)
+        player_store.save_player(bbr_id, scraped_player)
 
-        multiindex_col_dfs = ['playoffs_shooting','all_college_stats','pbp',
-                              'highs-playoffs','highs-reg-season','playoffs_pbp',
-                              'shooting','adj_shooting']
-        for df_path in os.listdir(f'Players/{bbr_id}'):
-            if df_path.replace('.csv','') in player_dfs_to_load:
-                if df_path.replace('.csv','') in multiindex_col_dfs:
-                    header = [0,1]
-                else:
-                    header = [0]
-                players_dict[bbr_id][df_path.replace('.csv','')] = pd.read_csv(f'Players/{bbr_id}/{df_path}', header = header, index_col=0)
+        for table_name, df in scraped_player.items():
+            if table_name in player_dfs_to_load:
+                players_dict[bbr_id][table_name] = df
 
 
+def load_players(bbr_ids, n_workers=4, requests_per_second=None):
+    '''
+    One store query for every player not loaded yet, old Players/{bbr_id}/ trees go through load_player,
+    and whoever is left is scraped concurrently (scrape_players), each saved to the store as soon as it is scraped
+    '''
+    missing_players = [p for p in dict.fromkeys(bbr_ids) if p not in players_dict.keys()]
+    if len(missing_players) == 0:
+        return
+    with pipeline_profile.stage('load_players', players=len(missing_players)):
+        players_dict.update(player_store.load_players(missing_players, table_names=player_dfs_to_load))
+    
+        players_to_scrape = []
+        for bbr_id in missing_players:
+            if bbr_id in players_dict.keys():
+                continue
+            elif os.path.isdir(f'Players/{bbr_id}') and (len(os.listdir(f'Players/{bbr_id}')) > 0):
+                load_player(bbr_id)
+            else:
+                players_to_scrape.append(bbr_id)
+
+        if len(players_to_scrape) > 0:
+            scraped_players = scrape_players(players_to_scrape, 
+                                             n_workers=n_workers, 
+                                             requests_per_second=requests_per_second,
+                                             on_scraped=player_store.save_player,
+                                             table_ids=player_dfs_to_load)
+            for bbr_id, scraped_player in scraped_players.items():
+                players_dict[bbr_id] = {table_name:df for table_name, df in scraped_player.items() 
+                                        if table_name in player_dfs_to_load}
+            # the lineup stages need every player's info (sort_lineup_players), so a player left out is an error here
+            failed_players = [bbr_id for bbr_id in players_to_scrape if bbr_id not in scraped_players]
+            if len(failed_players) > 0:
+                raise ValueError(f"failed to scrape {len(failed_players)} players: {failed_players}, "
+                                 "the players scraped are saved, rerun to retry the rest")
+
+
+
+def get_team_stints(transactions):
+    '''
+    Player info Transactions (as scraped by BBRscrape_players.parse_player_info) -> [(team, From, To)]
+    the team he belonged to between consecutive transactions, To is NaT for the last one
+    '''
+    if isinstance(transactions, str):
+        transactions = ast.literal_eval(transactions)
+    if not isinstance(transactions, list):
+        return []
+
+    team_changes = []
+    for transaction in transactions:
+        date = re.match(r'([A-Z][a-z]+ \d{1,2}, \d{4})', transaction)
+        if (date is None) or ('Assigned' in transaction) or ('Recalled' in transaction):
+            # G League assignments do not take a player off his team
+            continue
+        if ('Waived' in transaction) or ('Released' in transaction):
+            team = None
+        elif 'raded' in transaction:
+            team = re.search(r' to the [^()]*\(([A-Z]{3})\)', transaction)
+            team = team.group(1) if team is not None else None
+        else:
+            team = re.search(r'\(([A-Z]{3})\)', transaction)
+            team = team.group(1) if team is not None else None
+        team_changes.append((pd.Timestamp(date.group(1)), team))
 
-def get_home_players_and_load_players(df_game):
-    participants = get_game_participants(df_game)
+    team_changes = sorted(team_changes, key=lambda x: x[0])
+    ends = [date for date, team in team_changes[1:]] + [pd.NaT]
+    return [(team, date, end) for (date, team), end in zip(team_changes, ends) if team is not None]
 
-    for bbr_id in participants:
-        if bbr_id in players_dict.keys():
-            continue
-        else: 
-            load_player(bbr_id)
-        
-    def is_player_on_hometeam(bbr_id):
-        try:
-            if 'Tm' in players_dict[bbr_id].get('per_poss').columns:
-                players_dict[bbr_id]['per_poss'].rename({'Tm':'Team'}, axis='columns', inplace=True)
-        except:
-            print(bbr_id, players_dict[bbr_id].keys())
-        player_teams_in_game_season = players_dict[bbr_id]['per_poss'].loc[(players_dict[bbr_id]['per_poss']['Season'] \
-                                                                             == df_game['Season'].value_counts().index[0]) \
-                                                                            ,'Team' \
-                                                                           ].values
-        #print(bbr_id,player_teams_in_game_season)
-        away_player, home_player = False, False
-        for team in player_teams_in_game_season:
-            if team == df_game['AwayTeam'].value_counts().index[0]:
-                away_player = True
-            if team == df_game['HomeTeam'].value_counts().index[0]:
-                home_player = True
-        if (away_player and home_player) or (not (away_player or home_player)):
-            if df_game.loc[(df_game['EnterGame'] == bbr_id) | (df_game['LeaveGame'] == bbr_id), 'HomePlay'].notnull().sum() > 0:
-                home_player = True
-            if df_game.loc[(df_game['EnterGame'] == bbr_id) | (df_game['LeaveGame'] == bbr_id), 'AwayPlay'].notnull().sum() > 0:
-                home_player = False
-
-        return home_player
-
-
-    return {k:is_player_on_hometeam(k) for k in participants}
-
-
-
-def add_empty_lineup_cols(df_pbp):
-    df_pbp = df_pbp.iloc[:,:]
-    print(df_pbp['URL'].value_counts().index[0], end=', ')
 
-    hometeam_bool_dict = get_home_players_and_load_players(df_pbp)
+def get_roster_index():
+    '''
+    Teams of every loaded player in every season of his per_poss table, memoized in roster_index
+    traded players get the dates they were on each team from their Transactions, From/To are NaT
+    when open ended or when the transactions do not cover that team in that season
 
+    returns DataFrame of (Player, Season, Team, From, To)
+    '''
+    global roster_index
+    built_players, df_roster = roster_index
+    new_players = [p for p in players_dict.keys() if p not in built_players]
+    if (df_roster is not None) and (len(new_players) == 0):
+        return df_roster
+
+    rows = []
+    for p in new_players:
+        df_per_poss = players_dict[p].get('per_poss')
+        if (df_per_poss is None) or ('Season' not in df_per_poss.columns):
+            continue
+        team_col = 'Tm' if 'Tm' in df_per_poss.columns else 'Team'
+        df_info = players_dict[p].get('info')
+        transactions = df_info.at[0, 'Transactions'] \
+                       if (df_info is not None) and ('Transactions' in df_info.columns) else []
+        stints = get_team_stints(transactions)
+
+        for season, team in df_per_poss[['Season', team_col]].drop_duplicates().values:
+            if (team == 'TOT') or (not isinstance(season, str)) or (not season[:4].isdigit()):
+                continue
+            season_start, season_end = pd.Timestamp(f"{season[:4]}-07-01"), pd.Timestamp(f"{int(season[:4])+1}-06-30")
+            season_stints = [(start, end) for stint_team, start, end in stints 
+                             if (stint_team == team) and (start <= season_end) 
+                                and (pd.isnull(end) or (end >= season_start))]
+            if len(season_stints) == 0:
+                season_stints = [(pd.NaT, pd.NaT)]
+            for start, end in season_stints:
+                rows.append((p, season, team, start, end))
+
+    df_new = pd.DataFrame(rows, columns=['Player', 'Season', 'Team', 'From', 'To'])
+    df_roster = df_new if df_roster is None else pd.concat([df_roster, df_new], ignore_index=True)
+    roster_index = (built_players | set(new_players), df_roster)
+    return df_roster
+
+
+def get_home_assignments(df_pbp, df_participants):
+    '''
+    Home (True) / away (False) of every (URL, Player) of df_participants (see get_participant_index), in its order
+    one join of the participants with their games and get_roster_index, a player counts for a team on the game date
+    if he was on its roster that day. Players on both or neither roster go by the side of their substitution plays
+    '''
+    df_games = df_pbp.drop_duplicates('URL')[['URL', 'Season', 'Date', 'AwayTeam', 'HomeTeam']]
+    df_games = df_games.assign(Date=pd.to_datetime(df_games['Date']).dt.normalize(),
+                               AwayTeam=df_games['AwayTeam'].astype(object),
+                               HomeTeam=df_games['HomeTeam'].astype(object),
+                               Season=df_games['Season'].astype(object))
+    df_home = df_participants.drop_duplicates(['URL', 'Player'])[['URL', 'Player']].merge(df_games, on='URL', how='left')
+
+    df_on = df_home[['Player', 'Season', 'Date', 'AwayTeam', 'HomeTeam']].reset_index().merge(get_roster_index(), 
+                                                                                             on=['Player', 'Season'])
+    on_roster = (df_on['From'].isnull() | (df_on['From'] <= df_on['Date'])) \
+                & (df_on['To'].isnull() | (df_on['Date'] <= df_on['To']))
+    df_on['Away'] = on_roster & (df_on['Team'] == df_on['AwayTeam'])
+    df_on['Home'] = on_roster & (df_on['Team'] == df_on['HomeTeam'])
+    df_on = df_on.groupby('index')[['Away', 'Home']].any()
+    away_player = df_on['Away'].reindex(df_home.index, fill_value=False).values
+    home_player = df_on['Home'].reindex(df_home.index, fill_value=False).values
+
+    # side of the play text of every substitution a player is part of
+    sub_rows = np.flatnonzero((df_pbp['EnterGame'].notnull() | df_pbp['LeaveGame'].notnull()).values)
+    df_subs = pd.DataFrame({'URL': np.tile(df_pbp['URL'].values[sub_rows], 2),
+                            'Player': np.r_[df_pbp['EnterGame'].values[sub_rows], df_pbp['LeaveGame'].values[sub_rows]],
+                            'SubHome': np.tile(df_pbp['HomePlay'].notnull().values[sub_rows], 2),
+                            'SubAway': np.tile(df_pbp['AwayPlay'].notnull().values[sub_rows], 2)})
+    df_subs = df_subs[df_subs['Player'].notnull()].groupby(['URL', 'Player'])[['SubHome', 'SubAway']].any()
+    df_subs = df_subs.reindex(pd.MultiIndex.from_frame(df_home[['URL', 'Player']]), fill_value=False)
+
+    ambiguous = away_player == home_player
+    home_player = np.where(ambiguous & df_subs['SubHome'].values, True, home_player)
+    home_player = np.where(ambiguous & df_subs['SubAway'].values, False, home_player)
+    return df_home[['URL', 'Player']].assign(Home=home_player.astype(bool))
+
+
+def get_home_players_and_load_players(df_game, df_participants=None):
+    if df_participants is None:
+        df_participants = get_participant_index(df_game)
+    load_players(get_game_participants(df_game, df_participants))
+    df_home = get_home_assignments(df_game, df_participants)
+    return dict(zip(df_home['Player'].values, df_home['Home'].tolist()))
+
+
+
+def sort_lineup_players(hometeam_bool_dict):
     player_height_mass_team = {p:(players_dict[p]['info']['Height_cm'].values[0],
                                   players_dict[p]['info']['Mass_kg'].values[0], 
                                   hometeam_bool_dict[p]) 
                                for p in hometeam_bool_dict.keys()}
     
     # Sort players by away/home and short/tall before adding player columns
-    player_height_mass_team = dict(sorted(player_height_mass_team.items(), key=lambda x: (x[1][2], x[1][0], x[1][1])))
+    return dict(sorted(player_height_mass_team.items(), key=lambda x: (x[1][2], x[1][0], x[1][1])))
+
+
+def add_empty_lineup_cols(df_pbp, df_participants=None):
+    df_pbp = df_pbp.iloc[:,:]
+    logger.debug(f"lineups {df_pbp['URL'].value_counts().index[0]}")
+
+    hometeam_bool_dict = get_home_players_and_load_players(df_pbp, df_participants)
+
+    player_height_mass_team = sort_lineup_players(hometeam_bool_dict)
     
     # Add player column with tag for away/home
     for p in player_height_mass_team.keys():
@@ -230,9 +785,10 @@ def add_empty_lineup_cols(df_pbp):
 
 
 def add_lineup_cols(df_pbp, drop_player_cols = True):
-    players_per_quarter = participants_by_qtr(df_pbp)
-    df_empty_lineup = add_empty_lineup_cols(df_pbp).copy()
-    substitution_rows = df_empty_lineup['EnterGame'].notnull()
+    df_participants = get_participant_index(df_pbp)
+    players_per_quarter = participants_by_qtr(df_pbp, df_participants)
+    df_empty_lineup = add_empty_lineup_cols(df_pbp, df_participants).copy()
+    substitution_rows = get_events(df_empty_lineup) == event_codes['Substitution']
     lineup_cols = {col.split('_')[0]:col for col in df_empty_lineup.columns if '_' in col}
 
     home_lineup_cols = [col for col in df_empty_lineup.columns if '_h' in col]
@@ -280,89 +836,259 @@ def add_lineup_cols(df_pbp, drop_player_cols = True):
                     #print(p, ' first left the quarter at idx ', min(p_leaves))
 
 
-    home_lineup_overcounts = df_empty_lineup[home_lineup_cols].sum(axis=1) >5
-    home_lineup_undercounts = df_empty_lineup[home_lineup_cols].sum(axis=1) < 5
-    away_lineup_overcounts = df_empty_lineup[away_lineup_cols].sum(axis=1) > 5
-    away_lineup_undercounts = df_empty_lineup[away_lineup_cols].sum(axis=1) < 5
+    df_empty_lineup = repair_lineup_miscounts(df_empty_lineup, home_lineup_cols, away_lineup_cols)
+
+    df_empty_lineup.loc[:,'AwayLineup'] = df_empty_lineup.apply(lambda row: [col[:-2] for col in away_lineup_cols if row[col]] \
+                                                                 , axis=1).to_list()
+    df_empty_lineup.loc[:,'HomeLineup'] = df_empty_lineup.apply(lambda row: [col[:-2] for col in home_lineup_cols if row[col]] \
+                                                                 , axis=1).to_list()
+                    
+                    
+    df_empty_lineup['HomeLineup'] = df_empty_lineup['HomeLineup'].apply(lambda x: ','.join(x))
+    df_empty_lineup['AwayLineup'] = df_empty_lineup['AwayLineup'].apply(lambda x: ','.join(x))
+    
+    if drop_player_cols:
+        df_empty_lineup = df_empty_lineup.drop(columns=home_lineup_cols+away_lineup_cols)
+    return df_empty_lineup
+
+
+def repair_lineup_miscounts(df_lineup, home_lineup_cols, away_lineup_cols):
+    lineup_cols = {col.split('_')[0]:col for col in home_lineup_cols + away_lineup_cols}
+
+    home_lineup_overcounts = df_lineup[home_lineup_cols].sum(axis=1) >5
+    home_lineup_undercounts = df_lineup[home_lineup_cols].sum(axis=1) < 5
+    away_lineup_overcounts = df_lineup[away_lineup_cols].sum(axis=1) > 5
+    away_lineup_undercounts = df_lineup[away_lineup_cols].sum(axis=1) < 5
     home_lineup_miscounts = home_lineup_overcounts | home_lineup_undercounts
     away_lineup_miscounts = away_lineup_overcounts | away_lineup_undercounts
 
     if sum(home_lineup_miscounts | away_lineup_miscounts) > 0:
-        
+        game_url = df_lineup['URL'].values[0]
         
         if sum(home_lineup_miscounts) > 0:
-            home_miscounts_by_qtr = df_empty_lineup[home_lineup_miscounts].value_counts('Quarter')
-            home_overcounts_by_qtr = df_empty_lineup[home_lineup_overcounts].value_counts('Quarter')
-            home_undercounts_by_qtr = df_empty_lineup[home_lineup_undercounts].value_counts('Quarter')
+            home_miscounts_by_qtr = df_lineup[home_lineup_miscounts].value_counts('Quarter')
+            home_overcounts_by_qtr = df_lineup[home_lineup_overcounts].value_counts('Quarter')
+            home_undercounts_by_qtr = df_lineup[home_lineup_undercounts].value_counts('Quarter')
             
             
             for qtr in home_miscounts_by_qtr.index:
-                if home_miscounts_by_qtr[qtr] == df_empty_lineup[df_empty_lineup['Quarter'] == qtr].shape[0]:
+                if home_miscounts_by_qtr[qtr] == df_lineup[df_lineup['Quarter'] == qtr].shape[0]:
                     #entire qtr has miscount
-                    print(f'entire quarter {qtr} is missing home_player')
+                    logger.info(f'{game_url}: entire quarter {qtr} is missing home_player')
                     if home_undercounts_by_qtr.get(qtr):
                         bool_undercount = True
                     if home_overcounts_by_qtr.get(qtr):
                         bool_undercount = False
-                    missing_player = find_who_is_missing_from_game_qtr(df_pbp=df_empty_lineup, 
+                    missing_player = find_who_is_missing_from_game_qtr(df_pbp=df_lineup, 
                                                                        qtr=qtr,
                                                                        team="home",
                                                                        undercount=bool_undercount)
                     if isinstance(missing_player, str):
                         if bool_undercount:
-                            df_empty_lineup.loc[df_empty_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = True
+                            df_lineup.loc[df_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = True
                         else:
-                            df_empty_lineup.loc[df_empty_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = False
+                            df_lineup.loc[df_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = False
                         
                 else:
-                    print(f'some subset of quarter {qtr} is missing away_player')
+                    logger.warning(f'{game_url}: some subset of quarter {qtr} is missing home_player')
 
         if sum(away_lineup_miscounts) > 0:
-            away_miscounts_by_qtr = df_empty_lineup[away_lineup_miscounts].value_counts('Quarter')
-            away_overcounts_by_qtr = df_empty_lineup[away_lineup_overcounts].value_counts('Quarter')
-            away_undercounts_by_qtr = df_empty_lineup[away_lineup_undercounts].value_counts('Quarter')
+            away_miscounts_by_qtr = df_lineup[away_lineup_miscounts].value_counts('Quarter')
+            away_overcounts_by_qtr = df_lineup[away_lineup_overcounts].value_counts('Quarter')
+            away_undercounts_by_qtr = df_lineup[away_lineup_undercounts].value_counts('Quarter')
 
             
             for qtr in away_miscounts_by_qtr.index:
-                if away_miscounts_by_qtr[qtr] == df_empty_lineup[df_empty_lineup['Quarter'] == qtr].shape[0]:
+                if away_miscounts_by_qtr[qtr] == df_lineup[df_lineup['Quarter'] == qtr].shape[0]:
                     #entire qtr has miscount
-                    print(f'entire quarter {qtr} is missing away_player')
+                    logger.info(f'{game_url}: entire quarter {qtr} is missing away_player')
                     if away_undercounts_by_qtr.get(qtr):
                         bool_undercount = True
                     if away_overcounts_by_qtr.get(qtr):
                         bool_undercount = False
-                    missing_player = find_who_is_missing_from_game_qtr(df_pbp=df_empty_lineup, 
+                    missing_player = find_who_is_missing_from_game_qtr(df_pbp=df_lineup, 
                                                                        qtr=qtr,
                                                                        team="away",
                                                                       undercount=bool_undercount)
                     if isinstance(missing_player, str):
                         if bool_undercount:
-                            df_empty_lineup.loc[df_empty_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = True
+                            df_lineup.loc[df_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = True
                         else:
-                            df_empty_lineup.loc[df_empty_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = False
+                            df_lineup.loc[df_lineup['Quarter'] == qtr, lineup_cols[missing_player]] = False
                 else:
-                    print(f'some subset of quarter {qtr} is missing away_player')
+                    logger.warning(f'{game_url}: some subset of quarter {qtr} is missing away_player')
         
-        home_lineup_miscounts = df_empty_lineup[home_lineup_cols].sum(axis=1) != 5
-        away_lineup_miscounts = df_empty_lineup[away_lineup_cols].sum(axis=1) != 5
+        home_lineup_miscounts = df_lineup[home_lineup_cols].sum(axis=1) != 5
+        away_lineup_miscounts = df_lineup[away_lineup_cols].sum(axis=1) != 5
         if sum(away_lineup_miscounts) + sum(home_lineup_miscounts) == 0:
-            print('Lineup miscount rectified')
+            logger.info(f'{game_url}: lineup miscount rectified')
+            pipeline_profile.record_event('lineup_miscount', URL=game_url, rectified=True)
         else:
-            lineup_miscounts[df_empty_lineup["URL"].value_counts().index[0]] = sum(home_lineup_miscounts) + sum(away_lineup_miscounts)
-            print('Lineup miscount persists')
+            lineup_miscounts[df_lineup["URL"].value_counts().index[0]] = sum(home_lineup_miscounts) + sum(away_lineup_miscounts)
+            logger.warning(f'{game_url}: lineup miscount persists')
+            pipeline_profile.record_event('lineup_miscount', URL=game_url, rectified=False)
 
-    df_empty_lineup.loc[:,'AwayLineup'] = df_empty_lineup.apply(lambda row: [col[:-2] for col in away_lineup_cols if row[col]] \
-                                                                 , axis=1).to_list()
-    df_empty_lineup.loc[:,'HomeLineup'] = df_empty_lineup.apply(lambda row: [col[:-2] for col in home_lineup_cols if row[col]] \
-                                                                 , axis=1).to_list()
-                    
-                    
-    df_empty_lineup['HomeLineup'] = df_empty_lineup['HomeLineup'].apply(lambda x: ','.join(x))
-    df_empty_lineup['AwayLineup'] = df_empty_lineup['AwayLineup'].apply(lambda x: ','.join(x))
-    
-    if drop_player_cols:
-        df_empty_lineup = df_empty_lineup.drop(columns=home_lineup_cols+away_lineup_cols)
-    return df_empty_lineup
+    return df_lineup
+
+
+def add_lineup_cols_vectorized(df_season, drop_player_cols = True):
+    '''
+    Season-wide equivalent of df_.groupby('URL', group_keys=False).apply(add_lineup_cols).
+
+    On-court intervals are rebuilt from the EnterGame/LeaveGame rows of every game at once:
+    sub events are sorted by (game quarter, player, row), a clamped cumulative sum gives the
+    number of unmatched entries before each event, and the resulting intervals are painted onto
+    a (rows x player slots) matrix with one difference-array cumsum. Games that still miscount
+    are handed to repair_lineup_miscounts() exactly as in the per-game path.
+    '''
+    # same row order as the per-game groupby
+    df_ = df_season.iloc[np.argsort(pd.factorize(df_season['URL'], sort=True)[0], kind='stable')].copy()
+    n_rows = df_.shape[0]
+    game_codes, game_urls = pd.factorize(df_['URL'])
+
+    # one segment per (game, quarter); rows of a segment are contiguous after add_timestamps
+    quarters = df_['Quarter'].values
+    new_segment = np.r_[True, (game_codes[1:] != game_codes[:-1]) | (quarters[1:] != quarters[:-1])]
+    segment_ids = np.cumsum(new_segment) - 1
+    segment_starts = np.flatnonzero(new_segment)
+    segment_ends = np.r_[segment_starts[1:] - 1, n_rows - 1]
+    segment_games = game_codes[segment_starts]
+
+    # (segment, player) participants, from the same participant index the per-game path uses
+    df_participant_index = get_participant_index(df_)
+    df_segments = pd.DataFrame({'URL': game_urls[segment_games], 'Quarter': quarters[segment_starts],
+                                'segment': np.arange(len(segment_starts)), 'game': segment_games})
+    df_participants = df_participant_index.merge(df_segments, on=['URL', 'Quarter']
+                                                 ).rename(columns={'Player':'player'})[['segment', 'player', 'game']]
+
+    # home/away of every participant of every game in one join, see get_home_assignments
+    load_players(df_participant_index['Player'].unique())
+    df_home = get_home_assignments(df_, df_participant_index)
+    game_home_players = {url:dict(zip(df_game_home['Player'].values, df_game_home['Home'].tolist()))
+                         for url, df_game_home in df_home.groupby('URL', sort=False)}
+
+    # player slots per game, ordered away/home then short/tall like the per-game player columns
+    game_starts = np.flatnonzero(np.r_[True, game_codes[1:] != game_codes[:-1]])
+    game_ends = np.r_[game_starts[1:], n_rows]
+    slot_players = []
+    for game in range(len(game_urls)):
+        logger.debug(f"lineups {game_urls[game]}")
+        hometeam_bool_dict = game_home_players.get(game_urls[game], {})
+        for slot, p in enumerate(sort_lineup_players(hometeam_bool_dict).keys()):
+            slot_players.append((game, p, slot, hometeam_bool_dict[p]))
+    df_slots = pd.DataFrame(slot_players, columns=['game', 'player', 'slot', 'home'])
+    n_slots = df_slots['slot'].max() + 1
+    slot_names = np.full((len(game_urls), n_slots), '', dtype=object)
+    slot_names[df_slots['game'].values, df_slots['slot'].values] = df_slots['player'].values
+    slot_sides = np.full((len(game_urls), n_slots), -1, dtype=np.int8)
+    slot_sides[df_slots['game'].values, df_slots['slot'].values] = df_slots['home'].values.astype(np.int8)
+
+    df_participants = df_participants.merge(df_slots[['game', 'player', 'slot']], on=['game', 'player'])
+
+    # substitution events: +1 for EnterGame, -1 for LeaveGame
+    sub_rows = np.flatnonzero(get_events(df_) == event_codes['Substitution'])
+    df_events = pd.DataFrame({'row': np.r_[sub_rows, sub_rows],
+                              'player': np.r_[df_['EnterGame'].values[sub_rows], df_['LeaveGame'].values[sub_rows]],
+                              'delta': np.r_[np.ones(len(sub_rows), dtype=int), -np.ones(len(sub_rows), dtype=int)]})
+    df_events = df_events[df_events['player'].notnull()]
+    df_events['segment'] = segment_ids[df_events['row'].values]
+    df_events['game'] = game_codes[df_events['row'].values]
+    df_events = df_events.merge(df_participants[['segment', 'player', 'slot']], on=['segment', 'player'])
+    df_events = df_events.sort_values(['segment', 'slot', 'row']).reset_index(drop=True)
+
+    pair_groups = df_events.groupby(['segment', 'slot'], sort=False)
+    # players on court "pending" after each event, a cumsum that is clamped at zero
+    cum_delta = pair_groups['delta'].cumsum()
+    pending = (cum_delta - np.minimum(0, cum_delta.groupby([df_events['segment'], df_events['slot']]).cummin())).values
+    first_event = ~df_events.duplicated(['segment', 'slot']).values
+    last_event = ~df_events.duplicated(['segment', 'slot'], keep='last').values
+    pending_before = np.r_[0, pending[:-1]]
+    pending_before[first_event] = 0
+
+    event_rows = df_events['row'].values
+    event_slots = df_events['slot'].values
+    event_segments = df_events['segment'].values
+    next_rows = np.r_[event_rows[1:], 0]
+    next_rows[last_event] = segment_ends[event_segments[last_event]]
+
+    # a leave without a pending entry means the player started the quarter on court
+    unmatched_leaves = (df_events['delta'].values == -1) & (pending_before == 0)
+    pending_after = pending > 0
+
+    # participants without a substitution played the whole quarter
+    df_full_qtr = df_participants.merge(df_events[['segment', 'slot']].drop_duplicates(), how='left', indicator=True)
+    df_full_qtr = df_full_qtr[df_full_qtr['_merge'] == 'left_only']
+
+    interval_starts = np.r_[event_rows[pending_after] + 1,
+                            segment_starts[event_segments[unmatched_leaves]],
+                            segment_starts[df_full_qtr['segment'].values]]
+    interval_ends = np.r_[next_rows[pending_after],
+                          event_rows[unmatched_leaves],
+                          segment_ends[df_full_qtr['segment'].values]]
+    interval_slots = np.r_[event_slots[pending_after],
+                           event_slots[unmatched_leaves],
+                           df_full_qtr['slot'].values]
+    non_empty = interval_starts <= interval_ends
+
+    on_court = np.zeros((n_rows + 1, n_slots), dtype=np.int16)
+    np.add.at(on_court, (interval_starts[non_empty], interval_slots[non_empty]), 1)
+    np.add.at(on_court, (interval_ends[non_empty] + 1, interval_slots[non_empty]), -1)
+    on_court = np.cumsum(on_court[:-1], axis=0, dtype=np.int16) > 0
+
+    # games that miscount go through the same repair step as the per-game path
+    row_sides = slot_sides[game_codes]
+    home_miscounts = (on_court & (row_sides == 1)).sum(axis=1) != 5
+    away_miscounts = (on_court & (row_sides == 0)).sum(axis=1) != 5
+    miscounts = home_miscounts | away_miscounts
+
+    # the repair looks up a boxscore whenever one side miscounts a whole quarter, fetch them all in one batch
+    segment_n_rows = np.bincount(segment_ids)
+    whole_qtr_miscounts = (np.bincount(segment_ids, weights=home_miscounts) == segment_n_rows) \
+                          | (np.bincount(segment_ids, weights=away_miscounts) == segment_n_rows)
+    if whole_qtr_miscounts.any():
+        with pipeline_profile.stage('prefetch_boxscores', games=len(np.unique(segment_games[whole_qtr_miscounts]))):
+            scrape_boxscores(game_urls[np.unique(segment_games[whole_qtr_miscounts])])
+
+    for game in np.unique(game_codes[miscounts]):
+        repair_start = time.perf_counter()
+        start, end = game_starts[game], game_ends[game]
+        game_slots = df_slots[df_slots['game'] == game]
+        game_cols = [f"{p}_h" if home else f"{p}_a" for p, home in zip(game_slots['player'], game_slots['home'])]
+        df_game = df_.iloc[start:end].copy()
+        df_game[game_cols] = on_court[start:end, game_slots['slot'].values]
+        df_game = repair_lineup_miscounts(df_game,
+                                          [col for col in game_cols if col[-2:] == '_h'],
+                                          [col for col in game_cols if col[-2:] == '_a'])
+        on_court[start:end, game_slots['slot'].values] = df_game[game_cols].values.astype(bool)
+        pipeline_profile.record_game(game_urls[game], 'lineup_repair', time.perf_counter() - repair_start, rows=end - start)
+
+    # lineups only change at substitutions and quarter breaks: build each distinct run once
+    run_starts = np.flatnonzero(np.r_[True, (game_codes[1:] != game_codes[:-1]) | (on_court[1:] != on_court[:-1]).any(axis=1)])
+    run_lengths = np.diff(np.r_[run_starts, n_rows])
+    run_names = slot_names[game_codes[run_starts]]
+    for side, lineup_col in [(0, 'AwayLineup'), (1, 'HomeLineup')]:
+        run_on = on_court[run_starts] & (slot_sides[game_codes[run_starts]] == side)
+        run_lineups = [','.join(names[on]) for names, on in zip(run_names, run_on)]
+        df_[lineup_col] = np.repeat(np.array(run_lineups, dtype=object), run_lengths)
+
+    if not drop_player_cols:
+        player_col_values = {}
+        for game, game_slots in df_slots.groupby('game', sort=True):
+            start, end = game_starts[game], game_ends[game]
+            for p, home, slot in zip(game_slots['player'], game_slots['home'], game_slots['slot']):
+                col = f"{p}_h" if home else f"{p}_a"
+                if col not in player_col_values:
+                    player_col_values[col] = np.full(n_rows, np.nan, dtype=object)
+                player_col_values[col][start:end] = on_court[start:end, slot]
+        df_lineup_cols = pd.DataFrame(player_col_values, index=df_.index)
+        # column order of concatenated per-game frames: first game's player columns, lineups, then the rest
+        n_first_game_cols = (df_slots['game'] == 0).sum()
+        df_ = pd.concat([df_.drop(columns=['AwayLineup', 'HomeLineup']),
+                         df_lineup_cols.iloc[:, :n_first_game_cols],
+                         df_[['AwayLineup', 'HomeLineup']],
+                         df_lineup_cols.iloc[:, n_first_game_cols:]], axis=1)
+
+    return df_
 
 
 def find_who_is_missing_from_game_qtr(df_pbp, qtr, team, undercount):
@@ -372,6 +1098,7 @@ def find_who_is_missing_from_game_qtr(df_pbp, qtr, team, undercount):
     else:
         lineup_cols = [col for col in df_pbp.columns if col[-2:] == '_a']
         team = df_pbp.value_counts('AwayTeam').index[0]
+    pipeline_profile.record_event('boxscore', URL=df_pbp['URL'].values[0], Quarter=qtr, team=team)
     if qtr > 4:
         qtr_minutes = 5
     else: qtr_minutes = 12
@@ -404,32 +1131,53 @@ def find_who_is_missing_from_game_qtr(df_pbp, qtr, team, undercount):
     
 
 def bool_hometeam_in_possession_at_idx(df_pbp, idx):
-    game_url = df_pbp.value_counts('URL').index[0]
-    HomePossEnd_idxs = df_pbp[(df_pbp['URL'] == game_url) & df_pbp['HomePossEnd']].index
-    AwayPossEnd_idxs = df_pbp[(df_pbp['URL'] == game_url) & df_pbp['AwayPossEnd']].index
-    
-    if len(AwayPossEnd_idxs[AwayPossEnd_idxs < idx]) > 0:
-        last_AwayPossEnd_idx = AwayPossEnd_idxs[AwayPossEnd_idxs < idx][-1]
-    else:
-        last_AwayPossEnd_idx = -1
-    if len(HomePossEnd_idxs[HomePossEnd_idxs < idx]) > 0:
-        last_HomePossEnd_idx = HomePossEnd_idxs[HomePossEnd_idxs < idx][-1]
-    else:
-        last_HomePossEnd_idx = -1
-        
-    # if neither team has used a possession yet in game    
-    if (last_AwayPossEnd_idx == -1) and (last_HomePossEnd_idx == -1):
-        # did hometeam win tip?
-        opening_jump_possessor = df_pbp.loc[df_pbp['Timestamp'] ==1, 'JumpballPoss'].values[0]
-        participant_homebool_dict = get_home_players_and_load_players(df_pbp)
-        if participant_homebool_dict.get(opening_jump_possessor):
-            return True
+    df_game = df_pbp[df_pbp['URL'] == df_pbp.at[idx, 'URL']]
+    return hometeam_in_possession_at(np.flatnonzero(df_game['AwayPossEnd'].values),
+                                     np.flatnonzero(df_game['HomePossEnd'].values),
+                                     df_game.index.get_loc(idx),
+                                     lambda: get_opening_tip_home(df_game))
+
+
+def get_opening_tip_home(df_pbp):
+    # did hometeam win tip?
+    opening_jump_possessor = df_pbp.loc[df_pbp['Timestamp'] ==1, 'JumpballPoss'].values[0]
+    participant_homebool_dict = get_home_players_and_load_players(df_pbp)
+    return bool(participant_homebool_dict.get(opening_jump_possessor))
+
+
+def hometeam_in_possession_at(away_end_positions, home_end_positions, pos, opening_tip_home, assigned=(-1, -1)):
+    '''
+    away_end_positions, home_end_positions: sorted row positions of a game's AwayPossEnd/HomePossEnd
+    assigned: (away, home) position of the last possession end handed out since those were taken
+    the team that did not end the last possession before pos has the ball, O(log n) via searchsorted
+    '''
+    n_away = np.searchsorted(away_end_positions, pos)
+    n_home = np.searchsorted(home_end_positions, pos)
+    last_AwayPossEnd_pos = max(away_end_positions[n_away - 1] if n_away > 0 else -1, assigned[0])
+    last_HomePossEnd_pos = max(home_end_positions[n_home - 1] if n_home > 0 else -1, assigned[1])
+
+    # if neither team has used a possession yet in game
+    if (last_AwayPossEnd_pos == -1) and (last_HomePossEnd_pos == -1):
+        return opening_tip_home()
+    return last_AwayPossEnd_pos > last_HomePossEnd_pos
+
+
+def assign_possession_ends(away_poss_ends, home_poss_ends, positions, opening_tip_home):
+    '''
+    Concludes the possession of whichever team has the ball at each of positions (ascending), in place
+    Ends assigned earlier in the pass count for the later positions, as if the lookup was redone after each one
+    '''
+    away_end_positions = np.flatnonzero(away_poss_ends)
+    home_end_positions = np.flatnonzero(home_poss_ends)
+    assigned = [-1, -1]
+    for pos in positions:
+        if hometeam_in_possession_at(away_end_positions, home_end_positions, pos, opening_tip_home, assigned):
+            home_poss_ends[pos] = True
+            assigned[1] = pos
         else:
-            return False
-    if last_AwayPossEnd_idx > last_HomePossEnd_idx:
-        return True
-    else:
-        return False
+            away_poss_ends[pos] = True
+            assigned[0] = pos
+
 
 def add_possessions(df_pbp):
     df_ = df_pbp.copy()
@@ -437,31 +1185,22 @@ def add_possessions(df_pbp):
     df_.insert(12,'AwayPossEnd', False)
     df_.insert(16,'HomePossEnd', False)
 
-    away_plays = df_['AwayPlay'].notnull()
-    home_plays = df_['HomePlay'].notnull()
-
-    three_point_shots = df_['ShotType'].apply(lambda x: '3' in str(x))
-    two_point_shots = df_['ShotType'].apply(lambda x: '2' in str(x))
-    free_throws = df_['FreeThrowNum'].notnull() 
-
-    makes = (df_['ShotOutcome'] == 'make') |  (df_['FreeThrowOutcome'] == 'make')
-    misses = (df_['ShotOutcome'] == 'miss') |  (df_['FreeThrowOutcome'] == 'miss')    
-    
-    defensive_rebounds = df_['ReboundType'] == 'defensive'
-    turnovers = df_['TurnoverType'].notnull()
+    away_plays = df_['AwayPlay'].notnull().values
+    home_plays = df_['HomePlay'].notnull().values
 
-    final_free_throws = df_['FreeThrowNum'].isin([f"{n} of {n}" for n in range(1,4)])
-    end_quarters = df_['AwayPlay'].apply(lambda x: ('End of' in str(x)) and ('Game' not in str(x)))
+    events = get_events(df_)
+    made_shots = np.isin(events, MADE_SHOTS)
+    made_final_free_throws = np.isin(events, MADE_FINAL_FREE_THROWS)
+    defensive_rebounds = events == event_codes['DefRebound']
+    turnovers = events == event_codes['Turnover']
+    end_quarters = events == event_codes['PeriodEnd']
+    jumpballs = events == event_codes['JumpBall']
 
-    get_cotemporal_plays = lambda condition: df_['Timestamp'].isin(df_.loc[condition, 'Timestamp'].values)
+    timestamps = df_['Timestamp'].values
+    and_one_cotemporal = cotemporal(timestamps, np.isin(events, AND_ONES))
 
-    and_one_cotemporal = get_cotemporal_plays(df_['FreeThrowNum'] == '1 of 1')
-    end_quarter_cotemporal = get_cotemporal_plays(end_quarters)
-
-
-    start_qtr = (df_pbp['SecLeft'] == 720) & (df_pbp['Quarter'] <= 4)
-    start_ot = (df_pbp['SecLeft'] == 300) & (df_pbp['Quarter'] > 4)
-    jumpballs = df_pbp['JumpballAwayPlayer'].notnull()
+    start_qtr = ((df_pbp['SecLeft'] == 720) & (df_pbp['Quarter'] <= 4)).values
+    start_ot = ((df_pbp['SecLeft'] == 300) & (df_pbp['Quarter'] > 4)).values
     
     # Every defensive rebound concludes a possession for the opposite team
     df_.loc[defensive_rebounds & away_plays, 'HomePossEnd'] = True
@@ -472,271 +1211,421 @@ def add_possessions(df_pbp):
     df_.loc[turnovers & home_plays, 'HomePossEnd'] = True
 
     # Every made free throw n_of_n concludes a possession for the same team
-    df_.loc[final_free_throws & makes & away_plays, 'AwayPossEnd'] = True
-    df_.loc[final_free_throws & makes & home_plays, 'HomePossEnd'] = True
+    df_.loc[made_final_free_throws & away_plays, 'AwayPossEnd'] = True
+    df_.loc[made_final_free_throws & home_plays, 'HomePossEnd'] = True
 
     # Every made shot (without an and_one) concludes a possession for the same team
-    df_.loc[makes & (three_point_shots | two_point_shots) & ~and_one_cotemporal & away_plays, 'AwayPossEnd'] = True
-    df_.loc[makes & (three_point_shots | two_point_shots) & ~and_one_cotemporal & home_plays, 'HomePossEnd'] = True
+    df_.loc[made_shots & ~and_one_cotemporal & away_plays, 'AwayPossEnd'] = True
+    df_.loc[made_shots & ~and_one_cotemporal & home_plays, 'HomePossEnd'] = True
     
 
 
 
-    for idx in df_.loc[end_quarters].index.values:
-        
-        # EndQuarter (if no cotemporal possession conclusion) concludes possession for less recent possessor
-        if df_.loc[df_['Timestamp'] == df_.at[idx, 'Timestamp'], ['AwayPossEnd','HomePossEnd']].sum().sum() == 0:
-            if bool_hometeam_in_possession_at_idx(df_, idx):
-                df_.loc[idx, 'HomePossEnd'] = True
-            else:
-                df_.loc[idx, 'AwayPossEnd'] = True
-    
-    
-    
+    # the opening tip only matters if a quarter ends before anyone ends a possession, load the rosters only then
+    opening_tip = []
+    def opening_tip_home():
+        if len(opening_tip) == 0:
+            opening_tip.append(get_opening_tip_home(df_))
+        return opening_tip[0]
+
+    away_poss_ends = df_['AwayPossEnd'].values.copy()
+    home_poss_ends = df_['HomePossEnd'].values.copy()
+
+    # EndQuarter (if no cotemporal possession conclusion) concludes possession for less recent possessor
+    end_quarter_poss_ended = cotemporal(timestamps, away_poss_ends | home_poss_ends)
+    assign_possession_ends(away_poss_ends, home_poss_ends,
+                           np.flatnonzero(end_quarters & ~end_quarter_poss_ended), opening_tip_home)
+
     # JumpBall (mid-quarter only) concludes possession for less recent possessor
-    mid_qtr_jumpball_idxs = df_.loc[jumpballs & ~start_qtr & ~start_ot].index
-    for idx in mid_qtr_jumpball_idxs:
-        if bool_hometeam_in_possession_at_idx(df_, idx):
-            df_.loc[idx, 'HomePossEnd'] = True
-        else:
-            df_.loc[idx, 'AwayPossEnd'] = True
-    
+    assign_possession_ends(away_poss_ends, home_poss_ends,
+                           np.flatnonzero(jumpballs & ~start_qtr & ~start_ot), opening_tip_home)
+
+    df_['AwayPossEnd'] = away_poss_ends
+    df_['HomePossEnd'] = home_poss_ends
 
-    
     df_.insert(13,'AwayPoss', df_['AwayPossEnd'].cumsum())
     df_.insert(14,'AwayPts', df_['AwayScore'].diff().fillna(0).astype(int))
     df_.insert(19,'HomePoss', df_['HomePossEnd'].cumsum())
     df_.insert(20,'HomePts', df_['HomeScore'].diff().fillna(0).astype(int))
     df_.insert(22,'Margin', df_['HomeScore'] - df_['AwayScore'])
     df_.insert(23, 'FinalMargin', df_['Margin'].values[-1])
-    df_.insert(23, 'ClosestRemainingMargin', df_.apply(lambda row: df_.loc[row.name:,'Margin'].abs().min(), axis=1))
+
+    remaining_features = get_remaining_game_features(df_['Margin'].values, get_game_seconds(df_))
+    df_.insert(23, 'ClosestRemainingMargin', remaining_features.pop('ClosestRemainingMargin'))
+    for n, (feature, values) in enumerate(remaining_features.items()):
+        df_.insert(25 + n, feature, values)
 
     return df_
 
 
+def get_game_seconds(df_pbp):
+    # game clock seconds elapsed at each play, overtimes are 5 minutes
+    # in int64, 720 * an int8 Quarter (compact / csv dtypes) overflows under NumPy 2 promotion rules
+    quarters = df_pbp['Quarter'].values.astype(np.int64)
+    return np.where(quarters <= 4, 720 * quarters, 2880 + 300 * (quarters - 4)) - df_pbp['SecLeft'].values.astype(np.int64)
+
+
+def get_remaining_game_features(margin, game_seconds):
+    '''
+    Features of the rest of a game, from each play (included) to the final buzzer
+    margin: one game's home - away score after each play, in play order
+
+    ClosestRemainingMargin: smallest |margin| still to come
+    MaxRemainingHomeLead, MaxRemainingAwayLead: biggest lead each team still gets to (0 if it never leads again)
+    LastLeadChangeSec: game clock second of the last lead change still to come (NaN if the leader never changes again)
+    '''
+    # reverse cumulative min/max over the plays reversed is the min/max of everything from each play on
+    remaining = lambda accumulate, values: accumulate(values[::-1])[::-1]
+
+    leader = np.sign(margin)
+    # team leading before each play, ties skipped
+    previous_leader = pd.Series(np.where(leader != 0, leader, np.nan)).ffill().shift(1).values
+    lead_changes = (leader != 0) & (leader != previous_leader) & ~np.isnan(previous_leader)
+    lead_change_seconds = np.where(lead_changes, game_seconds, np.nan)
+
+    return {'ClosestRemainingMargin': remaining(np.minimum.accumulate, np.abs(margin)),
+            'MaxRemainingHomeLead': remaining(np.maximum.accumulate, np.maximum(margin, 0)),
+            'MaxRemainingAwayLead': remaining(np.maximum.accumulate, np.maximum(-margin, 0)),
+            'LastLeadChangeSec': remaining(np.fmax.accumulate, lead_change_seconds)}
+
+
 def get_player_attr_value(bbr_id, df_pbp, table_name='info', col_name='age', seasons_ago=1):
     '''
     
     '''
-    #print(f"getting {bbr_id}")
-    if bbr_id not in players_dict.keys():
-        load_player(bbr_id)
-
     season_year = df_pbp['Season'].value_counts().index[0]
+    return get_player_attrs([bbr_id], season_year, table_name=table_name, col_name=col_name, seasons_ago=seasons_ago)[0]
+
+
+def get_previous_season(season, seasons_ago=1):
+    # '2015-16', 1 -> '2014-15'
+    return f"{int(season[:4])-abs(seasons_ago)}-{(int(season[-2:])-abs(seasons_ago)) % 100:02d}"
+
+
+def get_player_attr_table(table_name='info', col_name='age'):
+    '''
+    One attribute of every loaded player, memoized in player_attr_tables
+    Only players loaded since the last call are added to it
+
+    returns pd.Series indexed by bbr_id (info columns, 'age' as the Birthdate)
+            or by (bbr_id, Season) (season tables, 'salary')
+    '''
     if col_name.lower() == 'age':
-        
-        season_year = season_year[:2]+ season_year[-2:]
-        
-        player_age = (pd.to_datetime(f"1/1/{season_year}") \
-                      - pd.to_datetime(players_dict[bbr_id]['info'].at[0,'Birthdate']) \
-                     ) / np.timedelta64(1, 'Y')
-        return np.round(player_age, 2)
-    
-        
+        table_name, col_name = 'info', 'Birthdate'
+    elif col_name.lower() == 'salary':
+        table_name, col_name = 'all_salaries', 'Salary'
+
+    built_players, attr_table = player_attr_tables.get((table_name, col_name), (set(), None))
+    new_players = [p for p in players_dict.keys() if p not in built_players]
+    if (attr_table is not None) and (len(new_players) == 0):
+        return attr_table
+
+    if table_name == 'info':
+        new_values = pd.Series({p: players_dict[p]['info'].at[0, col_name] 
+                                   if col_name in players_dict[p]['info'].columns else np.nan 
+                                for p in new_players}, index=pd.Index(new_players, name='bbr_id'), dtype=object)
+    else:
+        df_list = []
+        for p in new_players:
+            df_table = players_dict[p].get(table_name)
+            if (df_table is None) or ('Season' not in df_table.columns) or (col_name not in df_table.columns):
+                continue
+            team_col = 'Tm' if 'Tm' in df_table.columns else 'Team'
+            df_list.append(pd.DataFrame({'bbr_id': p,
+                                         'Season': df_table['Season'].values,
+                                         'Team': df_table[team_col].values if team_col in df_table.columns else '',
+                                         col_name: df_table[col_name].values}))
+        df_new = pd.concat(df_list) if len(df_list) > 0 else pd.DataFrame(columns=['bbr_id','Season','Team',col_name])
+
+        if col_name == 'Salary':
+            df_new[col_name] = pd.to_numeric(df_new[col_name].astype(str
+                                                                ).str.replace('$','',regex=False
+                                                                ).str.replace(',','',regex=False
+                                                                ).str.replace('(TW)','',regex=False
+                                                                ).str.replace('< Minimum','20000',regex=False
+                                                                ).str.strip(), errors='coerce')
+        else:
+            # players traded mid-season have one row per team and a TOT row for the whole season
+            n_season_rows = df_new.groupby(['bbr_id','Season'])['Season'].transform('size')
+            df_new = df_new[(n_season_rows == 1) | (df_new['Team'] == 'TOT')]
+        new_values = df_new.drop_duplicates(['bbr_id','Season']).set_index(['bbr_id','Season'])[col_name]
+
+    attr_table = new_values if attr_table is None else pd.concat([attr_table, new_values])
+    player_attr_tables[(table_name, col_name)] = (built_players | set(new_players), attr_table)
+    return attr_table
+
+
+def get_player_attrs(bbr_ids, season, table_name='info', col_name='age', seasons_ago=1):
+    '''
+    get_player_attr_value for many players of one season at once, one lookup into get_player_attr_table
+    returns np.array aligned with bbr_ids
+    '''
+    bbr_ids = list(bbr_ids)
+    load_players(bbr_ids)
+    attr_table = get_player_attr_table(table_name=table_name, col_name=col_name)
+
+    if col_name.lower() == 'age':
+        season_year = season[:2]+ season[-2:]
+        player_ages = (pd.to_datetime(f"1/1/{season_year}") - pd.to_datetime(attr_table.reindex(bbr_ids))
+                      ) / pd.Timedelta(days=365.2425)
+        return np.round(player_ages.values.astype(float), 2)
+
     if col_name.lower() == 'salary':
-        try:
-            if 'all_salaries' not in players_dict.get(bbr_id).keys():
-                return 20e3
-            else:
-                if season_year not in players_dict[bbr_id]['all_salaries'].value_counts('Season').index.values:
-                    print(f'no salary data for year for {bbr_id}')
-                    return 20e3
-                else:
-                    return players_dict.get(bbr_id
-                                           ).get('all_salaries'
-                                                ).loc[players_dict.get(bbr_id).get('all_salaries')['Season'] == season_year
-                                                      , 'Salary'
-                                                      ].str.replace('$','',regex=False
-                                                                   ).str.replace(',','',regex=False
-                                                                                ).str.replace('(TW)','',regex=False
-                                                                                             ).str.replace('< Minimum','20000',regex=False
-                                                                                                          ).str.strip().astype(int
-                                                                                                                              ).values[0]
-                
-            
-        except ValueError as ve: 
-            print(ve, bbr_id)
-            return 20e3
-        
-        except IndexError as ie:
-            print(ie, bbr_id)
-            return 20e3
-    
+        salaries = attr_table.reindex(pd.MultiIndex.from_arrays([bbr_ids, [season]*len(bbr_ids)])).values
+        no_salary = pd.isnull(salaries)
+        if no_salary.any():
+            logger.warning(f'no salary data for {season} for {list(np.array(bbr_ids)[no_salary])}')
+        return np.where(no_salary, 20e3, salaries)
+
     if table_name == 'info':
-        return players_dict[bbr_id][table_name].at[0,col_name]
-    
-   
+        return attr_table.reindex(bbr_ids).values
 
-    season_to_grab = f"{season_year[:2]}{int(season_year[2:4])-abs(seasons_ago)}-{int(season_year[-2:])-abs(seasons_ago)}" 
-    
+    season_to_grab = get_previous_season(season, seasons_ago)
+    return attr_table.reindex(pd.MultiIndex.from_arrays([bbr_ids, [season_to_grab]*len(bbr_ids)])).values
 
-    df_table_season = players_dict[bbr_id][table_name][players_dict[bbr_id][table_name]['Season'] == season_to_grab].copy()
-    
-    if df_table_season.shape[0] > 1:
-        if 'Tm' in df_table_season.columns:
-            return df_table_season.loc[df_table_season['Tm'] == 'TOT',col_name].values[0]
-        elif 'Team' in df_table_season.columns:
-            return df_table_season.loc[df_table_season['Team'] == 'TOT',col_name].values[0]
-        else:
-            print(f"SOMETHING FUNKY HAPPENED GETTING {bbr_id} {table_name} {col_name}")
-            return f"SOMETHING FUNKY HAPPENED GETTING {bbr_id} {table_name} {col_name}"
-    
-    elif df_table_season.shape[0] == 1:
-        return df_table_season[col_name].values[0]
-    
-    else:
-        return np.nan
-    
-def get_lineup_feature(df_g, table_name='info', col_name='age', seasons_ago=1, agg='list', delta_AwayHome=False):
+
+def get_lineup_attr_array(codes, seasons, features, seasons_ago=1):
     '''
-    agg can be ('list', 'mean', 'median', 'min', 'max', 'range', 'std')
-    
+    Attribute of every player in every lineup (row of player codes), for that row's season
+    features: list of (table_name, col_name)
+    returns (n_rows x 5 x n_features) object array, empty lineup slots are NaN
+    '''
+    lineup_attrs = np.full(codes.shape + (len(features),), np.nan, dtype=object)
+    for season in pd.unique(seasons):
+        season_rows = np.flatnonzero(seasons == season)
+        season_players = lineup_players(codes[season_rows])
+        for f, (table_name, col_name) in enumerate(features):
+            # code 0 (empty slot) stays NaN
+            values_by_code = np.full(len(code_players), np.nan, dtype=object)
+            values_by_code[[player_codes[p] for p in season_players]] = get_player_attrs(season_players, season,
+                                                                                       table_name=table_name,
+                                                                                       col_name=col_name,
+                                                                                       seasons_ago=seasons_ago)
+            lineup_attrs[season_rows, :, f] = values_by_code[codes[season_rows]]
+    return lineup_attrs
+
+
+def aggregate_lineup_attrs(values, filled_slots, agg='mean'):
+    '''
+    (n_rows x 5) player values -> one value per lineup, axis reductions over the slots
+    empty slots (filled_slots False) are left out, any missing player value makes the lineup's value NaN
+    '''
+    values = np.where(filled_slots, values, np.nan).astype(float)
+    with warnings.catch_warnings():
+        # lineups with no players at all
+        warnings.simplefilter('ignore', RuntimeWarning)
+        aggregated = lineup_aggs[agg][1](values, axis=1)
+    aggregated[(np.isnan(values) & filled_slots).any(axis=1)] = np.nan
+    return aggregated
+
+
+def get_lineup_features(df_g, features=[('info','age')], aggs=['mean'], seasons_ago=1, delta_AwayHome=False):
+    '''
+    Every (table_name, col_name) in features aggregated every way in aggs, in one call
+    aggs can be ('list', 'mean', 'median', 'min', 'max', 'range', 'std')
+
+    Player values are gathered once into an (n_rows x 5 x n_features) array and each agg is an axis reduction of it
+    Returns a copy of df_g with the same columns get_lineup_feature adds, for every feature x agg
     '''
     df_game = df_g.copy()
+    if isinstance(aggs, str):
+        aggs = [aggs]
+    for agg in aggs:
+        if (agg != 'list') and (agg not in lineup_aggs):
+            raise ValueError(f"agg {agg} is not one of {['list'] + list(lineup_aggs.keys())}")
 
-    get_player_val = lambda x: get_player_attr_value(bbr_id=x, 
-                                                     df_pbp=df_game, 
-                                                     table_name=table_name, 
-                                                     col_name=col_name, 
-                                                     seasons_ago=seasons_ago)
-    
-    
-    
     # For each row, get the 5 players in the row
     if 'AwayLineup' in df_game.columns:
-        
-        player_attr_dict = {p:get_player_val(p) 
-                            for p in set(df_game['AwayLineup'].str.split(',').sum() 
-                                         + df_game['HomeLineup'].str.split(',').sum()
-                                        )
-                           }
-        
-        away_lineup_vals = df_game.apply(lambda row: [player_attr_dict[player]
-                                                      for player in row['AwayLineup'].split(',')]
-                                         , axis=1).to_list()
-        home_lineup_vals = df_game.apply(lambda row: [player_attr_dict[player] 
-                                                      for player in row['HomeLineup'].split(',')]
-                                         , axis=1).to_list()
-
-        if '_' in col_name:
-            col_name = col_name.split('_')[-1]
-        if agg == 'list':
-            df_game.loc[:,[f"Away{pos}_{col_name}" for pos in range(1,6)]] = away_lineup_vals
-            df_game.loc[:,[f"Home{pos}_{col_name}" for pos in range(1,6)]] = home_lineup_vals
-            if delta_AwayHome:
-                for pos in range(1,6):
-                    df_game.loc[:,f"delta{pos}_{col_name}"] = df_game[f"Home{pos}_{col_name}"] - df_game[f"Away{pos}_{col_name}"]
-                    df_game.drop(columns=[f"Home{pos}_{col_name}", f"Away{pos}_{col_name}"], inplace=True)
-            return df_game
-
-        if agg == 'mean':
-
-            df_game.loc[:,f"AwayMean_{col_name}"] = [np.mean(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeMean_{col_name}"] = [np.mean(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaMean_{col_name}"] = df_game[f"HomeMean_{col_name}"] - df_game[f"AwayMean_{col_name}"]
-                df_game.drop(columns=[f"HomeMean_{col_name}", f"AwayMean_{col_name}"], inplace=True)
-            return df_game
-
-
-        if agg == 'median':
-
-            df_game.loc[:,f"AwayMed_{col_name}"] = [np.median(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeMed_{col_name}"] = [np.median(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaMed_{col_name}"] = df_game[f"HomeMed_{col_name}"] - df_game[f"AwayMed_{col_name}"]
-                df_game.drop(columns=[f"HomeMed_{col_name}", f"AwayMed_{col_name}"], inplace=True)
-            return df_game
-
-        if agg == 'min':
-
-            df_game.loc[:,f"AwayMin_{col_name}"] = [np.min(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeMin_{col_name}"] = [np.min(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaMin_{col_name}"] = df_game[f"HomeMin_{col_name}"] - df_game[f"AwayMin_{col_name}"]
-                df_game.drop(columns=[f"HomeMin_{col_name}", f"AwayMin_{col_name}"], inplace=True)
-            return df_game
-
-        if agg == 'max':
-
-            df_game.loc[:,f"AwayMax_{col_name}"] = [np.max(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeMax_{col_name}"] = [np.max(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaMax_{col_name}"] = df_game[f"HomeMax_{col_name}"] - df_game[f"AwayMax_{col_name}"]
-                df_game.drop(columns=[f"HomeMax_{col_name}", f"AwayMax_{col_name}"], inplace=True)
-            return df_game
-
-        if agg == 'range':
-
-            df_game.loc[:,f"AwayRange_{col_name}"] = [np.max(lineup) - np.min(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeRange_{col_name}"] = [np.max(lineup) - np.min(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaRange_{col_name}"] = df_game[f"HomeRange_{col_name}"] - df_game[f"AwayRange_{col_name}"]
-                df_game.drop(columns=[f"HomeRange_{col_name}", f"AwayRange_{col_name}"], inplace=True)
-            return df_game
-
-        if agg == 'std':
-
-            df_game.loc[:,f"AwayStd_{col_name}"] = [np.std(lineup) for lineup in away_lineup_vals]
-            df_game.loc[:,f"HomeStd_{col_name}"] = [np.std(lineup) for lineup in home_lineup_vals]
-            if delta_AwayHome:
-                df_game.loc[:,f"deltaStd_{col_name}"] = df_game[f"HomeStd_{col_name}"] - df_game[f"AwayStd_{col_name}"]
-                df_game.drop(columns=[f"HomeStd_{col_name}", f"AwayStd_{col_name}"], inplace=True)
-            return df_game
+        side_codes = {'Away': encode_lineups(df_game['AwayLineup']), 'Home': encode_lineups(df_game['HomeLineup'])}
     else:
-        
-        player_attr_dict = {p:get_player_val(p) 
-                            for p in set(df_game['Lineup'].str.split(',').sum()
-                                        )
-                           }
-        
-        lineup_vals = df_game.apply(lambda row: [player_attr_dict[player]
-                                                 for player in row['Lineup'].split(',')]
-                                               , axis=1
-                                   )
+        side_codes = {'Lineup': encode_lineups(df_game['Lineup'])}
+        delta_AwayHome = False
+    side_values = {side: get_lineup_attr_array(codes, df_game['Season'].values, features, seasons_ago=seasons_ago)
+                   for side, codes in side_codes.items()}
+
+    feature_cols = {}
+    for f, (table_name, col_name) in enumerate(features):
         if '_' in col_name:
             col_name = col_name.split('_')[-1]
-        if agg == 'list':
-            df_game.loc[:,[f"Lineup{pos}_{col_name}" for pos in range(1,6)]] = lineup_vals.to_list()
-            
-            return df_game
-
-        if agg == 'mean':
-
-            df_game.loc[:,f"LineupMean_{col_name}"] = lineup_vals.apply(lambda x: np.mean(x))
-            return df_game
-
+        for agg in aggs:
+            if agg == 'list':
+                for side, codes in side_codes.items():
+                    for pos in range(1,6):
+                        feature_cols[f"{side}{pos}_{col_name}"] = pd.Series(side_values[side][:, pos-1, f],
+                                                                            index=df_game.index).infer_objects()
+                if delta_AwayHome:
+                    for pos in range(1,6):
+                        feature_cols[f"delta{pos}_{col_name}"] = feature_cols.pop(f"Home{pos}_{col_name}"
+                                                                 ) - feature_cols.pop(f"Away{pos}_{col_name}")
+            else:
+                agg_name = lineup_aggs[agg][0]
+                for side, codes in side_codes.items():
+                    feature_cols[f"{side}{agg_name}_{col_name}"] = aggregate_lineup_attrs(side_values[side][:, :, f],
+                                                                                          codes > 0, agg)
+                if delta_AwayHome:
+                    feature_cols[f"delta{agg_name}_{col_name}"] = feature_cols.pop(f"Home{agg_name}_{col_name}"
+                                                                  ) - feature_cols.pop(f"Away{agg_name}_{col_name}")
 
-        if agg == 'median':
+    # columns added by an earlier call are overwritten in place, new ones go on the end
+    for col in [col for col in feature_cols if col in df_game.columns]:
+        df_game[col] = feature_cols.pop(col)
+    return pd.concat([df_game, pd.DataFrame(feature_cols, index=df_game.index)], axis=1)
 
-            df_game.loc[:,f"LineupMed_{col_name}"] = lineup_vals.apply(lambda x: np.median(x))
-            return df_game
 
-        if agg == 'min':
+def get_lineup_feature(df_g, table_name='info', col_name='age', seasons_ago=1, agg='list', delta_AwayHome=False):
+    '''
+    agg can be ('list', 'mean', 'median', 'min', 'max', 'range', 'std')
+    use get_lineup_features to add several (table_name, col_name) and aggs at once
+    '''
+    return get_lineup_features(df_g, features=[(table_name, col_name)], aggs=[agg], 
+                               seasons_ago=seasons_ago, delta_AwayHome=delta_AwayHome)
+    
 
-            df_game.loc[:,f"LineupMin_{col_name}"] = lineup_vals.apply(lambda x: np.min(x))
-            return df_game
+def get_stints(df_pbp):
+    '''
+    Play-by-play with lineups and possessions -> one row per stint, a run of plays of one game and quarter with the
+    same 10 players on the floor, with lineup_stat_cols summed over its plays
+    get_lineup_results, get_lineup_sums and get_lineup_features take the stint table in place of the plays
+    '''
+    if 'AwayPossEnd' not in df_pbp.columns:
+        raise ValueError("df_pbp has no possessions, load it with load_season(..., lineups=True, possessions=True)")
+    if 'AwayLineupKey' not in df_pbp.columns:
+        df_pbp = add_lineup_keys(df_pbp.copy())
+
+    # plays come game by game in time order, a stint starts wherever the game, quarter or either lineup changes
+    break_cols = ['URL', 'Quarter', 'AwayLineupKey', 'HomeLineupKey']
+    changes = np.zeros(df_pbp.shape[0], dtype=bool)
+    changes[0:1] = True
+    for col in break_cols:
+        values = df_pbp[col].values
+        changes[1:] |= values[1:] != values[:-1]
+    stint_starts = np.flatnonzero(changes)
+    stint_ends = np.r_[stint_starts[1:], df_pbp.shape[0]] - 1
+
+    df_stints = df_pbp[[col for col in ['Season', 'URL', 'Date', 'AwayTeam', 'HomeTeam', 'Quarter'] if col in df_pbp.columns]
+                      ].iloc[stint_starts].reset_index(drop=True)
+    df_stints['Stint'] = df_stints.groupby('URL', sort=False, observed=True).cumcount()
+    # SecElapsed of a play is the time since the previous one, the stint's clock starts that much before its first play
+    sec_elapsed = df_pbp['SecElapsed'].values
+    df_stints['StartSecLeft'] = df_pbp['SecLeft'].values[stint_starts] + sec_elapsed[stint_starts]
+    df_stints['EndSecLeft'] = df_pbp['SecLeft'].values[stint_ends]
+    df_stints['Plays'] = np.diff(np.r_[stint_starts, df_pbp.shape[0]])
+    for col in ['AwayLineup', 'HomeLineup']:
+        df_stints[col] = df_pbp[col].values[stint_starts]
+    for col in lineup_stat_cols:
+        df_stints[col] = np.add.reduceat(df_pbp[col].values.astype(np.int64), stint_starts) if len(stint_starts) > 0 \
+                         else np.zeros(0, dtype=np.int64)
+    for col in ['AwayLineupKey', 'HomeLineupKey']:
+        df_stints[col] = df_pbp[col].values[stint_starts]
+    return df_stints
+
+
+def get_possessions(df_pbp):
+    '''
+    Play-by-play with lineups and possessions -> one row per possession, in one pass over the AwayPossEnd/HomePossEnd flags
+    a possession runs from the play after the previous possession end of the game (either team's) to its own end play
+        PossNum: number of the possession in its game, OffHome: the home team had the ball
+        StartSec/EndSec: game clock seconds elapsed at the previous possession end and at this one
+        OffPts/DefPts: points scored by the offense / the defense over the possession's plays
+        OffLineup/DefLineup (+Key): lineups on the floor at the end play, EndEvent: event type of the end play
+    when one play ends a possession for both teams the away one comes first and the home one gets no plays
+    plays after the last possession end of a game are not part of any possession
+    '''
+    if 'AwayPossEnd' not in df_pbp.columns:
+        raise ValueError("df_pbp has no possessions, load it with load_season(..., lineups=True, possessions=True)")
+    if 'AwayLineupKey' not in df_pbp.columns:
+        df_pbp = add_lineup_keys(df_pbp.copy())
+
+    away_ends = np.flatnonzero(df_pbp['AwayPossEnd'].values.astype(bool))
+    home_ends = np.flatnonzero(df_pbp['HomePossEnd'].values.astype(bool))
+    end_rows = np.r_[away_ends, home_ends]
+    off_home = np.r_[np.zeros(len(away_ends), dtype=bool), np.ones(len(home_ends), dtype=bool)]
+    order = np.lexsort((off_home, end_rows))
+    end_rows, off_home = end_rows[order], off_home[order]
+
+    # plays come game by game, a possession starts after the previous end of its game or at the game's first play
+    game_codes = pd.factorize(df_pbp['URL'].values)[0]
+    game_starts = np.flatnonzero(np.r_[True, game_codes[1:] != game_codes[:-1]])
+    end_games = game_codes[end_rows]
+    first_in_game = np.r_[True, end_games[1:] != end_games[:-1]]
+    prev_end_rows = np.r_[0, end_rows[:-1]]
+    start_rows = np.where(first_in_game, game_starts[end_games], prev_end_rows + 1)
+    game_poss_starts = np.flatnonzero(first_in_game)
+    poss_num = np.arange(len(end_rows)) - np.repeat(game_poss_starts, np.diff(np.r_[game_poss_starts, len(end_rows)]))
+
+    game_seconds = get_game_seconds(df_pbp)
+    side_pts = {side: np.r_[0, np.cumsum(df_pbp[f'{side}Pts'].values.astype(np.int64))] for side in ['Away', 'Home']}
+    span_pts = {side: pts[end_rows + 1] - pts[np.minimum(start_rows, end_rows + 1)] for side, pts in side_pts.items()}
+    pick = lambda col, home: np.where(home, df_pbp[f'Home{col}'].values[end_rows], df_pbp[f'Away{col}'].values[end_rows])
+
+    df_poss = pd.DataFrame({'Season': df_pbp['Season'].values[end_rows],
+                            'URL': df_pbp['URL'].values[end_rows],
+                            'PossNum': poss_num,
+                            'OffHome': off_home,
+                            'OffTeam': pick('Team', off_home),
+                            'DefTeam': pick('Team', ~off_home),
+                            'Quarter': df_pbp['Quarter'].values[end_rows],
+                            'StartSec': np.where(first_in_game, 0, game_seconds[prev_end_rows]),
+                            'EndSec': game_seconds[end_rows],
+                            'OffPts': np.where(off_home, span_pts['Home'], span_pts['Away']),
+                            'DefPts': np.where(off_home, span_pts['Away'], span_pts['Home']),
+                            'OffLineup': pick('Lineup', off_home),
+                            'DefLineup': pick('Lineup', ~off_home),
+                            'EndEvent': pd.Categorical.from_codes(get_events(df_pbp)[end_rows], event_types),
+                            'OffLineupKey': pick('LineupKey', off_home),
+                            'DefLineupKey': pick('LineupKey', ~off_home)})
+    return df_poss.astype(possession_dtypes)
 
-        if agg == 'max':
 
-            df_game.loc[:,f"LineupMax_{col_name}"] = lineup_vals.apply(lambda x: np.max(x))
-            return df_game
+def get_lineup_results(df_pbp, return_lineup_matchups=True):
+    return summarize_lineup_results(get_lineup_sums(df_pbp), return_lineup_matchups=return_lineup_matchups)
 
-        if agg == 'range':
 
-            df_game.loc[:,f"LineupRange_{col_name}"] = lineup_vals.apply(lambda x: np.max(x) - np.min(x))
-            return df_game
+def get_lineup_sums(df_pbp):
+    if 'AwayLineupKey' not in df_pbp.columns:
+        df_pbp = add_lineup_keys(df_pbp.copy())
 
-        if agg == 'std':
+    # group on the int64 lineup keys, the lineup strings ride along
+    df_game_lineup_results = df_pbp.groupby(['Season','AwayLineupKey','HomeLineupKey'], as_index=False, observed=True
+                                           ).agg(AwayLineup=('AwayLineup','first'), 
+                                                 HomeLineup=('HomeLineup','first'), 
+                                                 **{col:(col,'sum') for col in lineup_stat_cols})
+    # pandas hands sums of narrow ints (compacted frames) back in the narrow dtype when they fit
+    df_game_lineup_results[lineup_stat_cols] = df_game_lineup_results[lineup_stat_cols].astype(np.int64)
+    return df_game_lineup_results[['Season','AwayLineup','HomeLineup'] + lineup_stat_cols + ['AwayLineupKey','HomeLineupKey']]
 
-            df_game.loc[:,f"LineupStd_{col_name}"] = lineup_vals.apply(lambda x: np.std(x))
-            return df_game
 
-        
-def get_lineup_results(df_pbp, return_lineup_matchups=True):
-    
-    df_game_lineup_results = df_pbp.groupby(['Season','AwayLineup','HomeLineup'], as_index=False)[['SecElapsed','AwayPossEnd','HomePossEnd', 'AwayPts', 'HomePts']].agg('sum')
-    non_zero_lineups = df_game_lineup_results.sum(axis=1, numeric_only=True) > 0
+def update_lineup_results(df_lineup_results, df_removed, df_added, return_lineup_matchups=True):
+    '''
+    Brings a get_lineup_results(df_pbp, return_lineup_matchups=True) output up to date after the df_removed plays
+    were taken out of df_pbp and the df_added plays put in, without regrouping the whole season
+    e.g. update_lineup_results(df_results, *season_updates['2015-16']) after load_season(16, ..., incremental=True)
+    '''
+    # keys are rebuilt from the strings, df_lineup_results may come from another process
+    df_sums_list = [add_lineup_keys(df_lineup_results[['Season','AwayLineup','HomeLineup'] + lineup_stat_cols].copy())]
+    if len(df_removed) > 0:
+        df_removed_sums = get_lineup_sums(df_removed)
+        df_removed_sums[lineup_stat_cols] = -df_removed_sums[lineup_stat_cols]
+        df_sums_list.append(df_removed_sums)
+    if len(df_added) > 0:
+        df_sums_list.append(get_lineup_sums(df_added))
+
+    return summarize_lineup_results(combine_lineup_sums(df_sums_list), return_lineup_matchups=return_lineup_matchups)
+
+
+def combine_lineup_sums(df_sums_list):
+    # get_lineup_sums of several sets of plays -> get_lineup_sums of all of them
+    df_game_lineup_results = pd.concat(df_sums_list, axis=0
+                                      ).groupby(['Season','AwayLineupKey','HomeLineupKey'], as_index=False, observed=True
+                                      ).agg(AwayLineup=('AwayLineup','first'), 
+                                            HomeLineup=('HomeLineup','first'), 
+                                            **{col:(col,'sum') for col in lineup_stat_cols})
+    return df_game_lineup_results[['Season','AwayLineup','HomeLineup'] + lineup_stat_cols + ['AwayLineupKey','HomeLineupKey']]
+
+
+def summarize_lineup_results(df_game_lineup_results, return_lineup_matchups=True):
+    stat_cols = lineup_stat_cols
+    non_zero_lineups = df_game_lineup_results[stat_cols].sum(axis=1) > 0
     df_lineup_results = df_game_lineup_results[non_zero_lineups].copy()
     if return_lineup_matchups:
         
@@ -751,14 +1640,16 @@ def get_lineup_results(df_pbp, return_lineup_matchups=True):
 
         return df_lineup_results
 
-    df_home_lineups = df_lineup_results.groupby(['Season','HomeLineup'], as_index=False).agg('sum', numeric_only=True)
-    df_home_lineups = df_home_lineups.rename(columns={'HomeLineup':'Lineup'})
+    df_home_lineups = df_lineup_results.groupby(['Season','HomeLineupKey'], as_index=False, observed=True
+                                               ).agg(Lineup=('HomeLineup','first'), **{col:(col,'sum') for col in stat_cols})
+    df_home_lineups = df_home_lineups.rename(columns={'HomeLineupKey':'LineupKey'})
     df_home_lineups['Home'] = True
 
-    df_away_lineups = df_lineup_results.groupby(['Season','AwayLineup'], as_index=False).agg('sum', numeric_only=True)
-    df_away_lineups = df_away_lineups.rename(columns={'AwayLineup':'Lineup'})
+    df_away_lineups = df_lineup_results.groupby(['Season','AwayLineupKey'], as_index=False, observed=True
+                                               ).agg(Lineup=('AwayLineup','first'), **{col:(col,'sum') for col in stat_cols})
+    df_away_lineups = df_away_lineups.rename(columns={'AwayLineupKey':'LineupKey'})
     df_away_lineups['Home'] = False
-    df_lineups = pd.concat([df_away_lineups, df_home_lineups], axis=0).iloc[:,:]
+    df_lineups = pd.concat([df_away_lineups, df_home_lineups], axis=0)[['Season','Lineup','LineupKey'] + stat_cols + ['Home']]
     df_lineups = df_lineups.reset_index(drop=True)
     df_lineups[['OffPoss', 'DefPoss', 'PtsScored', 'PtsAllowed']] = 0
     df_lineups.loc[df_lineups['Home'], 
@@ -0,0 +1,101 @@
+import pandas as pd
+import os
+import pickle
+import sqlite3
+import pipeline_profile
+
+
+logger = pipeline_profile.get_logger(__name__)
+
+# one sqlite file instead of a Players/{bbr_id}/{table}.csv tree
+store_path = 'Players/players.sqlite'
+# tables scraped with two header rows, see BBRscrape_players.scrape_player
+multiindex_col_dfs = ['playoffs_shooting','all_college_stats','pbp',
+                      'highs-playoffs','highs-reg-season','playoffs_pbp',
+                      'shooting','adj_shooting']
+# sqlite caps the number of ? parameters in one statement
+max_query_params = 900
+
+
+def connect():
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    con = sqlite3.connect(store_path)
+    con.execute('''CREATE TABLE IF NOT EXISTS player_tables (
+                       bbr_id TEXT NOT NULL,
+                       table_name TEXT NOT NULL,
+                       data BLOB NOT NULL,
+                       PRIMARY KEY (bbr_id, table_name))''')
+    return con
+
+
+def save_player(bbr_id, player_tables):
+    '''
+    player_tables: dict of table_name -> pd.DataFrame, as returned by scrape_player
+    '''
+    with connect() as con:
+        con.executemany('INSERT OR REPLACE INTO player_tables VALUES (?, ?, ?)',
+                        [(bbr_id, table_name, pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+                         for table_name, df in player_tables.items()])
+    con.close()
+
+
+def load_players(bbr_ids, table_names=None):
+    '''
+    Bulk read of every requested player's tables
+
+    returns dict of bbr_id -> {table_name: pd.DataFrame}, players missing from the store are left out
+    '''
+    bbr_ids = list(bbr_ids)
+    players = {}
+    if not os.path.isfile(store_path):
+        return players
+    con = connect()
+    for n in range(0, len(bbr_ids), max_query_params):
+        id_chunk = bbr_ids[n:n+max_query_params]
+        query = f"SELECT bbr_id, table_name, data FROM player_tables WHERE bbr_id IN ({','.join('?'*len(id_chunk))})"
+        for bbr_id, table_name, data in con.execute(query, id_chunk):
+            if (table_names is None) or (table_name in table_names):
+                players.setdefault(bbr_id, {})[table_name] = pickle.loads(data)
+    con.close()
+    return players
+
+
+def stored_players():
+    if not os.path.isfile(store_path):
+        return set()
+    con = connect()
+    bbr_ids = {row[0] for row in con.execute('SELECT DISTINCT bbr_id FROM player_tables')}
+    con.close()
+    return bbr_ids
+
+
+def read_player_dir(player_dir):
+    player_tables = {}
+    for df_path in os.listdir(player_dir):
+        if not df_path.endswith('.csv'):
+            continue
+        table_name = df_path.replace('.csv','')
+        if table_name in multiindex_col_dfs:
+            header = [0,1]
+        else:
+            header = [0]
+        player_tables[table_name] = pd.read_csv(os.path.join(player_dir, df_path), header=header, index_col=0)
+    return player_tables
+
+
+def migrate_player_dirs(players_dir='Players'):
+    '''
+    Copies every Players/{bbr_id}/*.csv tree into the store, players already stored are skipped
+    '''
+    already_stored = stored_players()
+    migrated = []
+    for bbr_id in sorted(os.listdir(players_dir)):
+        player_dir = os.path.join(players_dir, bbr_id)
+        if (not os.path.isdir(player_dir)) or (bbr_id in already_stored):
+            continue
+        player_tables = read_player_dir(player_dir)
+        if len(player_tables) > 0:
+            save_player(bbr_id, player_tables)
+            migrated.append(bbr_id)
+    logger.info(f"Migrated {len(migrated)} players into {store_path}")
+    return migrated
@@ -0,0 +1,158 @@
+import pandas as pd
+import hashlib
+import json
+import os
+import pipeline_profile
+
+
+logger = pipeline_profile.get_logger(__name__)
+
+cache_dir = 'PBP_cache'
+# pipeline source files, any edit to these invalidates every cached stage:
+# every module of this repo play_by_play imports except pipeline_profile, which only times and logs
+code_files = ['play_by_play.py', 'lineup_codes.py', 'event_codes.py', 'BBRscrape_boxscores.py', 'BBRscrape_players.py',
+              'pbp_schema.py', 'player_store.py', 'season_cache.py']
+_code_version = None
+
+
+def get_code_version():
+    global _code_version
+    if _code_version is None:
+        sha = hashlib.sha1()
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        for code_file in code_files:
+            with open(os.path.join(module_dir, code_file), 'rb') as f:
+                sha.update(f.read())
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+def get_file_hash(path):
+    '''
+    sha1 of a source file, only re-hashed when its size or mtime changed since the last call
+    '''
+    hashes_path = os.path.join(cache_dir, 'source_hashes.json')
+    source_hashes = {}
+    if os.path.isfile(hashes_path):
+        with open(hashes_path) as f:
+            source_hashes = json.load(f)
+
+    stat = os.stat(path)
+    size_mtime = [stat.st_size, stat.st_mtime_ns]
+    if source_hashes.get(path, [None])[:2] == size_mtime:
+        return source_hashes[path][2]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    source_hashes[path] = size_mtime + [sha.hexdigest()]
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(hashes_path, 'w') as f:
+        json.dump(source_hashes, f)
+    return sha.hexdigest()
+
+
+def get_stage_key(source_path, season, stages, options={}):
+    key = {'season': season,
+           'stages': list(stages),
+           'options': options,
+           'source': get_file_hash(source_path),
+           'code': get_code_version()}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_stage_path(season, stages, key):
+    return os.path.join(cache_dir, f"NBA_PBP_{season}_{'-'.join(stages)}_{key}")
+
+
+def to_categoricals(df_):
+    # every all-string column is stored dictionary encoded
+    df_ = df_.copy()
+    for col in df_.columns[df_.dtypes == object]:
+        if pd.api.types.infer_dtype(df_[col], skipna=True) in ('string', 'empty'):
+            df_[col] = df_[col].astype('category')
+    return df_
+
+
+def from_categoricals(df_):
+    # downstream pipeline stages write new values into these columns, so hand back plain objects
+    for col in df_.columns[df_.dtypes == 'category']:
+        df_[col] = df_[col].astype(object)
+    return df_
+
+
+def load_stage(source_path, season, stages, options={}):
+    '''
+    returns (df, meta) for a cached pipeline stage, or (None, None) on a cache miss
+    '''
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None, None
+
+    stage_path = get_stage_path(season, stages, get_stage_key(source_path, season, stages, options))
+    if not (os.path.isfile(stage_path + '.parquet') and os.path.isfile(stage_path + '.json')):
+        return None, None
+
+    df_ = from_categoricals(pq.read_table(stage_path + '.parquet').to_pandas())
+    with open(stage_path + '.json') as f:
+        meta = json.load(f)
+    return df_, meta
+
+
+def load_latest_stage(season, stages, options={}):
+    '''
+    The cached stage whatever play-by-play file it was built from (built by the current code with these options),
+    for an incremental update of the games that changed since
+    returns (df, meta) or (None, None)
+    '''
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None, None
+    if not os.path.isdir(cache_dir):
+        return None, None
+
+    stage_prefix = f"NBA_PBP_{season}_{'-'.join(stages)}_"
+    meta_paths = [os.path.join(cache_dir, cached_file) for cached_file in os.listdir(cache_dir)
+                  if cached_file.startswith(stage_prefix) and cached_file.endswith('.json')]
+    for meta_path in sorted(meta_paths, key=os.path.getmtime, reverse=True):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        stage_path = meta_path[:-len('.json')]
+        if (meta.get('code') == get_code_version()) and (meta.get('options') == options) \
+           and os.path.isfile(stage_path + '.parquet'):
+            return from_categoricals(pq.read_table(stage_path + '.parquet').to_pandas()), meta
+    return None, None
+
+
+def save_stage(df_, source_path, season, stages, options={}, meta={}):
+    try:
+        import pyarrow
+        import pyarrow.parquet as pq
+    except ImportError:
+        logger.warning('pyarrow is not installed, processed seasons will not be cached')
+        return
+
+    stage_path = get_stage_path(season, stages, get_stage_key(source_path, season, stages, options))
+    os.makedirs(cache_dir, exist_ok=True)
+    # drop stale entries of this stage left behind by older sources or code
+    for cached_file in os.listdir(cache_dir):
+        if cached_file.startswith(f"NBA_PBP_{season}_{'-'.join(stages)}_"):
+            os.remove(os.path.join(cache_dir, cached_file))
+    try:
+        pq.write_table(pyarrow.Table.from_pandas(to_categoricals(df_)), stage_path + '.parquet')
+    except (pyarrow.ArrowException, ValueError, TypeError) as e:
+        logger.warning(f'could not cache {season} {stages}: {e}')
+        return
+    with open(stage_path + '.json', 'w') as f:
+        json.dump(dict(meta, code=get_code_version(), options=options), f)
+
+
+def clear_cache(season=None):
+    if not os.path.isdir(cache_dir):
+        return
+    for cached_file in os.listdir(cache_dir):
+        if (season is None) or cached_file.startswith(f"NBA_PBP_{season}_"):
+            os.remove(os.path.join(cache_dir, cached_file))
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import threading
+import functools
+import http.server
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBRscrape_players
+import benchmark_pipeline
+import pipeline_profile
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    Serves tests/fixtures like BBR, path -> list of error statuses to answer with (in order) before serving the page
+    every request is logged to server.requests as (time, path, status)
+    '''
+    def do_GET(self):
+        with self.server.lock:
+            statuses = self.server.failures.get(self.path)
+            status = statuses.pop(0) if statuses else None
+            self.server.requests.append((time.monotonic(), self.path, status or 200))
+        if status is None:
+            return super().do_GET()
+        self.send_response(status)
+        if self.server.retry_after is not None:
+            self.send_header('Retry-After', self.server.retry_after)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def bbr_server(monkeypatch):
+    '''
+    Local BBR: BBRscrape_players.BBR_URL points at a server over tests/fixtures for the test
+    '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, directory=fixtures_dir))
+    server.lock = threading.Lock()
+    server.failures = {}
+    server.requests = []
+    server.retry_after = '0'
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(BBRscrape_players, 'BBR_URL', server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='session')
+def synthetic_season_dir(tmp_path_factory):
+    '''
+    benchmark_pipeline.make_season written once per session: 2018-19, with lineup miscounts the boxscores repair
+    (miss_rate) and miscounts that stay (drop_sub_rate), so the miscount bookkeeping and overcount lineups are exercised
+    '''
+    season_dir = tmp_path_factory.mktemp('synthetic_season')
+    cwd = os.getcwd()
+    os.chdir(season_dir)
+    try:
+        benchmark_pipeline.make_season(n_games=40, season='2018-19', miss_rate=0.05, drop_sub_rate=0.05, seed=3)
+    finally:
+        os.chdir(cwd)
+    return season_dir
+
+
+@pytest.fixture
+def synthetic_season(synthetic_season_dir, tmp_path, monkeypatch):
+    '''
+    Runs the test in a copy of the synthetic season (it may write caches or edit the play-by-play file)
+    with the pipeline's module state reset and its progress output silenced
+    '''
+    season_dir = tmp_path / 'season'
+    shutil.copytree(synthetic_season_dir, season_dir)
+    monkeypatch.chdir(season_dir)
+    log_level = pipeline_profile.log_level
+    pipeline_profile.set_log_level(logging.ERROR)
+    benchmark_pipeline.reset_pipeline_state()
+    yield '2018-19'
+    benchmark_pipeline.reset_pipeline_state()
+    pipeline_profile.set_log_level(log_level)
@@ -0,0 +1,141 @@
+import os
+import glob
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from concurrent.futures import ProcessPoolExecutor
+import BBRscrape_players
+import play_by_play
+import player_store
+from BBRscrape_players import RateLimiter, SharedRateLimiter, set_rate_limiter, get_page, scrape_player, scrape_players, \
+                              benchmark_parsers
+
+
+fixture_players = {'doejo01': 'John Doe', 'smithbo02': 'Bob Smith', 'leeka01': 'Kai Lee'}
+
+
+def player_path(bbr_id):
+    return f'/players/{bbr_id[0]}/{bbr_id}.html'
+
+
+def test_get_page_retries_429_and_5xx(bbr_server):
+    path = player_path('doejo01')
+    bbr_server.failures[path] = [429, 500, 503]
+    bbr_server.retry_after = None
+    page = get_page(bbr_server.url + path, limiter=RateLimiter(requests_per_second=100), backoff=0.05)
+    assert page.status_code == 200
+    assert [status for _, _, status in bbr_server.requests] == [429, 500, 503, 200]
+    # no Retry-After: waits backoff ** attempt between tries
+    request_times = [t for t, _, _ in bbr_server.requests]
+    assert request_times[2] - request_times[1] >= 0.05
+
+
+def test_get_page_gives_up_after_max_retries(bbr_server):
+    path = player_path('doejo01')
+    bbr_server.failures[path] = [503] * 3
+    with pytest.raises(requests.HTTPError):
+        get_page(bbr_server.url + path, limiter=RateLimiter(requests_per_second=100), max_retries=2)
+    assert len(bbr_server.requests) == 3
+
+
+def test_scrape_players_retries(bbr_server):
+    for bbr_id in fixture_players:
+        bbr_server.failures[player_path(bbr_id)] = [429, 503]
+    players = scrape_players(list(fixture_players), n_workers=3, requests_per_second=50,
+                             table_ids=play_by_play.player_dfs_to_load)
+    assert list(players) == list(fixture_players)
+    assert {bbr_id:player['info']['Name'][0] for bbr_id, player in players.items()} == fixture_players
+    assert sorted(players['doejo01']) == sorted(play_by_play.player_dfs_to_load)
+    for bbr_id in fixture_players:
+        statuses = [status for _, path, status in bbr_server.requests if path == player_path(bbr_id)]
+        assert statuses == [429, 503, 200]
+
+
+def test_scrape_players_rate_limit(bbr_server):
+    requests_per_second = 10
+    scrape_players(list(fixture_players), n_workers=3, requests_per_second=requests_per_second)
+    request_times = np.sort([t for t, _, _ in bbr_server.requests])
+    assert len(request_times) == len(fixture_players)
+    # the budget is shared by the 3 workers: one request per 1/requests_per_second overall, not per thread
+    assert request_times[-1] - request_times[0] >= 0.9 * (len(request_times) - 1) / requests_per_second
+
+
+def acquire_times(n_requests):
+    # worker side of test_shared_rate_limiter_spans_processes
+    request_times = []
+    for _ in range(n_requests):
+        BBRscrape_players.rate_limiter.acquire()
+        request_times.append(time.time())
+    return request_times
+
+
+def test_shared_rate_limiter_spans_processes():
+    requests_per_second = 20
+    limiter = SharedRateLimiter(requests_per_second=requests_per_second)
+    with ProcessPoolExecutor(max_workers=2, initializer=set_rate_limiter, initargs=(limiter,)) as executor:
+        request_times = np.sort(np.concatenate(list(executor.map(acquire_times, [3, 3]))))
+    # one budget for both processes, not one each
+    assert request_times[-1] - request_times[0] >= 0.9 * (len(request_times) - 1) / requests_per_second
+
+
+def test_scrape_players_resume_with_on_scraped(bbr_server):
+    saved = {}
+    on_scraped = lambda bbr_id, player: saved.update({bbr_id:player})
+    bbr_server.failures[player_path('leeka01')] = [404]
+    players = scrape_players(list(fixture_players), requests_per_second=50, on_scraped=on_scraped)
+    assert list(players) == ['doejo01', 'smithbo02']
+    assert list(saved) == list(players)
+
+    # rerun with only the players on_scraped has not seen
+    bbr_server.requests.clear()
+    remaining = [bbr_id for bbr_id in fixture_players if bbr_id not in saved]
+    players = scrape_players(remaining, requests_per_second=50, on_scraped=on_scraped)
+    assert list(players) == ['leeka01']
+    assert [path for _, path, _ in bbr_server.requests] == [player_path('leeka01')]
+    assert sorted(saved) == sorted(fixture_players)
+
+
+def test_load_players_names_failed_ids(bbr_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(play_by_play, 'players_dict', {})
+    with pytest.raises(ValueError, match='missingxx01'):
+        play_by_play.load_players(['doejo01', 'missingxx01'], requests_per_second=50)
+    # the players that did scrape are loaded and saved, a rerun only asks for the failed ones
+    assert 'doejo01' in play_by_play.players_dict
+    assert list(player_store.load_players(['doejo01'])) == ['doejo01']
+
+    bbr_server.requests.clear()
+    monkeypatch.setattr(play_by_play, 'players_dict', {})
+    play_by_play.load_players(['doejo01', 'smithbo02'], requests_per_second=50)
+    assert [path for _, path, _ in bbr_server.requests] == [player_path('smithbo02')]
+    assert sorted(play_by_play.players_dict) == ['doejo01', 'smithbo02']
+
+
+@pytest.mark.parametrize('bbr_id', list(fixture_players))
+def test_parse_player_page_fast_matches_soup_parser(bbr_server, bbr_id):
+    session = requests.Session()
+    limiter = RateLimiter(requests_per_second=100)
+    fast = scrape_player(bbr_id, session, limiter, table_ids=play_by_play.player_dfs_to_load)
+    soup = scrape_player(bbr_id, session, limiter, table_ids=play_by_play.player_dfs_to_load, fast=False)
+    assert sorted(fast) == sorted(soup) == sorted(play_by_play.player_dfs_to_load)
+    for table_name in play_by_play.player_dfs_to_load:
+        pd.testing.assert_frame_equal(fast[table_name], soup[table_name])
+
+
+def test_benchmark_parsers_reports_mismatches(monkeypatch):
+    page_paths = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'fixtures', 'players', '*', '*.html')))
+    times, mismatches = benchmark_parsers(page_paths, table_ids=play_by_play.player_dfs_to_load, n_repeats=1)
+    assert len(times['fast']) == len(page_paths)
+    assert mismatches == []
+
+    parse_fast = BBRscrape_players.parse_player_page_fast
+    def parse_without_totals(page_content, bbr_id, table_ids=None):
+        player_dict = parse_fast(page_content, bbr_id, table_ids=table_ids)
+        player_dict['advanced'] = player_dict['advanced'].iloc[1:]
+        return {table_name:df for table_name, df in player_dict.items() if table_name != 'totals'}
+    monkeypatch.setattr(BBRscrape_players, 'parse_player_page_fast', parse_without_totals)
+    _, mismatches = benchmark_parsers(page_paths[:1], table_ids=play_by_play.player_dfs_to_load, n_repeats=1)
+    bbr_id = os.path.basename(page_paths[0]).split('.')[0]
+    assert mismatches == [(bbr_id, 'totals'), (bbr_id, 'advanced')]
@@ -0,0 +1,20 @@
+import numpy as np
+from lineup_codes import lineup_keys, pack_lineups, unpack_lineups, encode_lineups
+
+
+def test_lineup_keys_ignore_player_order():
+    keys = lineup_keys(['a01,b01,c01,d01,e01', 'e01,d01,c01,b01,a01', 'a01,b01,c01,d01,f01'])
+    assert keys[0] == keys[1] != keys[2]
+    assert (keys >= 0).all()
+    assert (unpack_lineups(pack_lineups(encode_lineups(['a01,b01']))) > 0).sum() == 2
+
+
+def test_overcount_keys_do_not_depend_on_the_call():
+    overcount, other = 'a01,b01,c01,d01,e01,f01', 'g01,h01,i01,j01,k01,l01'
+    alone = lineup_keys([overcount])
+    with_others = lineup_keys([other, 'a01,b01,c01,d01,e01', overcount, 'f01,e01,d01,c01,b01,a01'])
+    assert alone[0] < 0
+    # the same overcount lineup gets the same key whatever else is in the call, a different one never shares it
+    assert with_others[2] == with_others[3] == alone[0]
+    assert with_others[0] < 0 and with_others[0] != alone[0]
+    assert lineup_keys([other])[0] == with_others[0]
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import pytest
+import pipeline_profile
+import play_by_play
+
+
+def sort_results(df_results, key_cols):
+    # ties in TotalPossessions come out in grouping order, which differs between runs that group differently
+    return df_results.sort_values(key_cols, kind='stable').reset_index(drop=True)
+
+
+def assert_same_lineup_results(df_results, df_expected, return_lineup_matchups):
+    key_cols = ['Season', 'AwayLineupKey', 'HomeLineupKey'] if return_lineup_matchups else ['Season', 'LineupKey', 'Home']
+    # the cumulative distributions follow the tie order, everything else has to match exactly
+    dist_cols = ['SecElapsedCumDist', 'TotPossCumDist']
+    pd.testing.assert_frame_equal(sort_results(df_results.drop(columns=dist_cols), key_cols),
+                                  sort_results(df_expected.drop(columns=dist_cols), key_cols))
+
+
+@pytest.mark.parametrize('return_lineup_matchups', [True, False])
+def test_stream_lineup_results_matches_in_memory(synthetic_season, return_lineup_matchups):
+    df_pbp = play_by_play.load_season(synthetic_season, lineups=True, possessions=True,
+                                      drop_lineup_miscount_games=False, cache=False)
+    assert (df_pbp['AwayLineup'].str.count(',') >= 5).any(), "the synthetic season should keep overcount lineups"
+    df_expected = play_by_play.get_lineup_results(df_pbp, return_lineup_matchups=return_lineup_matchups)
+    df_streamed = play_by_play.stream_lineup_results([synthetic_season], chunksize=3000,
+                                                     drop_lineup_miscount_games=False,
+                                                     return_lineup_matchups=return_lineup_matchups)
+    assert_same_lineup_results(df_streamed, df_expected, return_lineup_matchups)
+
+
+def test_incremental_update_matches_full_run(synthetic_season):
+    pytest.importorskip('pyarrow')
+    load = lambda **kwargs: play_by_play.load_season(synthetic_season, lineups=True, possessions=True,
+                                                     drop_lineup_miscount_games=False, **kwargs)
+    df_pbp = load(incremental=True)
+    df_results = play_by_play.get_lineup_results(df_pbp)
+
+    # change a game that has overcount lineups, drop another one
+    path = f'PBP_data/NBA_PBP_{synthetic_season}.csv'
+    df_raw = pd.read_csv(path)
+    overcount_games = set(df_pbp.loc[df_pbp['AwayLineup'].str.count(',') >= 5, 'URL'])
+    changed_game = next(url for url in df_raw['URL'].unique() if url in overcount_games)
+    dropped_game = df_raw['URL'].unique()[-1]
+    rebound = df_raw.index[(df_raw['URL'] == changed_game) & df_raw['Rebounder'].notnull()][3]
+    df_raw = pd.concat([df_raw.loc[:rebound], df_raw.loc[[rebound]], df_raw.loc[rebound + 1:]], ignore_index=True)
+    df_raw[df_raw['URL'] != dropped_game].to_csv(path, index=False)
+
+    df_incremental = load(incremental=True)
+    df_removed, df_added = play_by_play.season_updates[synthetic_season]
+    assert set(df_removed['URL']) == {changed_game, dropped_game}
+    assert set(df_added['URL']) == {changed_game}
+    miscounts = dict(play_by_play.lineup_miscounts)
+
+    play_by_play.lineup_miscounts.clear()
+    df_full = load(cache=False)
+    assert miscounts == play_by_play.lineup_miscounts
+    pd.testing.assert_frame_equal(df_incremental, df_full, check_dtype=False, check_categorical=False)
+    for return_lineup_matchups in [True, False]:
+        assert_same_lineup_results(play_by_play.update_lineup_results(df_results, df_removed, df_added,
+                                                                      return_lineup_matchups=return_lineup_matchups),
+                                   play_by_play.get_lineup_results(df_full, return_lineup_matchups=return_lineup_matchups),
+                                   return_lineup_matchups)
+
+
+def load_with_miscounts(season, **kwargs):
+    # the season with its miscount games kept, and the lineup_miscounts the run reported
+    play_by_play.lineup_miscounts.clear()
+    df_pbp = play_by_play.load_season(season, lineups=True, possessions=True, drop_lineup_miscount_games=False, **kwargs)
+    return df_pbp, dict(play_by_play.lineup_miscounts)
+
+
+def test_vectorized_lineups_match_legacy(synthetic_season):
+    df_legacy, legacy_miscounts = load_with_miscounts(synthetic_season, lineup_engine='legacy', cache=False)
+    df_vectorized, vectorized_miscounts = load_with_miscounts(synthetic_season, lineup_engine='vectorized', cache=False)
+    assert len(legacy_miscounts) > 0
+    assert vectorized_miscounts == legacy_miscounts
+    pd.testing.assert_frame_equal(df_vectorized, df_legacy)
+
+
+def test_cache_round_trip(synthetic_season):
+    pytest.importorskip('pyarrow')
+    df_uncached, uncached_miscounts = load_with_miscounts(synthetic_season, cache=False)
+    df_first, first_miscounts = load_with_miscounts(synthetic_season, cache=True)
+    with pipeline_profile.profile() as prof:
+        df_cached, cached_miscounts = load_with_miscounts(synthetic_season, cache=True)
+    # the second run is served from the cache, no stage is rerun
+    assert {'timestamps', 'lineups', 'possessions', 'read_csv'}.isdisjoint(record['stage'] for record in prof['stages'])
+    assert first_miscounts == cached_miscounts == uncached_miscounts
+    pd.testing.assert_frame_equal(df_first, df_uncached)
+    pd.testing.assert_frame_equal(df_cached, df_uncached)
+
+
+@pytest.mark.parametrize('lineup_engine', ['vectorized', 'legacy'])
+def test_parallel_run_matches_serial(synthetic_season, lineup_engine):
+    df_serial, serial_miscounts = load_with_miscounts(synthetic_season, lineup_engine=lineup_engine, cache=False)
+    df_parallel, parallel_miscounts = load_with_miscounts(synthetic_season, lineup_engine=lineup_engine, cache=False,
+                                                          n_jobs=2)
+    assert list(parallel_miscounts.items()) == list(serial_miscounts.items())
+    pd.testing.assert_frame_equal(df_parallel, df_serial)
+
+
+def test_game_seconds_of_compact_dtypes():
+    df_plays = pd.DataFrame({'Quarter': np.array([1, 4, 5, 6], dtype=np.int8),
+                             'SecLeft': np.array([700, 0, 300, 10], dtype=np.int16)})
+    game_seconds = play_by_play.get_game_seconds(df_plays)
+    assert game_seconds.dtype == np.int64
+    assert game_seconds.tolist() == [20, 2880, 2880, 3470]
+
+
+def test_remaining_game_features_match_brute_force(synthetic_season):
+    df_pbp = play_by_play.load_season(synthetic_season, lineups=True, possessions=True, cache=False)
+    assert df_pbp['LastLeadChangeSec'].notnull().any()
+    for url, df_game in list(df_pbp.groupby('URL', sort=False))[:10]:
+        margin = df_game['Margin'].values.astype(np.int64)
+        quarters, sec_left = df_game['Quarter'].values.astype(np.int64), df_game['SecLeft'].values.astype(np.int64)
+        game_seconds = np.where(quarters <= 4, 720 * quarters, 2880 + 300 * (quarters - 4)) - sec_left
+
+        # the leader flips whenever a lead goes to the other team than the last team to lead
+        lead_changes, last_leader = np.zeros(len(margin), dtype=bool), 0
+        for n, leader in enumerate(np.sign(margin)):
+            lead_changes[n] = (leader != 0) and (last_leader != 0) and (leader != last_leader)
+            last_leader = leader if leader != 0 else last_leader
+
+        expected = {'ClosestRemainingMargin': [np.abs(margin[n:]).min() for n in range(len(margin))],
+                    'MaxRemainingHomeLead': [max(margin[n:].max(), 0) for n in range(len(margin))],
+                    'MaxRemainingAwayLead': [max(-margin[n:].min(), 0) for n in range(len(margin))],
+                    'LastLeadChangeSec': [game_seconds[n:][lead_changes[n:]].max() if lead_changes[n:].any() else np.nan
+                                          for n in range(len(margin))]}
+        for feature, values in expected.items():
+            np.testing.assert_array_equal(df_game[feature].values.astype(float), np.array(values, dtype=float),
+                                          err_msg=f"{url} {feature}")
+
+
+def walk_possessions(df_pbp):
+    # the possession table the slow way: walk the plays, close a possession at every end flag
+    rows = []
+    game_seconds = play_by_play.get_game_seconds(df_pbp)
+    events = play_by_play.get_events(df_pbp)
+    for url, game_rows in df_pbp.groupby('URL', sort=False).indices.items():
+        pts, poss_num, start_sec = {'Away': 0, 'Home': 0}, 0, 0
+        for n in game_rows:
+            play = df_pbp.iloc[n]
+            pts['Away'] += int(play['AwayPts'])
+            pts['Home'] += int(play['HomePts'])
+            for side, other in [('Away', 'Home'), ('Home', 'Away')]:
+                if play[f'{side}PossEnd']:
+                    rows.append({'URL': url, 'PossNum': poss_num, 'OffHome': side == 'Home',
+                                 'OffTeam': play[f'{side}Team'], 'DefTeam': play[f'{other}Team'],
+                                 'Quarter': play['Quarter'], 'StartSec': start_sec, 'EndSec': game_seconds[n],
+                                 'OffPts': pts[side], 'DefPts': pts[other],
+                                 'OffLineup': play[f'{side}Lineup'], 'DefLineup': play[f'{other}Lineup'],
+                                 'EndEvent': play_by_play.event_types[events[n]]})
+                    pts, poss_num, start_sec = {'Away': 0, 'Home': 0}, poss_num + 1, game_seconds[n]
+    return pd.DataFrame(rows)
+
+
+def test_possession_table_matches_play_walk(synthetic_season):
+    df_pbp = play_by_play.load_season(synthetic_season, lineups=True, possessions=True, cache=False)
+    df_pbp = df_pbp[df_pbp['URL'].isin(df_pbp['URL'].unique()[:5])]
+    df_poss = play_by_play.get_possessions(df_pbp)
+    df_expected = walk_possessions(df_pbp)
+    assert len(df_poss) == df_pbp['AwayPossEnd'].sum() + df_pbp['HomePossEnd'].sum() == len(df_expected)
+    for col in df_expected.columns:
+        np.testing.assert_array_equal(df_poss[col].astype(object).values, df_expected[col].astype(object).values,
+                                      err_msg=col)
+
+
+def test_load_possessions_cache_round_trip(synthetic_season):
+    pytest.importorskip('pyarrow')
+    df_expected = play_by_play.get_possessions(play_by_play.load_season(synthetic_season, lineups=True, possessions=True,
+                                                                        cache=False))
+    df_first = play_by_play.load_possessions(synthetic_season, cache=True)
+    with pipeline_profile.profile() as prof:
+        df_cached = play_by_play.load_possessions(synthetic_season, cache=True)
+    assert 'load_cache' not in [record['stage'] for record in prof['stages']]
+    pd.testing.assert_frame_equal(df_first, df_expected)
+    pd.testing.assert_frame_equal(df_cached, df_expected)
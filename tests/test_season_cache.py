@@ -0,0 +1,27 @@
+import os
+import ast
+import season_cache
+
+
+def local_imports(module_file, repo_dir):
+    # repo modules module_file imports, followed through their own imports
+    found, to_visit = set(), [module_file]
+    while to_visit:
+        with open(os.path.join(repo_dir, to_visit.pop())) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else \
+                    [node.module] if isinstance(node, ast.ImportFrom) and node.module else []
+            for name in names:
+                file_name = f"{name.split('.')[0]}.py"
+                if os.path.isfile(os.path.join(repo_dir, file_name)) and file_name not in found:
+                    found.add(file_name)
+                    to_visit.append(file_name)
+    return found
+
+
+def test_code_version_covers_pipeline_modules():
+    repo_dir = os.path.dirname(os.path.abspath(season_cache.__file__))
+    pipeline_files = local_imports('play_by_play.py', repo_dir) | {'play_by_play.py'}
+    # pipeline_profile only times and logs, everything else can change what the pipeline caches
+    assert pipeline_files - {'pipeline_profile.py'} <= set(season_cache.code_files)